@@ -7,6 +7,9 @@ import matplotlib.pyplot as pl
 
 from astropy.io import fits
 
+from crossmatch import match_one_to_one
+from make_cat import flux_covariance
+
 expandpath = os.path.expandvars
 pjoin = os.path.join
 
@@ -67,11 +70,17 @@ if __name__ == "__main__":
     chaincat = fits.getdata(chaincat_file)
     summary = fits.getdata(summary_file)
 
-    inds = summary["id"]
-    sandro = sandro[inds]
+    # match the summary to the input catalog by position
+    tolerance = 0.1 / 3600.
+    isum, isandro, sep = match_one_to_one(summary["ra"], summary["dec"],
+                                          sandro["ra"], sandro["dec"], tolerance)
+    print("matched {} of {} sources".format(len(isum), len(summary)))
+    summary, chaincat = summary[isum], chaincat[isum]
+    sandro = sandro[isandro]
+    inds = np.arange(len(sandro))
 
     F = flux_matrix(chaincat)
-    C = [np.cov(f) for f in F]
+    C = flux_covariance(F)
     xx = np.linspace(0, 100, 100)
 
     # flux ratios
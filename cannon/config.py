@@ -16,6 +16,7 @@ config.log = True
 # --- Output -----
 config.scene_catalog = "superscene.fits"
 config.patchlogfile = "patchlog.dat"
+config.mass_matrix_file = ""      # per-source metric store (HDF5); "" to disable
 
 # -----------------------
 # --- Filters being run ---
@@ -31,6 +32,7 @@ config.psfstorefile = "stores/psf_jades_ng4.h5"
 config.splinedatafile = "stores/sersic_mog_model.smooth=0.0150.h5"
 config.frames_directory = os.path.expandvars("$SCRATCH/eisenstein_lab/stacchella/mosaic/st")
 config.initial_catalog = os.path.expandvars("$SCRATCH/eisenstein_lab/bdjohnson/jades_force/data/2019-mini-challenge/source_catalogs/forcepho_table_psf_matched_v5.0.fits")
+config.catalog_cache_dir = ""      # sidecar cache for the rectified catalog; "" to disable
 
 # ------------------------
 # --- Data Types/Sizes ---
@@ -39,6 +41,10 @@ config.meta_dtype = np.float32
 config.super_pixel_size = 8      # number of pixels along one side of a superpixel
 config.nside_full = 2048         # number of pixels along one side of a square input frame
 
+# ---------------------
+# --- Patch output ---
+config.output_layout = "groups"   # "groups" (one group per exposure) or "packed"
+
 # -----------------------
 # --- Patch Generation ---
 config.max_active_fraction = 0.1
@@ -46,9 +52,17 @@ config.maxactive_per_patch = 15
 
 # -----------------------
 # --- HMC parameters ---
-config.n_warm = 250
+config.sampler = "pymc3"         # "pymc3", "template" (reused pymc3 model), "native" or "multichain"
+config.n_chains = 4               # chains run in lockstep for sampler = "multichain"
+config.n_warm_tuned = 50          # n_warm when all active sources have stored metrics
+config.n_tune_tuned = 100         # n_tune when all active sources have stored metrics
+config.n_warm = 50                # final step size only warmup
 config.n_iter = 100
-config.n_tune = 100
+config.target_ess = 0              # keep drawing until every flux has this ESS; 0 for a fixed n_iter
+config.max_iter = 400             # cap on draws when target_ess is set
+config.n_tune = 250               # total warmup: metric adaptation windows, then n_warm
+config.n_start = 20               # length of the first metric window; windows double to fill n_tune - n_warm
+config.adapt_tol = 1.5            # stop metric tuning once changes are < adapt_tol x noise; 0 to disable
 
 # ------------------------
 # --- PSF information ----
@@ -16,17 +16,17 @@ from dispatcher import SuperScene
 
 # Local
 #from catalog import rectify_catalog
-from utils import Logger, dump_to_h5
+from utils import Logger, dump_to_h5, ResultWriter
+from patch_result import PatchResult
 parser = argparse.ArgumentParser()
 
 
 def get_residuals(patcher, sceneDB, result_file):
 
     # --- get results from file ---
-    with h5py.File(result_file, "r") as disk:
-        active = disk["active"][:]
-        fixed = disk["fixed"][:]
-        chain = disk["chain"][:]
+    result = PatchResult(result_file)
+    active, fixed = result.active, result.fixed
+    chain = result.chain()
     config.seed_index = active["source_index"][0]
 
     # --- checkout region (parent operation) ---
@@ -97,12 +97,15 @@ if __name__ == "__main__":
     # --- files to get chains from ---
     result_list = glob.glob(os.path.expandvars(config.result_pattern))
 
-    for result_file in result_list:
-        print("working on ".format(result_file))
-        residuals, extra = get_residuals(patcher, sceneDB, result_file)
-        if residuals is None:
-            print("could not generate scene for {}".format(result_file))
-            continue
-        fn = result_file.replace(".h5", "_mosaic_residuals.h5")
-        dump_to_h5(fn, patcher, pixeldatadict=residuals,
-                   otherdatadict=extra)
+    # --- write outputs in the background while the next patch is built ---
+    with ResultWriter() as writer:
+        for result_file in result_list:
+            print("working on ".format(result_file))
+            residuals, extra = get_residuals(patcher, sceneDB, result_file)
+            if residuals is None:
+                print("could not generate scene for {}".format(result_file))
+                continue
+            fn = result_file.replace(".h5", "_mosaic_residuals.h5")
+            writer.submit(fn, patcher, pixeldatadict=residuals,
+                          otherdatadict=extra)
+    print("writer stats: {}".format(writer.stats()))
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sys, time
+import sys, time, socket
 import numpy as np
 import argparse
 import h5py
@@ -14,15 +14,18 @@ import theano.tensor as tt
 from forcepho.patches import JadesPatch
 from forcepho.proposal import Proposer
 from forcepho.model import GPUPosterior, LogLikeWithGrad
-from mc import prior_bounds
+from mc import prior_bounds, template_run, run_multichain
+from sampler import run_native
+from diagnostics import chain_diagnostics, flux_indices, source_diagnostics
 
 # parent side
-from catalog import rectify_catalog
+from catalog import rectify_catalog, cached_rectify_catalog
 from forcepho.dispatcher import SuperScene
 
 # Local
 #from catalog import rectify_catalog, catalog_to_scene, scene_to_catalog
 from utils import Logger, dump_to_h5
+from runstore import RunStore
 parser = argparse.ArgumentParser()
 theano.gof.compilelock.set_lock_status(False)
 
@@ -32,6 +35,9 @@ if __name__ == "__main__":
     from config import config
     parser.add_argument("--seed_index", type=int, default=0)
     parser.add_argument("--outfile", type=str, default="")
+    parser.add_argument("--run_store", type=str, default="")
+    parser.add_argument("--run_store_writer", type=str, default=socket.gethostname(),
+                        help="writer name for the run store; processes with the same name share shards")
     parser.add_argument("--logging", action="store_true")
     parser.add_argument("--show_progress", action="store_true")
     parser.add_argument("--rotate", action="store_true")
@@ -43,21 +49,28 @@ if __name__ == "__main__":
     cargs.update(vars(args))
     config = argparse.Namespace(**cargs)
 
+    handler = None
     if config.logging:
         import logging
         logging.basicConfig(level=logging.DEBUG)
-        logger = logging.getLogger(__name__)
-    else:
-        logger = Logger(__name__)
+        handler = logging.getLogger(__name__)
+    logger = Logger(__name__, handler=handler)
 
     logger.info("rotate is {}".format(config.rotate))
     logger.info("reverse is {}".format(config.reverse))
 
     # --- Build ingredients (parent and child sides) ---
     # sourcecat = rectify_catalog(config.initial_catalog, **ingest_kwargs)
-    sourcecat, bands, header = rectify_catalog(config.initial_catalog,
-                                               rotate=config.rotate,
-                                               reverse=config.reverse)
+    with logger.span("rectify_catalog"):
+        if config.catalog_cache_dir:
+            sourcecat, bands, header = cached_rectify_catalog(config.initial_catalog,
+                                                              cache_dir=config.catalog_cache_dir,
+                                                              rotate=config.rotate,
+                                                              reverse=config.reverse)
+        else:
+            sourcecat, bands, header = rectify_catalog(config.initial_catalog,
+                                                       rotate=config.rotate,
+                                                       reverse=config.reverse)
     sceneDB = SuperScene(sourcecat=sourcecat, bands=bands,
                          maxactive_per_patch=config.maxactive_per_patch)
     logger.info("Made SceneDB")
@@ -79,7 +92,8 @@ if __name__ == "__main__":
 
     # --- Build patch on CPU side (child operation) ---
     # Note this is the *fixed* source metadata
-    patcher.build_patch(region, fixed, allbands=config.bandlist)
+    with logger.span("build_patch"):
+        patcher.build_patch(region, fixed, allbands=config.bandlist)
     logger.info("built patch with {} fixed sources".format(len(fixed)))
     logger.info("Patch has {} pixels".format(len(patcher.data)))
     original = np.split(patcher.data, np.cumsum(patcher.exposure_N)[:-1])
@@ -89,24 +103,28 @@ if __name__ == "__main__":
     # --- Send patch to GPU (with fixed sources) ---
     patcher.return_residual = True
     logger.info("Sending to gpu....")
-    gpu_patch = patcher.send_to_gpu()
+    with logger.span("send_to_gpu"):
+        gpu_patch = patcher.send_to_gpu()
     logger.info("Initial Patch sent")
 
     # --- Evaluate (and subtract) fixed sources ---
     logger.info("Making proposer and sending fixed proposal")
     proposer = Proposer(patcher)
-    out = proposer.evaluate_proposal(prop_fixed)
-    fixed_residual = out[-1]
+    with logger.span("subtract_fixed"):
+        out = proposer.evaluate_proposal(prop_fixed)
+        fixed_residual = out[-1]
     logger.info("Fixed sources subtracted")
 
     # --- Build active patch ---
     logger.info("Replacing cpu metadata with active sources")
-    patcher.pack_meta(active)
+    with logger.span("pack_meta"):
+        patcher.pack_meta(active)
     p0 = patcher.scene.get_all_source_params().copy()
     logger.info("got active parameter vector")
 
     logger.info("Swapping fixed/active metadata and residual/data on GPU")
-    patcher.swap_on_gpu()
+    with logger.span("swap_on_gpu"):
+        patcher.swap_on_gpu()
 
     # --- Instantiate the ln-likelihood object ---
     # This object reformats the Proposer return and splits the lnlike_function
@@ -119,29 +137,60 @@ if __name__ == "__main__":
     logger.info("Initial lnp={}".format(lnp0))
     pnames = model.scene.parameter_names
 
-    model.proposer.patch.return_residuals = False
-    logl = LogLikeWithGrad(model)
-    logger.info("Built loglike object")
-
     # --- Run hmc (simple) ---
     logger.info("Begin sampling with {} warm and "
-                "{} iterations".format(config.n_warm, config.n_iter))
-
-    with pm.Model() as opmodel:
-        # set priors for each element of theta
-        z0, start = prior_bounds(model.scene)
-        logger.info("got priors")
-        theta = tt.as_tensor_variable(z0[0])
-        # instantiate target density and start sampling.
-        pm.DensityDist('likelihood', lambda v: logl(v), observed={'v': theta})
-        trace = pm.sample(draws=config.n_iter,
-                          tune=config.n_warm,
-                          start=start,
-                          compute_convergence_checks=False,
-                          cores=1, progressbar=config.show_progress,
-                          discard_tuned_samples=True)
+                "{} iterations".format(config.n_tune, config.n_iter))
+
+    with logger.span("sample") as sp:
+        if config.sampler == "native":
+            # no theano op or pymc3 model, so nothing to compile
+            result = run_native(model, n_iter=config.n_iter, n_warm=config.n_warm,
+                                n_tune=config.n_tune, n_start=config.n_start,
+                                tol=config.adapt_tol, seed=config.seed_index,
+                                target_ess=config.target_ess, max_iter=config.max_iter)
+            chain = result.chain
+            diagnostics = result.diagnostics
+        elif config.sampler == "multichain":
+            # chains in lockstep, one batched likelihood call per leapfrog step
+            result = run_multichain(model, nchain=config.n_chains, n_iter=config.n_iter,
+                                    n_warm=config.n_warm, n_tune=config.n_tune,
+                                    n_start=config.n_start, tol=config.adapt_tol,
+                                    target_ess=config.target_ess, max_iter=config.max_iter,
+                                    seed=config.seed_index)
+            if not result.batched:
+                logger.info("posterior has no evaluate_batch; chains evaluated in a loop")
+            chain = result.chain.reshape(-1, result.chain.shape[-1])
+            diagnostics = result.diagnostics
+        elif config.sampler == "template":
+            # compiled once per parameter dimension; pymc3 tunes for all of n_tune
+            trace, step = template_run(model, n_iter=config.n_iter, n_warm=config.n_tune,
+                                       progressbar=config.show_progress)
+            chain = trace.get_values("proposal")
+        else:
+            model.proposer.patch.return_residuals = False
+            logl = LogLikeWithGrad(model)
+            logger.info("Built loglike object")
+            with pm.Model() as opmodel:
+                # set priors for each element of theta
+                z0, start = prior_bounds(model.scene)
+                logger.info("got priors")
+                theta = tt.as_tensor_variable(z0[0])
+                # instantiate target density and start sampling.
+                pm.DensityDist('likelihood', lambda v: logl(v), observed={'v': theta})
+                trace = pm.sample(draws=config.n_iter,
+                                  tune=config.n_tune,
+                                  start=start,
+                                  compute_convergence_checks=False,
+                                  cores=1, progressbar=config.show_progress,
+                                  discard_tuned_samples=True)
+            chain = trace.get_values("proposal")
+        sp.count = model.ncall
     logger.info("Done sampling")
-    chain = trace.get_values("proposal")
+    if config.sampler not in ["native", "multichain"]:
+        diagnostics = chain_diagnostics(chain)
+    source_ess, source_rhat = source_diagnostics(diagnostics["ess"], diagnostics["rhat"],
+                                                 len(active), params=flux_indices(pnames))
+    logger.info("Minimum flux ESS is {}".format(source_ess.min()))
 
     # Failsafes
     from astropy.io import fits
@@ -153,26 +202,46 @@ if __name__ == "__main__":
     model.scene.set_all_source_params(chain[-1, :])
     prop_last = model.scene.get_proposal()
     model.proposer.patch.return_residuals = True
-    out = proposer.evaluate_proposal(prop_last)
+    with logger.span("evaluate_residuals"):
+        out = proposer.evaluate_proposal(prop_last)
 
     pixr = {"data": original,
             "fixed_residual": fixed_residual,
             "active_residual": out[-1],
             }
-    extra = {"active_chi2": out[0],
+    extra = {"patchid": config.seed_index,
+             "active_chi2": out[0],
              "active_grad": out[1],
              "ncall": model.ncall,
              "chain": chain,
              "reference_coordinates": patcher.patch_reference_coordinates,
-             "region": np.array([region.ra, region.dec, region.radius])
+             "region": np.array([region.ra, region.dec, region.radius]),
+             "timing": logger.span_table(),
+             "ess": diagnostics["ess"],
+             "rhat": diagnostics["rhat"],
+             "source_ess": source_ess,
+             "source_rhat": source_rhat,
              }
 
-    if config.outfile:
-        fn = config.outfile
-    else:
-        fn = "patch{}_ra{:6.4f}_dec{:6.4f}.h5".format("sample", region.ra, region.dec)
-    dump_to_h5(fn, proposer.patch, active, fixed,
-               pixeldatadict=pixr, otherdatadict=extra)
-    logger.info("wrote patch data to {}".format(fn))
+    # note the timing of the write itself is only in the log
+    with logger.span("dump_to_h5") as sp:
+        if config.run_store:
+            # append to the run-level store, using the seed as the patchid
+            with RunStore(config.run_store, writer=config.run_store_writer,
+                          layout=config.output_layout) as store:
+                store.append(config.seed_index, proposer.patch, region, active, fixed,
+                             pixeldatadict=pixr, otherdatadict=extra)
+            logger.info("wrote patch data to {}".format(config.run_store))
+        else:
+            if config.outfile:
+                fn = config.outfile
+            else:
+                fn = "patch{}_ra{:6.4f}_dec{:6.4f}.h5".format("sample", region.ra, region.dec)
+            dump_to_h5(fn, proposer.patch, active, fixed,
+                       pixeldatadict=pixr, otherdatadict=extra,
+                       layout=config.output_layout)
+            logger.info("wrote patch data to {}".format(fn))
+
+    logger.info("output written in {:.2f}s".format(sp.duration))
 
     logger.info("Done")
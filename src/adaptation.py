@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""adaptation.py
+
+Stan-style windowed adaptation of the HMC metric (inverse mass matrix).
+Warmup is split into windows of doubling length; at the end of each window
+the metric is re-estimated from the (transformed) samples of that window
+alone, with Stan's regularization.  Tuning stops early once the metric
+estimated from successive windows stops changing.
+
+This is independent of the sampler; it is used by `mc.run_pymc3` and by
+`sampler.Sampler`.
+"""
+
+from functools import lru_cache
+import numpy as np
+
+
+__all__ = ["window_schedule", "regularize_covariance", "metric_distance",
+           "distance_noise", "WelfordCovariance", "WindowedAdaptation"]
+
+
+def window_schedule(n_adapt, n_start=20):
+    """Lengths of the metric adaptation windows.  Windows double in length
+    starting from `n_start`; a window is extended to the end of the
+    adaptation phase if the next (doubled) window would not fit.
+
+    Parameters
+    ----------
+    n_adapt : int
+        Total number of metric adaptation iterations.
+
+    n_start : int, optional (default: 20)
+        Length of the first window.
+
+    Returns
+    -------
+    windows : ndarray of int
+    """
+    windows, size, remaining = [], int(n_start), int(n_adapt)
+    while remaining > 0:
+        if (remaining - size) < 2 * size:
+            windows.append(remaining)
+            break
+        windows.append(size)
+        remaining -= size
+        size *= 2
+    return np.array(windows, dtype=int)
+
+
+def regularize_covariance(cov, n, regular_window=5, regular_variance=1e-3):
+    """Stan's regularized covariance estimate, shrinking towards a small
+    multiple of the identity for small numbers of samples.
+
+    Parameters
+    ----------
+    cov : ndarray of shape (ndim,) or (ndim, ndim)
+        Sample variance (diagonal) or covariance.
+
+    n : int
+        Number of samples used to estimate `cov`.
+    """
+    cov = np.array(cov, dtype=np.float64) * n / (n + regular_window)
+    shrink = regular_variance * regular_window / (n + regular_window)
+    if cov.ndim == 1:
+        cov += shrink
+    else:
+        cov[np.diag_indices_from(cov)] += shrink
+    return cov
+
+
+def metric_distance(old, new):
+    """A scale-free measure of the difference between two metrics: the root
+    mean square of the log of the eigenvalues of old^{-1} new (or of the
+    ratios of the variances for diagonal metrics).  This is zero for
+    identical metrics and log(2) if every direction changed in variance by a
+    factor of two.
+    """
+    old, new = np.asarray(old), np.asarray(new)
+    if (old.ndim == 1) and (new.ndim == 1):
+        lam = new / old
+    else:
+        old = np.diag(old) if old.ndim == 1 else old
+        new = np.diag(new) if new.ndim == 1 else new
+        from scipy.linalg import eigh
+        try:
+            lam = eigh(new, old, eigvals_only=True)
+        except(np.linalg.LinAlgError):
+            return np.inf
+    return np.sqrt(np.mean(np.log(np.clip(lam, 1e-300, None))**2))
+
+
+def distance_noise(ndim, n, dense=True, n_new=None, nrep=8):
+    """Expected `metric_distance` between two metrics estimated from
+    independent sets of `n` and `n_new` (default `n`) samples from the same
+    distribution.
+
+    The distance is affine invariant, so this is computed (and cached) by
+    simulating unit normal samples.  For dense metrics the spread of the
+    eigenvalues of a sample covariance matrix depends strongly on n / ndim,
+    and the sample covariance is singular for n <= ndim, so no asymptotic
+    formula is used.
+    """
+    n_new = n if n_new is None else n_new
+    return _distance_noise(int(ndim), int(n), int(n_new), bool(dense), int(nrep))
+
+
+@lru_cache(maxsize=None)
+def _distance_noise(ndim, n, n_new, dense, nrep):
+    rng = np.random.default_rng(ndim * 1000003 + n)
+    d = np.zeros(nrep)
+    for i in range(nrep):
+        a, b = rng.standard_normal((n, ndim)), rng.standard_normal((n_new, ndim))
+        if dense:
+            d[i] = metric_distance(np.cov(a.T), np.cov(b.T))
+        else:
+            d[i] = metric_distance(a.var(axis=0, ddof=1), b.var(axis=0, ddof=1))
+    return d.mean()
+
+
+class WelfordCovariance:
+    """Online (Welford) estimate of the mean and (co)variance of a stream of
+    samples, using O(ndim^2) memory (O(ndim) for the diagonal) and a single
+    pass.
+
+    Parameters
+    ----------
+    ndim : int
+        Number of parameters.
+
+    dense : bool, optional (default: True)
+        Accumulate the full covariance; otherwise only the variances.
+    """
+
+    def __init__(self, ndim, dense=True):
+        self.ndim = ndim
+        self.dense = dense
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = np.zeros(self.ndim)
+        self.m2 = np.zeros((self.ndim, self.ndim) if self.dense else self.ndim)
+
+    def update(self, x):
+        """Add one sample of shape (ndim,)."""
+        x = np.asarray(x, dtype=np.float64)
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        if self.dense:
+            self.m2 += np.outer(delta, x - self.mean)
+        else:
+            self.m2 += delta * (x - self.mean)
+
+    def update_batch(self, samples):
+        """Add a block of samples of shape (n, ndim), combining moments with
+        the parallel algorithm of Chan et al.
+        """
+        samples = np.atleast_2d(np.asarray(samples, dtype=np.float64))
+        nb = len(samples)
+        if nb == 0:
+            return
+        mb = samples.mean(axis=0)
+        d = samples - mb
+        m2b = np.dot(d.T, d) if self.dense else (d**2).sum(axis=0)
+        n = self.n + nb
+        delta = mb - self.mean
+        self.mean += delta * nb / n
+        if self.dense:
+            self.m2 += m2b + np.outer(delta, delta) * self.n * nb / n
+        else:
+            self.m2 += m2b + delta**2 * self.n * nb / n
+        self.n = n
+
+    def covariance(self, regularize=False, regular_window=5, regular_variance=1e-3):
+        """The sample (co)variance, optionally with Stan's regularization."""
+        if self.n < 2:
+            raise ValueError("At least two samples are needed for a covariance")
+        cov = self.m2 / (self.n - 1)
+        if regularize:
+            cov = regularize_covariance(cov, self.n, regular_window=regular_window,
+                                        regular_variance=regular_variance)
+        return cov
+
+
+class WindowedAdaptation:
+    """Scheduler for windowed metric adaptation with an early exit.
+
+    Iterating over the scheduler yields the length of each window in turn;
+    the caller passes each (transformed) sample of the window to `add`, and
+    calls `update` at the end of the window.  Iteration stops at the end of
+    the schedule or as soon as the metric has converged.
+
+    Parameters
+    ----------
+    ndim : int
+        Number of parameters.
+
+    n_adapt : int
+        Maximum total number of metric adaptation iterations.
+
+    n_start : int, optional (default: 20)
+        Length of the first window.
+
+    dense : bool, optional (default: True)
+        Estimate a dense covariance; otherwise only the variances.
+
+    init_cov : ndarray, optional
+        Initial metric.  Defaults to the identity.
+
+    tol : float, optional (default: 1.5)
+        Tuning stops when the `metric_distance` between the metrics from two
+        successive windows is less than `tol` times the distance expected
+        from sampling noise alone (see `distance_noise`), i.e. when the
+        metric has stopped changing by more than its estimation noise.  Set
+        to zero to always run the full schedule.
+
+    min_windows : int, optional (default: 3)
+        Minimum number of windows before the convergence test is applied.
+
+    min_ratio : float, optional (default: 4)
+        For dense metrics the convergence test is only applied once the
+        earlier window has at least `min_ratio * ndim` samples; for shorter
+        windows the estimation noise is too large (and for fewer than `ndim`
+        samples the estimate is dominated by the regularization).
+
+    regular_window, regular_variance : optional
+        Parameters of `regularize_covariance`
+    """
+
+    def __init__(self, ndim, n_adapt, n_start=20, dense=True, init_cov=None,
+                 tol=1.5, min_windows=3, min_ratio=4, regular_window=5,
+                 regular_variance=1e-3):
+        self.ndim = ndim
+        self.dense = dense
+        self.windows = window_schedule(n_adapt, n_start=n_start)
+        self.tol = tol
+        self.min_windows = min_windows
+        self.min_ratio = min_ratio
+        self.regular_window = regular_window
+        self.regular_variance = regular_variance
+        if init_cov is None:
+            init_cov = np.eye(ndim) if dense else np.ones(ndim)
+        init_cov = np.array(init_cov, dtype=np.float64)
+        if dense and init_cov.ndim == 1:
+            init_cov = np.diag(init_cov)
+        elif (not dense) and init_cov.ndim == 2:
+            init_cov = np.diag(init_cov).copy()
+        self.cov = init_cov
+        self.n_windows = 0
+        self.n_used = 0
+        self.distances = []
+        self.converged = False
+        self.accumulator = WelfordCovariance(ndim, dense=dense)
+
+    def __iter__(self):
+        for w in self.windows:
+            if self.converged:
+                break
+            yield w
+
+    @property
+    def n_saved(self):
+        """Number of scheduled adaptation iterations that were skipped."""
+        return int(self.windows.sum()) - self.n_used
+
+    def add(self, z):
+        """Add a sample of the current window."""
+        self.accumulator.update(z)
+
+    def estimate(self, samples=None):
+        """Regularized (co)variance of a set of samples, or of the samples
+        added in the current window.
+        """
+        acc = self.accumulator
+        if samples is not None:
+            acc = WelfordCovariance(self.ndim, dense=self.dense)
+            acc.update_batch(samples)
+        return acc.covariance(regularize=True, regular_window=self.regular_window,
+                              regular_variance=self.regular_variance)
+
+    def update(self, samples=None, cov=None):
+        """Finish a window.  The new metric is estimated from `samples`, of
+        shape (n, ndim), if given, else from the samples passed to `add`, or
+        an already estimated (regularized) covariance can be given.
+
+        Returns
+        -------
+        cov : ndarray
+            The new metric.
+        """
+        if cov is None:
+            cov = self.estimate(samples)
+        self.accumulator.reset()
+        if self.n_windows > 0:
+            n = int(self.windows[self.n_windows - 1])
+            n_new = int(self.windows[self.n_windows])
+            if self.dense and (n < self.min_ratio * self.ndim):
+                # the noise is too large to detect real changes in the metric
+                d = np.nan
+            else:
+                d = (metric_distance(self.cov, cov) /
+                     distance_noise(self.ndim, n, self.dense, n_new=n_new))
+            self.distances.append(d)
+            if (self.n_windows + 1 >= self.min_windows) and (d < self.tol):
+                self.converged = True
+        self.cov = cov
+        self.n_used += int(self.windows[self.n_windows])
+        self.n_windows += 1
+        return self.cov
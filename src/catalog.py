@@ -8,10 +8,14 @@ Also defines the standard source catalog data type.
 """
 
 
+import os, json, hashlib
 import numpy as np
 
 
 __all__ = ["sourcecat_dtype", "rectify_catalog",
+           "empty_sourcecat", "rectify_block",
+           "cached_rectify_catalog", "catalog_cache_key",
+           "compact_sourcecat_dtype", "to_compact", "from_compact",
            "SHAPE_COLS", "FLUX_COL", "PAR_COLS"]
 
 
@@ -36,8 +40,111 @@ def sourcecat_dtype(source_type=np.float64, bands=None):
     return np.dtype(dt)
 
 
+# narrow integer types for the bookkeeping tags in the compact layout
+COMPACT_TAGS = [("id", np.int32), ("source_index", np.int32),
+                ("is_active", np.int8), ("is_valid", np.int8),
+                ("n_iter", np.int32), ("n_patch", np.int16)]
+
+
+def compact_sourcecat_dtype(bands=None):
+    """Get a numpy.dtype object for a compact version of the `sourcecat`
+    structured array, suitable for holding very large catalogs in memory or
+    for sending rows between processes.  Shapes and fluxes are float32, and the
+    celestial coordinates are stored as float32 offsets ("dra", "ddec", in
+    degrees) from a float64 reference position that is kept separately.  See
+    `to_compact` and `from_compact`.
+    """
+    dt = list(COMPACT_TAGS)
+    dt += [("dra", np.float32), ("ddec", np.float32)]
+    dt += [(c, np.float32) for c in SHAPE_COLS[2:]]
+    dt += [(c, np.float32) for c in bands]
+    return np.dtype(dt)
+
+
+def to_compact(sourcecat, reference=None):
+    """Convert a `sourcecat` array to the compact layout.
+
+    The tags and the float32 columns are converted exactly as long as the
+    values are representable.  The coordinate offsets are rounded to float32,
+    which for offsets less than 1 degree from the reference is an error of
+    less than 6e-8 degrees (0.2 mas).
+
+    Parameters
+    ----------
+    sourcecat : structured ndarray of shape (n_sources,)
+        Array with dtype given by `sourcecat_dtype`
+
+    reference : 2-element sequence of float, optional
+        The (ra, dec) reference position in degrees.  Defaults to the center
+        of the bounding box of the catalog.
+
+    Returns
+    -------
+    compact : structured ndarray of shape (n_sources,)
+        Array with dtype given by `compact_sourcecat_dtype`
+
+    reference : ndarray of shape (2,)
+        The float64 (ra, dec) reference position.
+    """
+    bands = [c for c in sourcecat.dtype.names
+             if c not in SHAPE_COLS + [t for t, _ in COMPACT_TAGS]]
+    if reference is None:
+        if len(sourcecat):
+            reference = [(sourcecat[c].min() + sourcecat[c].max()) / 2.
+                         for c in ["ra", "dec"]]
+        else:
+            reference = [0., 0.]
+    reference = np.array(reference, dtype=np.float64)
+
+    compact = np.zeros(len(sourcecat), dtype=compact_sourcecat_dtype(bands))
+    for t, dt in COMPACT_TAGS:
+        info = np.iinfo(dt)
+        v = sourcecat[t]
+        if len(v) and ((v.min() < info.min) or (v.max() > info.max)):
+            raise ValueError("Column {} does not fit in {}".format(t, info.dtype))
+        compact[t] = v
+    compact["dra"] = sourcecat["ra"] - reference[0]
+    compact["ddec"] = sourcecat["dec"] - reference[1]
+    for c in SHAPE_COLS[2:] + bands:
+        compact[c] = sourcecat[c]
+
+    return compact, reference
+
+
+def from_compact(compact, reference, source_type=np.float64):
+    """Convert an array in the compact layout back to the standard `sourcecat`
+    layout.  Round-tripping a compact array through `from_compact` and
+    `to_compact` (with the same reference) is lossless.
+
+    Parameters
+    ----------
+    compact : structured ndarray of shape (n_sources,)
+        Array with dtype given by `compact_sourcecat_dtype`
+
+    reference : 2-element sequence of float
+        The (ra, dec) reference position returned by `to_compact`
+
+    Returns
+    -------
+    sourcecat : structured ndarray of shape (n_sources,)
+        Array with dtype given by `sourcecat_dtype`
+    """
+    names = [t for t, _ in COMPACT_TAGS] + ["dra", "ddec"] + SHAPE_COLS[2:]
+    bands = [c for c in compact.dtype.names if c not in names]
+    sourcecat = np.zeros(len(compact),
+                         dtype=sourcecat_dtype(source_type=source_type, bands=bands))
+    for t, _ in COMPACT_TAGS:
+        sourcecat[t] = compact[t]
+    sourcecat["ra"] = compact["dra"].astype(np.float64) + reference[0]
+    sourcecat["dec"] = compact["ddec"].astype(np.float64) + reference[1]
+    for c in SHAPE_COLS[2:] + bands:
+        sourcecat[c] = compact[c]
+
+    return sourcecat
+
+
 def rectify_catalog(sourcecatfile, rhrange=(0.05, 0.25), qrange=(0.2, 0.99),
-                    rotate=False, reverse=True):
+                    rotate=False, reverse=True, chunksize=None, outfile=None):
     """Read the given catalog file and generate a `sourcecat` structured
     ndarray, which is an ndarray matched row-by-row but has all required
     columns.  Also forces parameters to be in valid ranges with valid formats
@@ -60,6 +167,16 @@ def rectify_catalog(sourcecatfile, rhrange=(0.05, 0.25), qrange=(0.2, 0.99),
     reverse : bool, optional, default=True
         Whether to reverse the direction of the PA (i.e. from CW to CCW)
 
+    chunksize : int, optional
+        If given, memory map the FITS table and rectify it in blocks of this
+        many rows, writing each block directly into the preallocated output.
+        The full input table is then never held in memory alongside the
+        output.
+
+    outfile : string, optional
+        If given, the output `sourcecat` is a memory-mapped `.npy` file at
+        this location instead of an in-memory array.
+
     Returns
     -------
     sourcecat : structured ndarray of shape (n_sources,)
@@ -70,32 +187,210 @@ def rectify_catalog(sourcecatfile, rhrange=(0.05, 0.25), qrange=(0.2, 0.99),
 
     """
     from astropy.io import fits
-    cat = fits.getdata(sourcecatfile)
-    header = fits.getheader(sourcecatfile)
-    bands = [b.upper().strip() for b in header["FILTERS"].split(",")]
+    with fits.open(sourcecatfile, memmap=True) as hdul:
+        header = hdul[0].header.copy()
+        bands = [b.upper().strip() for b in header["FILTERS"].split(",")]
+        cat = hdul[0].data
+        if cat is None:
+            cat = hdul[1].data
+
+        n_sources = len(cat)
+        if chunksize is None:
+            chunksize = max(n_sources, 1)
+        sourcecat = empty_sourcecat(n_sources, bands, outfile=outfile)
+        for lo in range(0, n_sources, chunksize):
+            hi = min(lo + chunksize, n_sources)
+            rectify_block(cat[lo:hi], sourcecat[lo:hi], bands,
+                          rhrange=rhrange, qrange=qrange,
+                          rotate=rotate, reverse=reverse)
+            sourcecat["source_index"][lo:hi] = np.arange(lo, hi)
+        del cat
+
+    if outfile is not None:
+        sourcecat.flush()
+
+    return sourcecat, bands, header
+
+
+def empty_sourcecat(n_sources, bands, outfile=None):
+    """Allocate a zeroed `sourcecat` structured array, optionally as a
+    memory-mapped `.npy` file.
+
+    Parameters
+    ----------
+    n_sources : int
+        Number of rows.
+
+    bands : list of strings
+        The band names, used to generate the dtype.
 
-    n_sources = len(cat)
+    outfile : string, optional
+        If given, the array is created as a memory-mapped `.npy` file at this
+        location.
+
+    Returns
+    -------
+    sourcecat : structured ndarray or numpy.memmap of shape (n_sources,)
+    """
     cat_dtype = sourcecat_dtype(bands=bands)
-    sourcecat = np.zeros(n_sources, dtype=cat_dtype)
-    sourcecat["source_index"][:] = np.arange(n_sources)
+    if outfile is None:
+        return np.zeros(n_sources, dtype=cat_dtype)
+    # open_memmap zero-fills the new file
+    sourcecat = np.lib.format.open_memmap(outfile, mode="w+", dtype=cat_dtype,
+                                          shape=(n_sources,))
+    return sourcecat
+
+
+def rectify_block(cat, sourcecat, bands, rhrange=(0.05, 0.25),
+                  qrange=(0.2, 0.99), rotate=False, reverse=True):
+    """Copy a block of rows from the input catalog into the matching block of
+    a `sourcecat` array (in place), rectifying the shape columns.  See
+    `rectify_catalog` for a description of the keywords.
+
+    Parameters
+    ----------
+    cat : structured ndarray or FITS_rec
+        A block of rows from the input catalog.
+
+    sourcecat : structured ndarray
+        A view of the output catalog rows corresponding to `cat`.
+
+    bands : list of strings
+        The band names, in the same order as the "flux" column of `cat`.
+    """
     for f in cat.dtype.names:
         if f in sourcecat.dtype.names:
             sourcecat[f][:] = cat[f][:]
 
+    flux = cat["flux"]
     for i, b in enumerate(bands):
-        sourcecat[b][:] = cat["flux"][:, i]
+        sourcecat[b][:] = flux[:, i]
 
     # --- Rectify shape columns ---
     sourcecat["sersic"] = 3.0  # middle of range
-    bad = ~np.isfinite(sourcecat["rhalf"])
-    sourcecat["rhalf"][bad] = rhrange[0]
-    sourcecat["rhalf"][:] = np.clip(sourcecat["rhalf"], *rhrange)
-    sourcecat["q"][:] = np.clip(sourcecat["q"], *qrange)
+    rhalf = sourcecat["rhalf"]
+    rhalf[~np.isfinite(rhalf)] = rhrange[0]
+    np.clip(rhalf, *rhrange, out=rhalf)
+    q = sourcecat["q"]
+    np.clip(q, *qrange, out=q)
     # rotate PA by +90 degrees but keep in the interval [-pi/2, pi/2]
+    pa = sourcecat["pa"]
     if rotate:
-        p = sourcecat["pa"] > 0
-        sourcecat["pa"] += np.pi / 2. - p * np.pi
+        p = pa > 0
+        pa += np.pi / 2. - p * np.pi
     if reverse:
-        sourcecat["pa"] *= -1.0
+        pa *= -1.0
+
+
+def _jsonify(kwargs):
+    return {k: np.array(v).tolist() for k, v in kwargs.items()}
+
+
+def catalog_cache_key(sourcecatfile, full_hash=False, blocksize=2**22, **rectify_kwargs):
+    """Generate a key identifying the rectified version of a catalog file.
+    This is a hash of the absolute path, size and modification time of the
+    file (or, optionally, of its full contents) and of the keyword arguments
+    that control the rectification.
+
+    Parameters
+    ----------
+    sourcecatfile : string
+        Path to the FITS binary table of the initialization catalog.
+
+    full_hash : bool, optional (default: False)
+        Hash the file contents instead of its path, size and modification
+        time.  This reads the whole file, but the key survives copying or
+        touching the file.
+
+    rectify_kwargs : optional
+        Keyword arguments to `rectify_catalog` that change the output.
+
+    Returns
+    -------
+    key : string
+        A hexadecimal digest.
+    """
+    digest = hashlib.sha1()
+    if full_hash:
+        with open(sourcecatfile, "rb") as f:
+            for block in iter(lambda: f.read(blocksize), b""):
+                digest.update(block)
+    else:
+        st = os.stat(sourcecatfile)
+        stat = [os.path.abspath(sourcecatfile), st.st_size, st.st_mtime_ns]
+        digest.update(json.dumps(stat).encode("utf-8"))
+    kw = json.dumps(_jsonify(rectify_kwargs), sort_keys=True)
+    digest.update(kw.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def cached_rectify_catalog(sourcecatfile, cache_dir=None, rhrange=(0.05, 0.25),
+                           qrange=(0.2, 0.99), rotate=False, reverse=True,
+                           chunksize=None, full_hash=False):
+    """Like `rectify_catalog`, but the rectified catalog is stored in a sidecar
+    cache (a `.npy` file and a JSON header) keyed on the input file (see
+    `catalog_cache_key`) and on the rectification arguments.  When a matching cache entry
+    exists it is memory-mapped instead of being rebuilt from the FITS file.
+
+    The returned array is mapped copy-on-write, so callers may modify it
+    without changing the cache.
+
+    Parameters
+    ----------
+    sourcecatfile : string
+        Path to the FITS binary table of the initialization catalog.
+
+    cache_dir : string, optional
+        Directory for the cache files.  Defaults to the directory containing
+        `sourcecatfile`.
+
+    full_hash : bool, optional (default: False)
+        Key the cache on the file contents rather than on its path, size and
+        modification time.
+
+    Returns
+    -------
+    sourcecat : numpy.memmap of shape (n_sources,)
+
+    bands : list of strings
+
+    header : astropy header object
+    """
+    from astropy.io import fits
+    rectify_kwargs = dict(rhrange=rhrange, qrange=qrange,
+                          rotate=rotate, reverse=reverse)
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(sourcecatfile))
+    key = catalog_cache_key(sourcecatfile, full_hash=full_hash, **rectify_kwargs)
+    base = os.path.join(cache_dir, "{}.{}".format(
+        os.path.basename(sourcecatfile).replace(".fits", ""), key[:16]))
+    catname, metaname = base + ".sourcecat.npy", base + ".sourcecat.json"
+
+    try:
+        with open(metaname, "r") as f:
+            meta = json.load(f)
+        assert meta["key"] == key
+        sourcecat = np.load(catname, mmap_mode="c")
+        header = fits.Header.fromstring(meta["header"])
+        return sourcecat, meta["bands"], header
+    except(IOError, OSError, ValueError, KeyError, AssertionError):
+        pass
+
+    # Build the cache.  Write to temporary names then rename, so that
+    # concurrent jobs never see a partial cache entry.  The JSON file is
+    # written last and marks the entry as complete.
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = ".tmp{}".format(os.getpid())
+    sourcecat, bands, header = rectify_catalog(sourcecatfile, chunksize=chunksize,
+                                               outfile=catname + tmp,
+                                               **rectify_kwargs)
+    del sourcecat
+    os.replace(catname + tmp, catname)
+    meta = dict(key=key, source=os.path.abspath(sourcecatfile), bands=bands,
+                header=header.tostring(), rectify_kwargs=_jsonify(rectify_kwargs))
+    with open(metaname + tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(metaname + tmp, metaname)
 
+    sourcecat = np.load(catname, mmap_mode="c")
     return sourcecat, bands, header
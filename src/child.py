@@ -9,13 +9,16 @@ from forcepho.proposal import Proposer
 from forcepho.model import GPUPosterior, LogLikeWithGrad
 from forcepho.fitting import Result
 from catalog import scene_to_catalog
+import mc
 from mc import prior_bounds
+from sampler import scene_bounds, BoundTransform
+from massmatrix import assemble, extract
 
 logger = logging.getLogger(__name__)
 
 
 def run_patch(patcher, region, fixedcat, activecat,
-              config, logger=logger):
+              config, massin=None, logger=logger):
 
     #isactive = sources["active"]
     #fixedcat = sources[~isactive]
@@ -65,13 +68,31 @@ def run_patch(patcher, region, fixedcat, activecat,
     lnp0 = model.lnprob(p0)
     logger.info("Initial lnp={}".format(lnp0))
 
+    # --- Initial metric from the per-source store ---
+    # stored blocks are in parameter space; map them to the transformed
+    # space of this patch's bounds at the starting position
+    sids = activecat["source_index"]
+    nparam = len(p0) // len(sids)
+    lower, upper, s0 = scene_bounds(patcher.scene)
+    transform = BoundTransform(lower, upper)
+    init_cov, known = assemble(massin, sids, nparam,
+                               jacobian=transform.jacobian(transform.to_unbounded(s0)))
+    n_warm, n_tune = None, None
+    if known.all():
+        # shorter warmup, but keep a short metric adaptation phase
+        n_warm, n_tune = config.n_warm_tuned, config.n_tune_tuned
+    logger.info("Stored metric for {} of {} sources".format(known.sum(), len(known)))
+
     # launch HMC
     tstart = time.time()
-    trace, step = run_pymc3(model, p0, config, init_mass=massin)
+    trace, step = run_pymc3(model, config, init_cov=init_cov, n_warm=n_warm, n_tune=n_tune)
     twall = time.time() - tstart
 
     # get things to save
     chain = trace.get_values("proposal")
+
+    # parameter space covariance to send back to the store
+    massout = extract(np.cov(chain, rowvar=False), sids, nparam, weight=len(chain))
     model.proposer.patch.return_residuals = True
     model.evaluate(chain[-1, :])
     active_residual = model._residuals
@@ -85,24 +106,17 @@ def run_patch(patcher, region, fixedcat, activecat,
     return cat, massout, fixed, niter
 
 
-def run_pymc3(model, config):
-    model.proposer.patch.return_residuals = False
-    logl = LogLikeWithGrad(model)
-    with pm.Model() as opmodel:
-        # set priors for each element of theta
-        z0, start = prior_bounds(model.scene)
-        theta = tt.as_tensor_variable(z0[0])
-        # instantiate target density and start sampling.
-        pm.DensityDist('likelihood', lambda v: logl(v), observed={'v': theta})
-        trace = pm.sample(draws=config.n_iter,
-                          tune=config.n_warm,
-                          start=start,
-                          compute_convergence_checks=False,
-                          cores=1, progressbar=config.show_progress,
-                          discard_tuned_samples=True)
-    return trace, None
-
-
+def run_pymc3(model, config, init_cov=None, n_warm=None, n_tune=None):
+    # reuses the compiled model for patches with the same number of
+    # parameters, with windowed metric adaptation up to n_tune iterations
+    n_warm = config.n_warm if n_warm is None else n_warm
+    n_tune = config.n_tune if n_tune is None else n_tune
+    trace, step = mc.run_pymc3(model, n_iter=config.n_iter, n_warm=n_warm,
+                               n_tune=n_tune, n_start=config.n_start,
+                               init_cov=init_cov, tol=config.adapt_tol,
+                               target_ess=config.target_ess, max_iter=config.max_iter,
+                               progressbar=config.show_progress)
+    return trace, step
 
 
 def make_result(region, patch, trace, ncall=-1, twall=0, config=None):
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""crossmatch.py
+
+Positional cross-matching of catalogs, built on the KD-tree index of
+`spatial.SourceIndex`.  All functions take celestial coordinates in degrees
+and return vectorized arrays of matched row indices.
+"""
+
+import numpy as np
+
+from spatial import SourceIndex, angle_to_chord, chord_to_angle
+
+
+__all__ = ["match_nearest", "match_within", "match_one_to_one"]
+
+
+def match_nearest(ra1, dec1, ra2, dec2, tolerance=np.inf, index=None):
+    """For each position in the first catalog find the nearest position in
+    the second catalog.
+
+    Parameters
+    ----------
+    ra1, dec1 : ndarrays of shape (n1,)
+        Positions in the first catalog.
+
+    ra2, dec2 : ndarrays of shape (n2,)
+        Positions in the second catalog.
+
+    tolerance : float, optional
+        Maximum separation in degrees for a match.
+
+    index : spatial.SourceIndex, optional
+        A prebuilt index of the second catalog.
+
+    Returns
+    -------
+    inds : ndarray of int, shape (n1,)
+        Row in the second catalog of the nearest match, or -1 if there is no
+        match within `tolerance`.
+
+    sep : ndarray of float, shape (n1,)
+        Separation in degrees (inf if there is no match)
+    """
+    if index is None:
+        index = SourceIndex(ra2, dec2)
+    inds, sep = index.nearest(ra1, dec1, k=1, max_radius=tolerance)
+    inds, sep = inds[:, 0], sep[:, 0]
+    inds[~np.isfinite(sep)] = -1
+    return inds, sep
+
+
+def match_within(ra1, dec1, ra2, dec2, radius):
+    """Find all pairs of positions in two catalogs that are within a given
+    separation of each other.
+
+    Returns
+    -------
+    i1 : ndarray of int
+        Rows in the first catalog.
+
+    i2 : ndarray of int
+        Rows in the second catalog.
+
+    sep : ndarray of float
+        Separation of each pair in degrees.  Pairs are sorted by `i1`, then
+        by separation.
+    """
+    t1 = SourceIndex(ra1, dec1).tree
+    t2 = SourceIndex(ra2, dec2).tree
+    pairs = t1.sparse_distance_matrix(t2, angle_to_chord(radius),
+                                      output_type="ndarray")
+    i1, i2 = pairs["i"].astype(int), pairs["j"].astype(int)
+    sep = chord_to_angle(pairs["v"])
+    order = np.lexsort((sep, i1))
+    return i1[order], i2[order], sep[order]
+
+
+def match_one_to_one(ra1, dec1, ra2, dec2, tolerance, max_rounds=10):
+    """Match two catalogs such that each row is matched to at most one row of
+    the other catalog.  Pairs that are mutual nearest neighbors are accepted
+    first; the remaining unmatched rows are then re-matched among themselves,
+    for up to `max_rounds` rounds.
+
+    Parameters
+    ----------
+    ra1, dec1 : ndarrays of shape (n1,)
+        Positions in the first catalog.
+
+    ra2, dec2 : ndarrays of shape (n2,)
+        Positions in the second catalog.
+
+    tolerance : float
+        Maximum separation in degrees for a match.
+
+    Returns
+    -------
+    i1 : ndarray of int
+        Matched rows in the first catalog, sorted.
+
+    i2 : ndarray of int
+        The corresponding rows in the second catalog.
+
+    sep : ndarray of float
+        Separations in degrees.
+    """
+    ra1, dec1 = np.asarray(ra1, dtype=np.float64), np.asarray(dec1, dtype=np.float64)
+    ra2, dec2 = np.asarray(ra2, dtype=np.float64), np.asarray(dec2, dtype=np.float64)
+    left1, left2 = np.arange(len(ra1)), np.arange(len(ra2))
+    out1, out2, outsep = [], [], []
+    for r in range(max_rounds):
+        if (len(left1) == 0) or (len(left2) == 0):
+            break
+        # nearest neighbors in both directions among the remaining rows
+        f, sep = match_nearest(ra1[left1], dec1[left1], ra2[left2], dec2[left2],
+                               tolerance=tolerance)
+        b, _ = match_nearest(ra2[left2], dec2[left2], ra1[left1], dec1[left1],
+                             tolerance=tolerance)
+        has = f >= 0
+        mutual = np.zeros(len(left1), dtype=bool)
+        mutual[has] = b[f[has]] == np.arange(len(left1))[has]
+        if not mutual.any():
+            break
+        out1.append(left1[mutual])
+        out2.append(left2[f[mutual]])
+        outsep.append(sep[mutual])
+        # only rows that had a candidate can still be matched
+        used2 = np.zeros(len(left2), dtype=bool)
+        used2[f[mutual]] = True
+        left1 = left1[has & ~mutual]
+        left2 = left2[~used2]
+
+    if len(out1) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    i1, i2, sep = np.concatenate(out1), np.concatenate(out2), np.concatenate(outsep)
+    order = np.argsort(i1)
+    return i1[order], i2[order], sep[order]
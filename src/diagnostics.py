@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""diagnostics.py
+
+Online convergence diagnostics for MCMC chains: batch-means effective sample
+size (ESS) and split R-hat, updated draw by draw with memory that does not
+grow with the chain length.
+
+Each chain is summarized by the mean and sum of squared deviations of
+consecutive batches of draws.  When the number of batches reaches
+`2 * max_batches` adjacent batches are merged and the batch size doubles, so
+the batch size grows with the chain length as the batch-means estimator
+requires.  Since any set of batches can be combined exactly, the same
+summaries give the variances of the two halves of each chain needed for
+split R-hat.
+"""
+
+import numpy as np
+
+
+__all__ = ["ChainMonitor", "chain_diagnostics", "flux_indices", "source_diagnostics"]
+
+
+def _combine(n1, mean1, m21, n2, mean2, m22):
+    """Combine the moments of two groups (Chan et al.)"""
+    n = n1 + n2
+    delta = mean2 - mean1
+    mean = mean1 + delta * n2 / n
+    m2 = m21 + m22 + delta**2 * n1 * n2 / n
+    return n, mean, m2
+
+
+class ChainMonitor:
+    """Online batch-means ESS and split R-hat for one or more chains.
+
+    Parameters
+    ----------
+    ndim : int
+        Number of parameters.
+
+    nchain : int, optional (default: 1)
+        Number of chains, advanced together.
+
+    batch_size : int, optional (default: 5)
+        Initial number of draws per batch.
+
+    max_batches : int, optional (default: 32)
+        Batches are merged pairwise when there are `2 * max_batches` of them.
+    """
+
+    def __init__(self, ndim, nchain=1, batch_size=5, max_batches=32):
+        self.ndim = ndim
+        self.nchain = nchain
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.n = 0
+        shape = (nchain, 2 * max_batches, ndim)
+        self._means = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+        self.nbatch = 0
+        self._reset_partial()
+
+    def _reset_partial(self):
+        self._pn = 0
+        self._pmean = np.zeros((self.nchain, self.ndim))
+        self._pm2 = np.zeros((self.nchain, self.ndim))
+
+    def update(self, x):
+        """Add one draw from each chain.
+
+        Parameters
+        ----------
+        x : ndarray of shape (nchain, ndim), or (ndim,) for a single chain
+        """
+        x = np.asarray(x, dtype=np.float64).reshape(self.nchain, self.ndim)
+        self.n += 1
+        self._pn += 1
+        delta = x - self._pmean
+        self._pmean += delta / self._pn
+        self._pm2 += delta * (x - self._pmean)
+        if self._pn == self.batch_size:
+            self._means[:, self.nbatch] = self._pmean
+            self._m2[:, self.nbatch] = self._pm2
+            self.nbatch += 1
+            self._reset_partial()
+            if self.nbatch == 2 * self.max_batches:
+                self._merge()
+
+    def _merge(self):
+        b = self.batch_size
+        _, mean, m2 = _combine(b, self._means[:, 0::2], self._m2[:, 0::2],
+                               b, self._means[:, 1::2], self._m2[:, 1::2])
+        self._means[:] = 0
+        self._m2[:] = 0
+        self._means[:, :self.max_batches] = mean
+        self._m2[:, :self.max_batches] = m2
+        self.nbatch = self.max_batches
+        self.batch_size = 2 * b
+
+    def _moments(self, lo, hi):
+        """Count, mean and m2 of each chain over batches lo:hi"""
+        nb = hi - lo
+        b = self.batch_size
+        means, m2 = self._means[:, lo:hi], self._m2[:, lo:hi]
+        mean = means.mean(axis=1)
+        m2 = m2.sum(axis=1) + b * ((means - mean[:, None, :])**2).sum(axis=1)
+        return nb * b, mean, m2
+
+    @property
+    def n_used(self):
+        """Number of draws per chain in completed batches."""
+        return self.nbatch * self.batch_size
+
+    def ess(self):
+        """Batch-means effective sample size of each parameter, summed over
+        chains.  Returns NaN until there are at least 4 complete batches.
+        """
+        if self.nbatch < 4:
+            return np.full(self.ndim, np.nan)
+        n, _, m2 = self._moments(0, self.nbatch)
+        var = m2 / (n - 1)
+        var_bm = self._means[:, :self.nbatch].var(axis=1, ddof=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ess = self.nbatch * var / var_bm
+        ess = np.where(var_bm > 0, np.minimum(ess, n), n)
+        return ess.sum(axis=0)
+
+    def rhat(self):
+        """Split R-hat of each parameter, splitting each chain into halves
+        of whole batches.  Returns NaN until there are at least 4 complete
+        batches.
+        """
+        if self.nbatch < 4:
+            return np.full(self.ndim, np.nan)
+        half = self.nbatch // 2
+        n1, mean1, m21 = self._moments(0, half)
+        n2, mean2, m22 = self._moments(self.nbatch - half, self.nbatch)
+        means = np.concatenate([mean1, mean2])
+        var = np.concatenate([m21, m22]) / (n1 - 1)
+        W = var.mean(axis=0)
+        B_n = means.var(axis=0, ddof=1)
+        var_plus = (n1 - 1) / n1 * W + B_n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rhat = np.sqrt(var_plus / W)
+        return np.where(W > 0, rhat, np.nan)
+
+    def converged(self, target_ess, params=None, max_rhat=None):
+        """Whether the ESS of the given parameters (default all) has reached
+        the target, and (optionally) their R-hat is below `max_rhat`.
+        """
+        params = slice(None) if params is None else params
+        ess = self.ess()[params]
+        if not np.all(ess >= target_ess):
+            return False
+        if max_rhat is not None:
+            return bool(np.all(self.rhat()[params] < max_rhat))
+        return True
+
+    def summary(self):
+        """Diagnostics to store with the patch output."""
+        return dict(ess=self.ess(), rhat=self.rhat(),
+                    n_draws=np.array(self.n * self.nchain))
+
+
+def chain_diagnostics(chain, **monitor_kwargs):
+    """Diagnostics for a complete chain of shape (n_draw, ndim), or
+    (nchain, n_draw, ndim), computed as for `ChainMonitor`.
+    """
+    chain = np.asarray(chain)
+    if chain.ndim == 2:
+        chain = chain[None]
+    monitor = ChainMonitor(chain.shape[-1], nchain=chain.shape[0], **monitor_kwargs)
+    for i in range(chain.shape[1]):
+        monitor.update(chain[:, i])
+    return monitor.summary()
+
+
+def flux_indices(parameter_names):
+    """Indices of the flux parameters in a scene parameter vector."""
+    return np.array([i for i, p in enumerate(parameter_names) if "F" in p],
+                    dtype=int)
+
+
+def source_diagnostics(ess, rhat, nsource, params=None):
+    """Reduce per-parameter diagnostics to per-source values: the smallest
+    ESS and largest R-hat of each source's parameters (or of the subset
+    `params`, e.g. from `flux_indices`)
+
+    Returns
+    -------
+    source_ess : ndarray of shape (nsource,)
+
+    source_rhat : ndarray of shape (nsource,)
+    """
+    nparam = len(ess) // nsource
+    sel = np.zeros(len(ess), dtype=bool)
+    sel[slice(None) if params is None else params] = True
+    sel = sel.reshape(nsource, nparam)
+    e = np.where(sel, np.reshape(ess, (nsource, nparam)), np.inf)
+    r = np.where(sel, np.reshape(rhat, (nsource, nparam)), -np.inf)
+    return e.min(axis=1), r.max(axis=1)
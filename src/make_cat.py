@@ -1,50 +1,251 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import glob, os, sys
+import glob, os, re, sys
+import warnings
+from functools import lru_cache
 import numpy as np
 
 import h5py
 from astropy.io import fits
 from astropy.wcs import WCS
 
+from patch_result import PatchResult
+from projection import get_projector
+
 
 SHAPE_COLS = ["ra", "dec", "q", "pa", "nsersic", "rhalf"]
+INDEX_COLS = ["id", "n_iter"]
+
+
+# Range and size of the interpolation grid for the aperture fraction.  This
+# covers sersic indices and rap/rhalf ratios well beyond those allowed by the
+# sampler.  With this grid the bilinear interpolation error is less than
+# 1e-4 (absolute, in the enclosed flux fraction) everywhere in the range.
+APER_GRID = dict(nsersic=(0.5, 8.0), n_nsersic=256,
+                 logratio=(-2.5, 2.5), n_logratio=1024)
+
+
+def _exact_aperture_fraction(nsersic, ratio):
+    from scipy.special import gammainc, gammaincinv
+    n = nsersic
+    # note gammaincinv is for the normalized gamma function, so...
+    b_n = gammaincinv(2 * n, 0.5)
+    x = b_n * ratio**(1./n)
+    return gammainc(2 * n, x)
+
+
+@lru_cache(maxsize=4)
+def aperture_fraction_grid(nsersic=APER_GRID["nsersic"], n_nsersic=APER_GRID["n_nsersic"],
+                           logratio=APER_GRID["logratio"], n_logratio=APER_GRID["n_logratio"]):
+    """Get the (cached) table of enclosed flux fraction on a regular grid of
+    sersic index and log10(rap/rhalf).
+
+    Returns
+    -------
+    ngrid : ndarray of shape (n_nsersic,)
+
+    lgrid : ndarray of shape (n_logratio,)
+
+    table : ndarray of shape (n_nsersic, n_logratio)
+    """
+    ngrid = np.linspace(*nsersic, n_nsersic)
+    lgrid = np.linspace(*logratio, n_logratio)
+    table = _exact_aperture_fraction(ngrid[:, None], 10**lgrid[None, :])
+    return ngrid, lgrid, table
 
 
-def fixed_aperture_fraction(nsersic, rhalf, rap):
+def fixed_aperture_fraction(nsersic, rhalf, rap, exact=True):
     """Compute the fraction of the flux that falls within a given radius of
     the source center for a _circularized_ shape.  The circularization means
     this is not the same as the fraction of flux of a galaxy that would fall
     within a circular aperture placed on the galaxy image (which depends on q as
     well)
 
+    With `exact=False` this is a bilinear interpolation in a precomputed
+    table (see `APER_GRID`), accurate to 1e-4; values outside the table are
+    computed exactly.  The interpolation is only about 5-8 times faster than
+    the exact evaluation, since the table lookups and temporary arrays cost
+    nearly as much as the incomplete gamma functions, so it is not the
+    default.
+
     Parameters
     ----------
-    nsersic : float
+    nsersic : float or ndarray
         The sersic index
 
-    rhalf : float
+    rhalf : float or ndarray
         The half-light radius
 
     rap : float
         The aperture radius, in the same units as `rhalf` (usually arcsec)
 
+    exact : bool, optional (default: True)
+        If True, evaluate the incomplete gamma functions directly.  If False,
+        interpolate in the table.
+
     Returns
     -------
-    frac : float
-        The fraction of the total light that is enclosed within `rap`
+    frac : float or ndarray
+        The fraction of the total light that is enclosed within `rap`.  This
+        is NaN where `nsersic` or `rhalf` is not finite and positive (e.g.
+        for padded chains, see `fit_chain_length`).
     """
-    from scipy.special import gammainc, gammaincinv
-    n = nsersic
-    # note gammaincinv is for the normalized gamma function, so...
-    b_n = gammaincinv(2 * n, 0.5)
-    x = b_n * (rap / rhalf)**(1./n)
-    frac = gammainc(2 * n, x)
+    nsersic, rhalf = np.broadcast_arrays(np.asarray(nsersic, dtype=np.float64),
+                                         np.asarray(rhalf, dtype=np.float64))
+    valid = np.isfinite(nsersic) & np.isfinite(rhalf) & (nsersic > 0) & (rhalf > 0)
+    if not np.all(valid):
+        frac = np.full(nsersic.shape, np.nan)
+        frac[valid] = fixed_aperture_fraction(nsersic[valid], rhalf[valid], rap, exact=exact)
+        return frac if frac.ndim else frac[()]
+
+    if exact:
+        return _exact_aperture_fraction(nsersic, rap / rhalf)
+
+    ngrid, lgrid, table = aperture_fraction_grid()
+    lratio = np.log10(rap / rhalf)
+
+    # fractional grid coordinates
+    fi = (nsersic - ngrid[0]) / (ngrid[1] - ngrid[0])
+    fj = (lratio - lgrid[0]) / (lgrid[1] - lgrid[0])
+    inside = ((fi >= 0) & (fi <= len(ngrid) - 1) &
+              (fj >= 0) & (fj <= len(lgrid) - 1))
+    i = np.clip(fi, 0, len(ngrid) - 2).astype(int)
+    j = np.clip(fj, 0, len(lgrid) - 2).astype(int)
+    u, v = fi - i, fj - j
+
+    frac = ((table[i, j] * (1 - u) + table[i + 1, j] * u) * (1 - v) +
+            (table[i, j + 1] * (1 - u) + table[i + 1, j + 1] * u) * v)
+
+    if not np.all(inside):
+        out = ~inside
+        frac[out] = _exact_aperture_fraction(nsersic[out], rap / rhalf[out])
+
     return frac
 
 
-def make_chaincat(filename, apertures=[]):
+class ChainCatalog:
+    """A chain catalog with lazily evaluated derived columns.  The base
+    catalog holds the sampled parameters for each source; derived columns
+    (aperture fluxes, colors, and pixel coordinates) are computed from it
+    when they are accessed and are not stored, unless `materialize` is called.
+    Aperture fractions, which are the same for every band, are computed
+    once per aperture and cached.
+
+    Parameters
+    ----------
+    base : structured ndarray of shape (n_source,)
+        The base catalog, with an "id" column and one (n_iter,) column for
+        each band and for each of `SHAPE_COLS`.  Catalogs read from the
+        output of `build_catalogs` also have an "n_iter" column (see
+        `fit_chain_length`).
+
+    bands : list of strings, optional
+        The band columns.  Defaults to all columns that are not "id",
+        "n_iter", or shape columns.
+
+    apertures : list of float, optional (default: [])
+        Aperture radii (in same units as rhalf) for the "{band}_aper{r}mas"
+        columns.  Note these are for "circularized" profiles
+
+    colors : list of 2-tuples of strings, optional (default: [])
+        Pairs of bands for the "color_{b1}_{b2}" columns, in magnitudes.
+
+    wcs : astropy.wcs.WCS, optional
+        If given, add "x" and "y" pixel coordinate columns.
+
+    aperture_grid : bool, optional (default: False)
+        Whether to interpolate the aperture fractions in a table instead of
+        computing them exactly (see `fixed_aperture_fraction`).
+    """
+
+    aper_fmt = "{}_aper{:.0f}mas"
+    color_fmt = "color_{}_{}"
+
+    def __init__(self, base, bands=None, apertures=[], colors=[], wcs=None,
+                 aperture_grid=False):
+        self.base = base
+        if bands is None:
+            bands = [c for c in base.dtype.names
+                     if c not in INDEX_COLS + SHAPE_COLS]
+        self.bands = list(bands)
+        self.apertures = list(apertures)
+        self.wcs = wcs
+        self.aperture_grid = aperture_grid
+        self._cache = {}
+
+        self.derived = {}
+        if wcs is not None:
+            self.derived["x"] = lambda: self._pixels()[0]
+            self.derived["y"] = lambda: self._pixels()[1]
+        for r in self.apertures:
+            for b in self.bands:
+                name = self.aper_fmt.format(b, r * 1000)
+                self.derived[name] = (lambda b=b, r=r: self.base[b] * self.aperture_fraction(r))
+        for b1, b2 in colors:
+            name = self.color_fmt.format(b1, b2)
+            self.derived[name] = (lambda b1=b1, b2=b2:
+                                  -2.5 * np.log10(self.base[b1] / self.base[b2]))
+
+    def __len__(self):
+        return len(self.base)
+
+    def __getitem__(self, name):
+        if name in self.derived:
+            return self.derived[name]()
+        return self.base[name]
+
+    @property
+    def colnames(self):
+        """Names of all base and derived columns, except "id" and "n_iter"."""
+        base = [c for c in self.base.dtype.names if c not in INDEX_COLS]
+        return base + list(self.derived.keys())
+
+    def aperture_fraction(self, rap):
+        """The (cached) fraction of the flux within aperture radius `rap`,
+        with shape (n_source, n_iter).
+        """
+        key = ("aper", rap)
+        if key not in self._cache:
+            self._cache[key] = fixed_aperture_fraction(self.base["nsersic"],
+                                                       self.base["rhalf"], rap,
+                                                       exact=not self.aperture_grid)
+        return self._cache[key]
+
+    def _pixels(self):
+        if "pixels" not in self._cache:
+            projector = get_projector(self.wcs)
+            self._cache["pixels"] = projector.project(self.base["ra"], self.base["dec"],
+                                                      ids=self.base["id"])
+        return self._cache["pixels"]
+
+    def materialize(self, names=None):
+        """Build a structured array holding the base columns and the requested
+        derived columns.
+
+        Parameters
+        ----------
+        names : list of strings, optional
+            Derived columns to include.  Defaults to all of them.
+
+        Returns
+        -------
+        cat : structured ndarray of shape (n_source,)
+        """
+        if names is None:
+            names = list(self.derived.keys())
+        n_iter = self.base[SHAPE_COLS[0]].shape[-1]
+        dtype = np.dtype(self.base.dtype.descr +
+                         [(c, np.float64, (n_iter,)) for c in names])
+        cat = np.zeros(len(self), dtype=dtype)
+        for c in self.base.dtype.names:
+            cat[c] = self.base[c]
+        for c in names:
+            cat[c] = self[c]
+        return cat
+
+
+def make_chaincat(filename, apertures=[], colors=[], wcs=None, aperture_grid=False):
     """Make a catalog from the chain.  This essentially names the columns in
     the `chain` dataset of the provided file and makes several transformations:
     * ra           -> ra + reference_ra
@@ -54,25 +255,37 @@ def make_chaincat(filename, apertures=[]):
 
     Parameters
     ----------
+    filename : string or h5py.Group
+       The patch output file, or an open group with the same layout (e.g. a
+       patch in a `runstore.RunStore`)
+
     apertures : list of float, optional (default: [])
        A list of aperture radii (in same units as rhalf).  Note these are for "circularized" profiles
-    """
-    with h5py.File(filename, "r") as disk:
-        chain = disk["chain"][:]
-        active = disk["active"][:]
-        try:
-            bands = disk["bandlist"][:]
-            ref = disk["reference_coordinates"][:]
-        except(KeyError):
-            bands = disk.attrs["bandlist"][:]
-            ref = disk.attrs["reference_coordinates"][:]
 
-    bands = [b.decode("utf-8") for b in bands]
+    colors : list of 2-tuples of strings, optional (default: [])
+       Pairs of bands for which to add color columns.
 
-    aper_fmt = "{}_aper{:.0f}mas"
-    aper_bands = []
-    for r in apertures:
-        aper_bands += [aper_fmt.format(b, r*1000) for b in bands]
+    wcs : astropy.wcs.WCS, optional
+       If given, add pixel coordinate columns.
+
+    aperture_grid : bool, optional (default: False)
+       Whether to interpolate the aperture fractions in a table (see
+       `fixed_aperture_fraction`).
+
+    Returns
+    -------
+    chaincat : ChainCatalog
+       The base catalog is in the `base` attribute.  Aperture fluxes, colors,
+       and pixel coordinates are derived columns that are only computed when
+       accessed; use `chaincat.materialize()` to get them all as a
+       structured array.
+    """
+    # each file is read once, so do not leave its handle in the cache
+    with PatchResult(filename) as result:
+        chain = result.chain()
+        active = result.active
+        bands = result.bandlist
+        ref = result.reference_coordinates
 
     # --- Get sizes of things ----
     n_iter, n_param = chain.shape
@@ -84,99 +297,554 @@ def make_chaincat(filename, apertures=[]):
 
     # --- generate dtype ---
     colnames = bands + SHAPE_COLS
-    cols = ([("id", np.int), ("x", np.float, (n_iter,)), ("y", np.float, (n_iter,))] +
-            [(c, np.float, (n_iter,)) for c in colnames + aper_bands])
+    cols = ([("id", np.int64)] +
+            [(c, np.float64, (n_iter,)) for c in colnames])
     dtype = np.dtype(cols)
 
     # --- make and fill catalog
+    # view the chain as (n_iter, n_source, n_param_per_source) without
+    # copying, then fill one column for all sources at once
     cat = np.zeros(n_source, dtype=dtype)
-    for s in range(n_source):
-        for j, col in enumerate(colnames):
-            cat[s][col] = chain[:, s * n_param_per_source + j]
+    chain = chain.reshape(n_iter, n_source, n_param_per_source)
+    for j, col in enumerate(colnames):
+        cat[col] = chain[:, :, j].T
 
-    # rectify parameters
+    # rectify parameters (in place)
     cat["ra"] += ref[0]
     cat["dec"] += ref[1]
-    cat["q"] = cat["q"]**2
-    cat["pa"] = -np.rad2deg(cat["pa"])
+    np.square(cat["q"], out=cat["q"])
+    np.rad2deg(cat["pa"], out=cat["pa"])
+    np.negative(cat["pa"], out=cat["pa"])
 
     cat["id"] = active["source_index"]
 
-    if wcs is not None:
-        
-        x, y = wcs.all_world2pix(cat["ra"], cat["dec"], 1)
-        cat["x"] = x
-        cat["y"] = y
-
-    # add aperture fluxes
-    # this is dumb because the fractions are the same in each band
-    # but it makes the logic for the summary catalog easier
-    for r in apertures:
-        frac = fixed_aperture_fraction(cat["nsersic"], cat["rhalf"], r)
-        for b in bands:
-            aper_name = aper_fmt.format(b, r*1000)
-            cat[aper_name] = cat[b] * frac
-
     # document units and number of iterations
     # units: image_units, degrees, degrees, b/a, degrees E of North, sersic index, arcsec
     # n_iter
-    return cat
+    return ChainCatalog(cat, bands=bands, apertures=apertures,
+                        colors=colors, wcs=wcs, aperture_grid=aperture_grid)
 
 
-def summary_cat(chaincat, estimate=np.mean, wcs=None):
+def summary_cat(chaincat, estimate=np.nanmean, wcs=None, percentiles=[]):
     """Return point estimates and uncertaites for all parameters in a given
-    chaincat
+    chaincat.  Each column is summarized for all sources at once, as a
+    vectorized operation on the (n_source, n_iter) block of samples.  The
+    median and any requested percentiles come from a single
+    `np.nanpercentile` call per column.  NaN samples (e.g. the padding of
+    chains stored by `build_catalogs`) are ignored.
 
     Parameters
     ----------
+    chaincat : ChainCatalog or structured ndarray
+        The chain catalog.  Derived columns of a `ChainCatalog` are computed
+        one at a time as they are summarized.
+
+    estimate : callable, optional (default: np.nanmean)
+        Function giving the point estimate.  It must accept an `axis`
+        keyword (e.g. np.nanmean or np.nanmedian)
+
     wcs : optional
         If given, use this WCS to convert celestial coordinates back into pixel coordinates.
+
+    percentiles : list of float, optional (default: [])
+        Percentiles of the samples to add as extra columns, named e.g.
+        "{col}_p16" for the 16th percentile.
+
+    Returns
+    -------
+    cat : structured ndarray of shape (n_source,)
+        Columns are the point estimate for each parameter, the standard
+        deviation in "{col}_unc", the median in "{col}_median", and any
+        requested percentiles.
     """
     efmt = "{}_unc"
+    mfmt = "{}_median"
+    pfmt = "{}_p{:g}"
 
-    colnames = list(chaincat.dtype.names)
-    _ = colnames.pop(colnames.index("id"))
+    try:
+        colnames = list(chaincat.colnames)
+    except(AttributeError):
+        colnames = [c for c in chaincat.dtype.names if c not in INDEX_COLS]
     allnames = colnames + [efmt.format(c) for c in colnames]
-    dtype = ([("id", np.int), ("patchid", np.int)] +
-             [(c, np.float) for c in allnames])
+    allnames += [mfmt.format(c) for c in colnames]
+    allnames += [pfmt.format(c, q) for c in colnames for q in percentiles]
+    dtype = ([("id", np.int64), ("patchid", np.int64)] +
+             [(c, np.float64) for c in allnames])
 
     cat = np.zeros(len(chaincat), dtype=dtype)
-    for i, row in enumerate(chaincat):
-        for j, c in enumerate(colnames):
-            cat[i][c] = estimate(row[c])
-            cat[i][efmt.format(c)] = np.std(row[c])
+    cat["id"] = chaincat["id"]
+    qlist = [50.] + list(percentiles)
+    for c in colnames:
+        block = chaincat[c]
+        # sources with no valid samples (e.g. bad shapes) give NaN
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            cat[c] = estimate(block, axis=-1)
+            cat[efmt.format(c)] = np.nanstd(block, axis=-1)
+            qs = np.nanpercentile(block, qlist, axis=-1)
+        cat[mfmt.format(c)] = qs[0]
+        for q, v in zip(percentiles, qs[1:]):
+            cat[pfmt.format(c, q)] = v
 
     return cat
 
 
-if __name__ == "__main__":
+def flux_covariance(F, correlation=False):
+    """Compute the covariance (or correlation) matrix of the fluxes for many
+    sources at once.
+
+    Parameters
+    ----------
+    F : ndarray of shape (nobj, nband, nsample)
+        Flux samples for each source and band (see e.g.
+        `compare_cats.flux_matrix`)
+
+    correlation : bool, optional (default: False)
+        If True, return the correlation matrix instead of the covariance.
+
+    Returns
+    -------
+    C : ndarray of shape (nobj, nband, nband)
+        Same as `[np.cov(f) for f in F]`
+    """
+    F = np.asarray(F, dtype=np.float64)
+    n_sample = F.shape[-1]
+    Fc = F - F.mean(axis=-1, keepdims=True)
+    C = np.einsum("ijk,ilk->ijl", Fc, Fc) / (n_sample - 1)
+    if correlation:
+        d = np.sqrt(np.einsum("ijj->ij", C))
+        C /= d[:, :, None] * d[:, None, :]
+    return C
+
+
+def chain_flux_covariance(catfile, outfile, bands=None, chunksize=4096,
+                          dataset="chains", dtype=np.float32):
+    """Compute flux covariance and correlation matrices for every source in
+    the chain catalog made by `build_catalogs`, reading the chains in blocks
+    of sources, and write them to an HDF5 file.
+
+    Parameters
+    ----------
+    catfile : string
+        HDF5 file with a chain catalog dataset.
+
+    outfile : string
+        Output HDF5 file.  It will have the datasets "id" (nobj,), and
+        "flux_cov" and "flux_corr" (nobj, nband, nband), and a "bands"
+        attribute.
+
+    bands : list of strings, optional
+        Bands to use.  Defaults to all band columns of the chain catalog.
+
+    chunksize : int, optional (default: 4096)
+        Number of sources to read at once.
+
+    dtype : optional (default: np.float32)
+        Data type of the stored matrices.
+    """
+    with h5py.File(catfile, "r") as disk, h5py.File(outfile, "w") as out:
+        dset = disk[dataset]
+        if bands is None:
+            bands = [c for c in dset.dtype.names if c not in INDEX_COLS + SHAPE_COLS]
+        nobj, nband = dset.shape[0], len(bands)
+        out.attrs["bands"] = np.array(bands, dtype="S")
+        ids = out.create_dataset("id", shape=(nobj,), dtype=dset.dtype["id"])
+        cov = out.create_dataset("flux_cov", shape=(nobj, nband, nband), dtype=dtype)
+        corr = out.create_dataset("flux_corr", shape=(nobj, nband, nband), dtype=dtype)
+        for lo in range(0, nobj, chunksize):
+            hi = min(lo + chunksize, nobj)
+            padded = "n_iter" in dset.dtype.names
+            rows = dset.fields(["id"] + ["n_iter"] * padded + bands)[lo:hi]
+            F = np.array([rows[b] for b in bands]).transpose(1, 0, 2)
+            if padded:
+                # use only the valid draws of each chain
+                C = np.zeros((hi - lo, nband, nband))
+                for n in np.unique(rows["n_iter"]):
+                    sel = rows["n_iter"] == n
+                    C[sel] = flux_covariance(F[sel, :, :n])
+            else:
+                C = flux_covariance(F)
+            d = np.sqrt(np.einsum("ijj->ij", C))
+            ids[lo:hi] = rows["id"]
+            cov[lo:hi] = C
+            corr[lo:hi] = C / (d[:, :, None] * d[:, None, :])
+
+
+def patchid_from_filename(filename):
+    """Get the patch id from an output filename like `test_sample_idx100.h5`,
+    or from a `runstore.RunStore` group name like `patch00000100`.  Returns
+    -1 for names without a patch id, like the default output names of
+    `test_sample.py` (e.g. `patchsample_ra53.1000_dec-27.8000.h5`).
+    """
+    name = os.path.basename(filename).replace(".h5", "")
+    m = re.search(r"idx(\d+)$", name) or re.match(r"patch(\d+)(_\d+)?$", name)
+    return int(m.group(1)) if m else -1
+
+
+def read_patchid(filename):
+    """Get the patch id of a patch output file or group, from its "patchid"
+    dataset if present and otherwise from its name (see
+    `patchid_from_filename`).
+    """
+    with PatchResult(filename) as result:
+        if "patchid" in result:
+            return int(result["patchid"])
+        disk = result.disk
+        name = disk.name if disk.name != "/" else disk.file.filename
+    return patchid_from_filename(name)
+
+
+def patch_catalogs(filename, apertures=[], percentiles=[], colors=[], wcs=None,
+                   aperture_grid=False):
+    """Make the chain catalog and the summary catalog for one patch output
+    file.
+
+    Returns
+    -------
+    chaincat : structured ndarray
+        The base chain catalog (see `make_chaincat`), without derived columns
+
+    summary : structured ndarray
+        See `summary_cat`.  Includes derived columns.  The "patchid" column
+        is filled by `read_patchid`.
+    """
+    chaincat = make_chaincat(filename, apertures=apertures, colors=colors, wcs=wcs,
+                             aperture_grid=aperture_grid)
+    summary = summary_cat(chaincat, percentiles=percentiles)
+    summary["patchid"] = read_patchid(filename)
+    return chaincat.base, summary
+
+
+def _patch_catalogs(args):
+    """Pool worker for `build_catalogs`.  Errors are returned, not raised, so
+    that one bad file does not stop the build.
+    """
+    filename, kwargs = args
+    try:
+        chaincat, summary = patch_catalogs(filename, **kwargs)
+        return filename, chaincat, summary, None
+    except(Exception) as e:
+        return filename, None, None, repr(e)
+
+
+def fit_chain_length(chaincat, n_iter):
+    """Bring the chains of a base chain catalog to a fixed number of draws,
+    so that patches sampled for different numbers of iterations can share
+    one dataset.  Shorter chains are padded with NaN, and longer chains are
+    thinned to `n_iter` evenly spaced draws.
+
+    Returns
+    -------
+    cat : structured ndarray
+        With the same columns as `chaincat`, each of shape (n_iter,), and an
+        "n_iter" column giving the number of valid (not padded) draws.
+    """
+    names = [c for c in chaincat.dtype.names if c not in INDEX_COLS]
+    n = chaincat[names[0]].shape[-1]
+    dtype = np.dtype([("id", chaincat.dtype["id"]), ("n_iter", np.int64)] +
+                     [(c, np.float64, (n_iter,)) for c in names])
+    cat = np.zeros(len(chaincat), dtype=dtype)
+    cat["id"] = chaincat["id"]
+    if n > n_iter:
+        draws, valid = np.round(np.linspace(0, n - 1, n_iter)).astype(int), n_iter
+    else:
+        draws, valid = slice(None), n
+    cat["n_iter"] = valid
+    for c in names:
+        cat[c][:, valid:] = np.nan
+        cat[c][:, :valid] = chaincat[c][:, draws]
+    return cat
 
-    wcs = None
-    imname = os.path.expandvars("$HOME/Projects/jades_force/data/2019-mini-challenge/mosaics/st/trimmed/F200W_bkgsub.fits")
-    wcs = WCS(fits.getheader(imname))
 
-    pdir = os.path.expandvars("$HOME/Projects/jades_force/cannon/output/")
-    search = os.path.join(pdir, "*[0-9].h5")
-    files = glob.glob(search)
-    patchid = [int(os.path.basename(f).split("idx")[-1].replace(".h5", ""))
-               for f in files]
+def _append_rows(out, name, rows):
+    """Append rows to a resizable 1-d dataset, creating it if necessary."""
+    if name not in out:
+        out.create_dataset(name, data=rows, maxshape=(None,), chunks=True)
+        return
+    dset = out[name]
+    if dset.dtype != rows.dtype:
+        raise ValueError("Rows for {} have dtype {}, "
+                         "expected {}".format(name, rows.dtype, dset.dtype))
+    n = dset.shape[0]
+    dset.resize((n + len(rows),))
+    dset[n:] = rows
 
-    chaincats = [make_chaincat(f, apertures=[0.10]) for f in files]
 
-    # get the source indicies of each row
-    inds = [chains["id"] for chains in chaincats]
-    order = np.argsort(np.concatenate(inds))
-    order = slice(None)
+# --- manifest of processed patch files ---
+MANIFEST_DTYPE = np.dtype([("filename", "S512"), ("size", np.int64),
+                           ("mtime", np.float64), ("hash", "S40"),
+                           ("patchid", np.int64), ("n_source", np.int64),
+                           ("source_start", np.int64)])
 
-    chaincat = np.concatenate(chaincats)[order]
-    fits.writeto("chains_mini-challenge-19_v0.fits", chaincat, overwrite=True)
 
-    summaries = []
-    for i, pid in enumerate(patchid):
-        summary = summary_cat(chaincats[i], wcs=wcs)
-        summary["patchid"] = pid
-        summary["id"] = chaincats[i]["id"]
-        summaries.append(summary)
+def file_stat(filename, use_hash=False):
+    """Get the size, modification time, and (optionally) the SHA1 hash of a
+    file, used to decide whether it has changed since it was processed.
+    """
+    st = os.stat(filename)
+    digest = ""
+    if use_hash:
+        import hashlib
+        h = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(2**22), b""):
+                h.update(block)
+        digest = h.hexdigest()
+    return st.st_size, st.st_mtime, digest
+
+
+def read_manifest(filename):
+    """Read the manifest of processed patch files from a catalog file made
+    by `build_catalogs`.
+
+    Returns
+    -------
+    manifest : structured ndarray
+        One row per processed patch file, with the file name, size,
+        modification time, hash (if computed), patchid, and the location of
+        its source ids in `sources`.
+
+    sources : ndarray of int
+        Concatenated source ids of all processed files.
+    """
+    with h5py.File(filename, "r") as disk:
+        return disk["manifest"][:], disk["manifest_sources"][:]
+
+
+def build_catalogs(files, outfile, apertures=[], percentiles=[],
+                   colors=[], wcs=None, nproc=None, progress_every=100, incremental=False,
+                   prune=False, use_hash=False, copy_block=2**16, chain_length=None,
+                   aperture_grid=False):
+    """Build the chain and summary catalogs for many patch output files in
+    parallel.  Files are processed by a pool of worker processes, and each
+    patch's rows are appended to the "chains" and "summary" datasets of an
+    HDF5 output file as soon as they are done, so memory use is independent
+    of the number of files.  Rows are in order of completion; use the "id"
+    and "patchid" columns to identify them.  All chains in the "chains"
+    dataset have the same length (see `fit_chain_length`), with the number
+    of valid draws for each source in its "n_iter" column.
+
+    A manifest of the processed files (see `read_manifest`) is stored in the
+    output, along with a "row_file" dataset giving the manifest entry of each
+    catalog row.  With `incremental`, only files that are new or have changed
+    since the existing output was built are processed; the rows of changed
+    files are replaced and all other rows are copied over.  The output is
+    written to a temporary file and moved into place when complete; the
+    temporary file is removed if the build fails.
+
+    Parameters
+    ----------
+    files : list of strings
+        The patch output files.
+
+    outfile : string
+        Name of the HDF5 file to write.
+
+    apertures, percentiles, colors, wcs : optional
+        Passed to `make_chaincat` and `summary_cat`.  The derived columns
+        only appear in the summary; the "chains" dataset holds the base chain
+        catalog, and the apertures and colors are stored as attributes so the
+        derived columns can be recreated with `ChainCatalog`.
+
+    nproc : int, optional
+        Number of worker processes.  Defaults to the number of cores.  If 1,
+        files are processed serially in this process.
+
+    progress_every : int, optional (default: 100)
+        Print progress after this many files.
+
+    incremental : bool, optional (default: False)
+        Whether to reuse the rows of unchanged files from an existing
+        `outfile`.  Ignored (i.e. a full build is done) if `outfile` does not
+        exist, was made with different apertures or percentiles, or has an
+        older layout.
+
+    prune : bool, optional (default: False)
+        If incremental, whether to drop rows for files that are in the
+        existing manifest but not in `files`.
+
+    use_hash : bool, optional (default: False)
+        Whether to also compare file hashes, not just size and modification
+        time, to detect changed files.
+
+    chain_length : int, optional
+        Number of draws stored for each source.  Defaults to the chain length
+        of the existing output (if incremental) or of the first processed
+        file.
+
+    aperture_grid : bool, optional (default: False)
+        Passed to `make_chaincat`.
+
+    Returns
+    -------
+    failed : list of (filename, error) tuples
+        Files that could not be processed.  These are not added to the
+        manifest, so they are retried by the next incremental build.
+    """
+    from multiprocessing import Pool
+    settings = dict(apertures=np.array(apertures, dtype=np.float64),
+                    percentiles=np.array(percentiles, dtype=np.float64),
+                    colors=np.array(colors, dtype="S"))
+
+    # --- find existing rows to keep ---
+    old, keep = None, np.zeros(0, dtype=int)
+    if incremental and os.path.exists(outfile):
+        with h5py.File(outfile, "r") as disk:
+            same = all([(k in disk.attrs) and np.array_equal(disk.attrs[k], v)
+                        for k, v in settings.items()])
+            same = (same and ("manifest" in disk) and ("chains" in disk) and
+                    ("n_iter" in disk["chains"].dtype.names) and
+                    ("ra_median" in disk["summary"].dtype.names))
+            if same:
+                old_length = disk["chains"].dtype[SHAPE_COLS[0]].shape[0]
+                same = chain_length in (None, old_length)
+            if same:
+                chain_length = old_length
+                old, old_sources = read_manifest(outfile)
+    stats = {f: file_stat(f, use_hash=use_hash) for f in files}
+    if old is not None:
+        oldnames = [n.decode("utf-8") for n in old["filename"]]
+        unchanged = []
+        for k, fn in enumerate(oldnames):
+            if fn in stats:
+                size, mtime, digest = stats[fn]
+                ok = ((old[k]["size"] == size) & (old[k]["mtime"] == mtime) &
+                      (old[k]["hash"].decode("utf-8") == digest))
+            else:
+                ok = not prune
+            if ok:
+                unchanged.append(k)
+        keep = np.array(unchanged, dtype=int)
+        done = set([oldnames[k] for k in keep])
+        files = [f for f in files if f not in done]
+
+    manifest, sources, nsource = [], [], [0]
+
+    def add_entry(row, srcs):
+        row = row.copy()
+        row["n_source"] = len(srcs)
+        row["source_start"] = nsource[0]
+        nsource[0] += len(srcs)
+        manifest.append(row)
+        sources.append(np.array(srcs, dtype=np.int64))
+        return len(manifest) - 1
+
+    kwargs = dict(apertures=apertures, percentiles=percentiles,
+                  colors=colors, wcs=wcs, aperture_grid=aperture_grid)
+    jobs = [(f, kwargs) for f in files]
+    failed = []
+    tmpfile = outfile + ".tmp"
+    try:
+        with h5py.File(tmpfile, "w") as out:
+            for k, v in settings.items():
+                out.attrs[k] = v
+
+            # --- copy rows of unchanged files in blocks ---
+            if len(keep):
+                remap = np.zeros(len(old), dtype=np.int64) - 1
+                for k in keep:
+                    lo, n = old[k]["source_start"], old[k]["n_source"]
+                    remap[k] = add_entry(old[k], old_sources[lo:lo + n])
+                with h5py.File(outfile, "r") as disk:
+                    row_file = disk["row_file"]
+                    for lo in range(0, len(row_file), copy_block):
+                        rf = row_file[lo:lo + copy_block]
+                        sel = remap[rf] >= 0
+                        if not sel.any():
+                            continue
+                        _append_rows(out, "chains", disk["chains"][lo:lo + copy_block][sel])
+                        _append_rows(out, "summary", disk["summary"][lo:lo + copy_block][sel])
+                        _append_rows(out, "row_file", remap[rf[sel]])
+                print("kept rows for {} unchanged files".format(len(keep)))
+
+            # --- process new and changed files ---
+            if nproc == 1:
+                pool = None
+                results = map(_patch_catalogs, jobs)
+            else:
+                nproc = nproc or os.cpu_count()
+                pool = Pool(nproc)
+                chunksize = max(1, min(16, len(jobs) // (4 * nproc)))
+                results = pool.imap_unordered(_patch_catalogs, jobs, chunksize=chunksize)
+            try:
+                for i, (fn, chaincat, summary, err) in enumerate(results):
+                    if err is not None:
+                        failed.append((fn, err))
+                    else:
+                        row = np.zeros(1, dtype=MANIFEST_DTYPE)[0]
+                        row["filename"] = fn
+                        row["size"], row["mtime"], row["hash"] = stats[fn]
+                        row["patchid"] = summary["patchid"][0] if len(summary) else -1
+                        k = add_entry(row, summary["id"])
+                        if chain_length is None:
+                            chain_length = chaincat[SHAPE_COLS[0]].shape[-1]
+                        _append_rows(out, "chains", fit_chain_length(chaincat, chain_length))
+                        _append_rows(out, "summary", summary)
+                        _append_rows(out, "row_file", np.zeros(len(summary), dtype=np.int64) + k)
+                    if progress_every and ((i + 1) % progress_every == 0):
+                        print("{} of {} files done, {} failed".format(i + 1, len(jobs), len(failed)))
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+            out.create_dataset("manifest", data=np.array(manifest, dtype=MANIFEST_DTYPE))
+            allsources = np.concatenate(sources) if len(sources) else np.zeros(0, dtype=np.int64)
+            out.create_dataset("manifest_sources", data=allsources)
+    except(BaseException):
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+    os.replace(tmpfile, outfile)
+    return failed
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--search", type=str,
+                        default="$HOME/Projects/jades_force/cannon/output/*[0-9].h5")
+    parser.add_argument("--outroot", type=str, default="mini-challenge-19_v0")
+    parser.add_argument("--nproc", type=int, default=None)
+    parser.add_argument("--apertures", type=float, nargs="*", default=[0.10])
+    parser.add_argument("--percentiles", type=float, nargs="*", default=[])
+    parser.add_argument("--aperture_grid", action="store_true",
+                        help="interpolate aperture fractions in a table instead of computing them exactly")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process new or changed files")
+    parser.add_argument("--prune", action="store_true",
+                        help="drop rows for files that no longer match the search")
+    parser.add_argument("--chain_length", type=int, default=None,
+                        help="number of draws stored per source; chains are padded or thinned to this")
+    parser.add_argument("--flux_covariance", action="store_true",
+                        help="also write the per-source flux covariance and correlation matrices")
+    parser.add_argument("--fits", action="store_true",
+                        help="also write the catalogs as FITS (loads the full chain catalog)")
+    args = parser.parse_args()
+
+    wcs = None
+    imname = os.path.expandvars("$HOME/Projects/jades_force/data/2019-mini-challenge/mosaics/st/trimmed/F200W_bkgsub.fits")
+    wcs = WCS(fits.getheader(imname))
 
-    summary = np.concatenate(summaries)[order]
-    fits.writeto("summary_mini-challenge-19_v0.fits", summary, overwrite=True)
+    files = glob.glob(os.path.expandvars(args.search))
+    outfile = "catalogs_{}.h5".format(args.outroot)
+    failed = build_catalogs(files, outfile, apertures=args.apertures,
+                            percentiles=args.percentiles, wcs=wcs, nproc=args.nproc,
+                            incremental=args.incremental, prune=args.prune,
+                            chain_length=args.chain_length, aperture_grid=args.aperture_grid)
+    for fn, err in failed:
+        print("failed on {}: {}".format(fn, err))
+
+    if args.flux_covariance:
+        chain_flux_covariance(outfile, "flux_cov_{}.h5".format(args.outroot))
+
+    with h5py.File(outfile, "r") as disk:
+        summary = disk["summary"][:]
+        fits.writeto("summary_{}.fits".format(args.outroot), summary, overwrite=True)
+        if args.fits:
+            chaincat = ChainCatalog(disk["chains"][:], apertures=args.apertures, wcs=wcs,
+                                    aperture_grid=args.aperture_grid)
+            fits.writeto("chains_{}.fits".format(args.outroot), chaincat.materialize(),
+                         overwrite=True)
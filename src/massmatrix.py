@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""massmatrix.py
+
+A store of tuned HMC metrics (inverse mass matrices) keyed by source index,
+so that a source revisited in a later patch starts sampling with a tuned
+metric and needs only a short warmup.
+
+The inverse metric for a patch is the covariance of the sampled parameters,
+which are ordered source by source with `nparam` parameters per source.  The
+sampler works in the logit space of uniform prior bounds that are re-centred
+on the scene for every patch, so blocks are stored in the (bounded) parameter
+space, where they do not depend on the bounds.  When a metric is assembled
+for a new patch the blocks are mapped to that patch's transformed space with
+the Jacobian dx/dz of its bounds at the starting position (see
+`sampler.BoundTransform.jacobian`).  This linearization is accurate as long
+as the posterior is narrow compared to the prior interval.  The store keeps
+
+    * one (nparam, nparam) diagonal block per source, and
+    * (nparam, nparam) cross-term blocks for pairs of sources that were
+      sampled together and were significantly correlated.
+
+When a patch is checked out the blocks for its active sources are shipped
+with the patch as a small `payload` dictionary; the child assembles them
+into a dense metric with `assemble()`, samples, and returns a payload built
+from the new covariance with `extract()`, which the parent merges back into
+the store with `checkin()`.
+
+Merge policy: diagonal blocks are averaged with weights given by the number
+of samples that went into each estimate, with the stored weight capped at
+`max_weight` so that newer estimates (e.g. after a neighbor was changed)
+are not swamped.  Cross terms are replaced by the newest estimate for the
+pair, and removed when the pair is sampled together again without a
+significant correlation.  Cross terms for pairs that are not both active in
+a later patch are kept but not used, and if the assembled matrix is not
+positive definite the cross terms are dropped.
+"""
+
+import os
+import numpy as np
+import h5py
+
+
+__all__ = ["MassMatrixStore", "assemble", "extract"]
+
+
+def assemble(payload, source_indices, nparam, default=None, jacobian=None):
+    """Build a dense inverse metric for a list of sources from a payload of
+    blocks.
+
+    Parameters
+    ----------
+    payload : dict or None
+        As returned by `MassMatrixStore.checkout()`.
+
+    source_indices : sequence of int
+        The active sources, in the order of the parameter vector.
+
+    nparam : int
+        Number of parameters per source.
+
+    default : ndarray of shape (nparam,) or (nparam, nparam), optional
+        Block to use for sources without a stored block, in the sampled
+        space.  Defaults to the identity.
+
+    jacobian : ndarray of shape (nsource * nparam,), optional
+        The derivatives dx/dz of the parameters with respect to the sampled
+        (transformed) parameters at the starting position.  If given, the
+        stored parameter space blocks are converted to the sampled space.
+
+    Returns
+    -------
+    inv_metric : ndarray of shape (nsource * nparam, nsource * nparam)
+
+    known : ndarray of bool, shape (nsource,)
+        Whether a stored block was used for each source.
+    """
+    sids = np.atleast_1d(source_indices).tolist()
+    nsource = len(sids)
+    if default is None:
+        default = np.eye(nparam)
+    default = np.diag(default) if np.ndim(default) == 1 else np.asarray(default)
+
+    inv_metric = np.zeros((nsource * nparam, nsource * nparam))
+    known = np.zeros(nsource, dtype=bool)
+    slc = [slice(i * nparam, (i + 1) * nparam) for i in range(nsource)]
+    pos = {s: i for i, s in enumerate(sids)}
+
+    if jacobian is None:
+        jacobian = np.ones(nsource * nparam)
+    dzdx = 1.0 / np.reshape(jacobian, (nsource, nparam))
+
+    blocks = {} if payload is None else dict(zip(payload["source_index"].tolist(),
+                                                 payload["blocks"]))
+    for i, s in enumerate(sids):
+        if s in blocks:
+            inv_metric[slc[i], slc[i]] = blocks[s] * np.outer(dzdx[i], dzdx[i])
+            known[i] = True
+        else:
+            inv_metric[slc[i], slc[i]] = default
+    if payload is None or len(payload["pairs"]) == 0:
+        return inv_metric, known
+
+    diagonal = inv_metric.copy()
+    for (a, b), cross in zip(payload["pairs"].tolist(), payload["cross"]):
+        if (a in pos) and (b in pos):
+            i, j = pos[a], pos[b]
+            cross = cross * np.outer(dzdx[i], dzdx[j])
+            inv_metric[slc[i], slc[j]] = cross
+            inv_metric[slc[j], slc[i]] = cross.T
+    try:
+        np.linalg.cholesky(inv_metric)
+    except(np.linalg.LinAlgError):
+        # blocks estimated in different patches may not be consistent
+        return diagonal, known
+    return inv_metric, known
+
+
+def extract(cov, source_indices, nparam, weight=1, min_corr=0.1):
+    """Split a patch covariance matrix into a payload of per-source blocks
+    and significant cross terms.
+
+    Parameters
+    ----------
+    cov : ndarray of shape (nsource * nparam, nsource * nparam) or (nsource * nparam,)
+        The covariance of the parameters, in the (bounded) parameter space,
+        e.g. of the chain.  A 1-d array is taken to be the diagonal.
+
+    weight : int, optional
+        Number of samples used to estimate `cov`.
+
+    min_corr : float, optional (default: 0.1)
+        Cross terms are kept for a pair of sources only if the absolute
+        correlation coefficient of some pair of their parameters exceeds
+        this value.
+
+    Returns
+    -------
+    payload : dict
+    """
+    sids = np.atleast_1d(source_indices).astype(np.int64)
+    nsource = len(sids)
+    cov = np.asarray(cov, dtype=np.float64)
+    if cov.ndim == 1:
+        cov = np.diag(cov)
+    c4 = cov.reshape(nsource, nparam, nsource, nparam).transpose(0, 2, 1, 3)
+    blocks = c4[np.arange(nsource), np.arange(nsource)].copy()
+
+    sd = np.sqrt(np.diag(cov)).reshape(nsource, nparam)
+    ii, jj = np.triu_indices(nsource, k=1)
+    corr = c4[ii, jj] / (sd[ii, :, None] * sd[jj, None, :])
+    strong = np.abs(corr).max(axis=(-2, -1)) > min_corr if len(ii) else np.zeros(0, dtype=bool)
+
+    # canonical order (smaller source index first) for the pair keys
+    a, b = sids[ii], sids[jj]
+    cross = c4[ii, jj]
+    flip = a > b
+    cross[flip] = cross[flip].transpose(0, 2, 1)
+    pairs = np.array([np.minimum(a, b), np.maximum(a, b)]).T.reshape(-1, 2)
+
+    return dict(source_index=sids, blocks=blocks,
+                weight=np.zeros(nsource, dtype=np.int64) + int(weight),
+                pairs=pairs[strong], cross=cross[strong],
+                weak_pairs=pairs[~strong])
+
+
+class MassMatrixStore:
+    """Per-source store of inverse metric blocks.
+
+    Parameters
+    ----------
+    nparam : int
+        Number of parameters per source (e.g. nband + 6).
+
+    filename : string, optional
+        HDF5 file to load from (if it exists) and to save to.
+
+    max_weight : int, optional (default: 1000)
+        Cap on the accumulated weight of a stored block when merging.
+    """
+
+    def __init__(self, nparam, filename=None, max_weight=1000):
+        self.nparam = nparam
+        self.filename = filename
+        self.max_weight = max_weight
+        self.blocks = {}
+        self.weights = {}
+        self.cross = {}
+        if filename and os.path.exists(filename):
+            self.load(filename)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, source_index):
+        return int(source_index) in self.blocks
+
+    def known(self, source_indices):
+        """Boolean array of whether each source has a stored block."""
+        return np.array([int(s) in self.blocks
+                         for s in np.atleast_1d(source_indices)], dtype=bool)
+
+    def checkout(self, source_indices):
+        """Make a payload with the stored blocks and cross terms for a set of
+        sources, to be sent along with a patch.  Returns None if none of the
+        sources have stored blocks.
+        """
+        sids = [int(s) for s in np.atleast_1d(source_indices)]
+        have = [s for s in sids if s in self.blocks]
+        if len(have) == 0:
+            return None
+        members = set(have)
+        pairs = [p for p in self.cross if (p[0] in members) and (p[1] in members)]
+        p = self.nparam
+        return dict(source_index=np.array(have, dtype=np.int64),
+                    blocks=np.array([self.blocks[s] for s in have]),
+                    weight=np.array([self.weights[s] for s in have], dtype=np.int64),
+                    pairs=np.array(pairs, dtype=np.int64).reshape(-1, 2),
+                    cross=np.array([self.cross[k] for k in pairs]).reshape(-1, p, p))
+
+    def checkin(self, payload):
+        """Merge a payload returned from a patch (see `extract`) into the
+        store.
+        """
+        if payload is None:
+            return
+        for s, block, w in zip(payload["source_index"].tolist(),
+                               payload["blocks"], payload["weight"].tolist()):
+            if s in self.blocks:
+                w0 = min(self.weights[s], self.max_weight)
+                self.blocks[s] = (w0 * self.blocks[s] + w * block) / (w0 + w)
+                self.weights[s] = min(w0 + w, self.max_weight)
+            else:
+                self.blocks[s] = np.array(block)
+                self.weights[s] = w
+        for k in payload.get("weak_pairs", np.zeros((0, 2))).tolist():
+            self.cross.pop(tuple(k), None)
+        for k, cross in zip(payload["pairs"].tolist(), payload["cross"]):
+            self.cross[tuple(k)] = np.array(cross)
+
+    # --- Persistence ---
+
+    def save(self, filename=None):
+        """Write the store to an HDF5 file, atomically."""
+        filename = filename or self.filename
+        sids = np.array(sorted(self.blocks), dtype=np.int64)
+        pairs = sorted(self.cross)
+        p = self.nparam
+        tmpfile = filename + ".tmp"
+        with h5py.File(tmpfile, "w") as out:
+            out.attrs["nparam"] = p
+            out.attrs["max_weight"] = self.max_weight
+            out.attrs["space"] = "parameter"
+            out.create_dataset("source_index", data=sids)
+            out.create_dataset("blocks", data=np.array([self.blocks[s] for s in sids]).reshape(-1, p, p))
+            out.create_dataset("weight", data=np.array([self.weights[s] for s in sids], dtype=np.int64))
+            out.create_dataset("pairs", data=np.array(pairs, dtype=np.int64).reshape(-1, 2))
+            out.create_dataset("cross", data=np.array([self.cross[k] for k in pairs]).reshape(-1, p, p))
+        os.replace(tmpfile, filename)
+
+    def load(self, filename):
+        """Read (and merge) a store written by `save`."""
+        with h5py.File(filename, "r") as disk:
+            if int(disk.attrs["nparam"]) != self.nparam:
+                raise ValueError("{} has {} parameters per source, not {}".format(
+                                 filename, disk.attrs["nparam"], self.nparam))
+            space = disk.attrs.get("space", b"")
+            if isinstance(space, bytes):
+                space = space.decode("utf-8")
+            if space != "parameter":
+                raise ValueError("{} holds blocks in the transformed space of "
+                                 "old patch bounds; start a new store".format(filename))
+            payload = {k: disk[k][:] for k in ["source_index", "blocks", "weight",
+                                               "pairs", "cross"]}
+        self.checkin(payload)
@@ -4,12 +4,18 @@
 """mc.py - mthods for hmc with pymc3.  This should (almost) all go in the forcepho.fitting module
 """
 
+from argparse import Namespace
 import numpy as np
 from forcepho.model import LogLikeWithGrad
+from sampler import (scene_bounds, Sampler, sample_lockstep,
+                     model_lnprob_and_grad, model_lnprob_and_grad_batch)
+from adaptation import WindowedAdaptation, WelfordCovariance
+from diagnostics import ChainMonitor, chain_diagnostics, flux_indices
 
 import theano
 import pymc3 as pm
-from pymc3.step_methods.hmc.quadpotential import QuadPotentialFull
+from pymc3.step_methods.hmc.quadpotential import QuadPotentialFull, QuadPotentialDiag
+from pymc3.step_methods.hmc.integration import CpuLeapfrogIntegrator
 import theano.tensor as tt
 theano.gof.compilelock.set_lock_status(False)
 
@@ -45,36 +51,141 @@ def prior_bounds(scene, pos_prior=0.1/3600., flux_factor=5,
         A dictionary keyed by `parname` that gives the starting value for the
         parameter.
     """
-    pnames = scene.parameter_names
-
-    rh_range = np.array(scene.sources[0].rh_range)
-    sersic_range = np.array(scene.sources[0].sersic_range)
-    lower = [s.nband * [0.] +
-             [s.ra - pos_prior, s.dec - pos_prior,
-              0.3, -np.pi/1.5, sersic_range[0], rh_range[0]]
-             for s in scene.sources]
-    upper = [(np.clip(np.array(s.flux) * flux_factor, flux_lim, max_flux)).tolist() +
-             [s.ra + pos_prior, s.dec + pos_prior,
-              1.0, np.pi/1.5, sersic_range[-1], rh_range[-1]]
-             for s in scene.sources]
-    lower = np.concatenate(lower)
-    upper = np.concatenate(upper)
+    lower, upper, s0 = scene_bounds(scene, pos_prior=pos_prior, flux_factor=flux_factor,
+                                    flux_lim=flux_lim, max_flux=max_flux)
     #z0 = [pm.Uniform(p, lower=l, upper=u) 
     #      for p, l, u in zip(pnames, lower, upper)]
     z0 = [pm.Uniform(parname, lower=lower, upper=upper, shape=lower.shape)]
-    s0 = scene.get_all_source_params().copy()
-    # replace parameters at lower bound
-    # HACK
-    for i, p in enumerate(pnames):
-        if ("F" in p):
-            if s0[i] <= lower[i]:
-                s0[i] = 0.5 * (upper[i] + lower[i])
 
     start = {parname: s0}
 
     return z0, start
 
 
+class _ModelProxy:
+    """Forward attribute access to a posterior object that can be swapped, so
+    that a compiled theano op can be reused for a new patch.
+    """
+
+    def __init__(self, target=None):
+        self.target = target
+
+    def __getattr__(self, name):
+        target = self.__dict__.get("target")
+        if target is None:
+            raise AttributeError(name)
+        return getattr(target, name)
+
+
+class ModelTemplate:
+    """A pymc3 model for a parameter vector of fixed dimension, with the
+    uniform prior bounds held in theano shared variables.  The graph, and the
+    NUTS step functions, are compiled once and then reused for every patch
+    with the same number of parameters by updating the shared variables and
+    swapping the posterior object.
+
+    Parameters
+    ----------
+    ndim : int
+        Number of parameters.
+
+    parname : string, optional (default: "proposal")
+        The name of the parameter vector.
+    """
+
+    def __init__(self, ndim, parname="proposal"):
+        self.ndim = ndim
+        self.parname = parname
+        self.proxy = _ModelProxy()
+        self.logl = LogLikeWithGrad(self.proxy)
+        self.lower = theano.shared(np.zeros(ndim), name="lower")
+        self.upper = theano.shared(np.ones(ndim), name="upper")
+        self.start = theano.shared(np.zeros(ndim) + 0.5, name="start")
+        with pm.Model() as self.model:
+            z0 = pm.Uniform(parname, lower=self.lower, upper=self.upper, shape=(ndim,))
+            theta = tt.as_tensor_variable(z0)
+            pm.DensityDist('likelihood', lambda v: self.logl(v), observed={'v': theta})
+        self._step = None
+
+    def update(self, model, lower, upper, start):
+        """Point the template at a new posterior object and prior bounds."""
+        assert len(lower) == self.ndim
+        model.proposer.patch.return_residuals = False
+        self.proxy.target = model
+        self.lower.set_value(np.asarray(lower, dtype=np.float64))
+        self.upper.set_value(np.asarray(upper, dtype=np.float64))
+        self.start.set_value(np.asarray(start, dtype=np.float64))
+
+    def update_scene(self, model, **bounds_kwargs):
+        """Update from the scene of a posterior object, using the same bounds
+        as `prior_bounds`
+        """
+        lower, upper, s0 = scene_bounds(model.scene, **bounds_kwargs)
+        self.update(model, lower, upper, s0)
+
+    def step(self, potential=None, **nuts_kwargs):
+        """Get the NUTS step for this model, compiling it only the first time.
+        Tuning is reset, and the potential replaced if one is given.
+        """
+        if self._step is None:
+            with self.model:
+                self._step = pm.NUTS(potential=potential, **nuts_kwargs)
+        else:
+            if potential is not None:
+                # the integrator keeps its own reference to the potential
+                self._step.potential = potential
+                self._step.integrator = CpuLeapfrogIntegrator(
+                    potential, self._step._logp_dlogp_func)
+            self._step.reset_tuning()
+        return self._step
+
+    def sample(self, draws, tune, step=None, start=None, **sample_kwargs):
+        """Sample the current posterior, starting from the current start
+        unless a `start` point is given.
+        """
+        if step is None:
+            step = self.step()
+        if start is None:
+            start = {self.parname: self.start.get_value()}
+        kwargs = dict(compute_convergence_checks=False, cores=1, chains=1,
+                      progressbar=False, discard_tuned_samples=True)
+        kwargs.update(sample_kwargs)
+        with self.model:
+            trace = pm.sample(draws=draws, tune=tune, step=step, start=start,
+                              **kwargs)
+        return trace
+
+
+_templates = {}
+
+
+def get_template(ndim, parname="proposal"):
+    """Get the (cached) `ModelTemplate` for a given number of parameters."""
+    key = (ndim, parname)
+    if key not in _templates:
+        _templates[key] = ModelTemplate(ndim, parname=parname)
+    return _templates[key]
+
+
+def template_run(model, n_iter=50, n_warm=100, potential=None,
+                 bounds_kwargs={}, **sample_kwargs):
+    """Sample a posterior using the cached model template for its dimension,
+    with the priors of `prior_bounds`.
+
+    Returns
+    -------
+    trace : pymc3.MultiTrace
+
+    step : pymc3.NUTS
+    """
+    lower, upper, s0 = scene_bounds(model.scene, **bounds_kwargs)
+    template = get_template(len(lower))
+    template.update(model, lower, upper, s0)
+    step = template.step(potential=potential)
+    trace = template.sample(n_iter, n_warm, step=step, **sample_kwargs)
+    return trace, step
+
+
 def simple_run(model, p0, n_iter=50, n_warm=100, prior_bounds=None):
 
     # -- Launch HMC ---
@@ -105,103 +216,254 @@ def simple_run(model, p0, n_iter=50, n_warm=100, prior_bounds=None):
     return trace, None
 
 
-def run_pymc3(model, p0, iterations, init_cov=None, prior_bounds=None):
+def accumulate_draws(accumulator, model):
+    """Make a `pm.sample` callback that adds each draw, mapped to the
+    transformed (sampled) space of the model, to a covariance accumulator as
+    it is produced.
+    """
+    def callback(trace=None, draw=None):
+        accumulator.update(model.bijection.map(draw.point))
+    return callback
 
-    # -- Launch HMC ---
-    # wrap the loglike and grad in theano tensor ops
-    model.proposer.patch.return_residuals = False
-    logl = LogLikeWithGrad(model)
 
-    # Get upper and lower bounds for variables
-    #lower, upper = prior_bounds(model.proposer.patch.scene)
-    #print(lower.dtype, upper.dtype)
-    pnames = model.scene.parameter_names
-    start = dict(zip(pnames, p0))
+def monitor_draws(monitor, parname="proposal", stop=None):
+    """Make a `pm.sample` callback that adds each post-warmup draw to a
+    `diagnostics.ChainMonitor`.  If `stop(monitor)` returns True sampling is
+    ended early, by raising KeyboardInterrupt, which pymc3 handles by
+    returning the trace so far.
+    """
+    def callback(trace=None, draw=None):
+        if draw.tuning:
+            return
+        monitor.update(draw.point[parname])
+        if (stop is not None) and stop(monitor):
+            raise KeyboardInterrupt
+    return callback
+
+
+def accumulate_trace(accumulator, trace, model):
+    """Add the samples of a `MultiTrace`, mapped to the transformed (sampled)
+    space of the model, to a covariance accumulator.
+    """
+    for chain in trace._straces.values():
+        for p in chain:
+            accumulator.update(model.bijection.map(p))
+    return accumulator
 
-    # Define the windows used to tune the mass matrix.
-    k = np.floor(np.log2((config.n_tune - config.n_warm) / config.n_start))
-    nwindow = config.n_start * 2 ** np.arange(k)
-    nwindow = np.append(nwindow, config.n_tune - config.n_warm - np.sum(nwindow))
-    nwindow = nwindow.astype(int)
 
-    # The pm.sample() method below will draw an initial theta,
-    # then call logl.perform and logl.grad multiple times
-    # in a loop with different theta values.
-    with pm.Model() as opmodel:
+def run_pymc3(model, p0=None, n_iter=100, n_warm=200, n_tune=1000, n_start=20,
+              init_cov=None, dense=True, tol=1.5, min_windows=3,
+              target_ess=None, max_iter=None, max_rhat=None, check_every=25,
+              bounds_kwargs={}, **sample_kwargs):
+    """Sample a posterior with windowed adaptation of the metric.
 
-        # Set priors for each element of theta.
-        z0 = prior_bounds(model.scene)
-        theta = tt.as_tensor_variable(z0)
+    The first `n_tune - n_warm` warmup iterations are split into windows of
+    doubling length (see `adaptation.window_schedule`), after each of which
+    the metric is re-estimated from the samples of that window.  Metric
+    tuning stops early if the metric has converged.  The last `n_warm`
+    warmup iterations tune only the step size.
 
-        # Instantiate target density.
-        pm.DensityDist('likelihood', lambda v: logl(v),
-                        observed={'v': theta})
-
-        # Tune mass matrix.
-        start, burnin = None, None
-        for steps in iterations.nwindow:
-            step = get_step_for_trace(init_cov=init_cov, trace=burnin)
-            burnin = pm.sample(start=start, tune=steps, draws=2, step=step,
-                               compute_convergence_checks=False,
-                               progressbar=False, cores=1,
-                               discard_tuned_samples=False)
-            start = [t[-1] for t in burnin._straces.values()]
-        step = get_step_for_trace(init_cov=init_cov, trace=burnin)
-
-        # Sample with tuned mass matrix.
-        trace = pm.sample(draws=iterations.n_iter, tune=iterations.n_warm,
-                          step=step, start=start,
-                          progressbar=False, cores=1,
-                          discard_tuned_samples=True)
+    Parameters
+    ----------
+    model : forcepho.model.GPUPosterior
+
+    p0 : ndarray, optional
+        Starting position.  Defaults to the scene parameters (see
+        `prior_bounds`).
+
+    n_iter : int
+        Number of samples to draw.
+
+    n_warm : int
+        Number of step size only warmup iterations.
 
-        return trace, step
+    n_tune : int
+        Maximum total number of warmup iterations.
+
+    n_start : int
+        Length of the first metric adaptation window.
+
+    init_cov : ndarray, optional
+        Initial inverse metric in the transformed space.
+
+    dense, tol, min_windows : optional
+        See `adaptation.WindowedAdaptation`
+
+    target_ess : float, optional
+        If given, draw at least `n_iter` and at most `max_iter` samples,
+        stopping once the batch-means ESS of every flux parameter reaches
+        this value (and their split R-hat is below `max_rhat`, if given).
+
+    Returns
+    -------
+    trace : pymc3.MultiTrace
+        With extra attributes `adaptation`, holding the scheduler, and
+        `diagnostics` (see `diagnostics.ChainMonitor.summary`)
+
+    step : pymc3.NUTS
+    """
+    lower, upper, s0 = scene_bounds(model.scene, **bounds_kwargs)
+    template = get_template(len(lower))
+    template.update(model, lower, upper, s0 if p0 is None else p0)
+    potential = QuadPotentialFull if dense else QuadPotentialDiag
+
+    # Tune mass matrix.
+    schedule = WindowedAdaptation(template.ndim, max(n_tune - n_warm, 0),
+                                  n_start=n_start, dense=dense, init_cov=init_cov,
+                                  tol=tol, min_windows=min_windows)
+    start = None
+    for steps in schedule:
+        step = template.step(potential=potential(schedule.cov))
+        # the window's draws are streamed into the schedule's accumulator
+        burnin = template.sample(2, steps, step=step, start=start,
+                                 discard_tuned_samples=False,
+                                 callback=accumulate_draws(schedule.accumulator, template.model))
+        start = burnin.point(-1)
+        schedule.update()
+    step = template.step(potential=potential(schedule.cov))
+
+    # Sample with tuned mass matrix, monitoring convergence.
+    monitor = ChainMonitor(template.ndim)
+    n_draw = n_iter
+    stop = None
+    if target_ess:
+        n_draw = max(n_iter, max_iter or 0)
+        fluxes = flux_indices(model.scene.parameter_names)
+
+        def stop(monitor):
+            return ((monitor.n >= n_iter) and (monitor.n % check_every == 0) and
+                    monitor.converged(target_ess, params=fluxes, max_rhat=max_rhat))
+
+    trace = template.sample(n_draw, n_warm, step=step, start=start,
+                            callback=monitor_draws(monitor, template.parname, stop=stop),
+                            **sample_kwargs)
+    trace.adaptation = schedule
+    trace.diagnostics = monitor.summary()
+
+    return trace, step
+
+
+def run_multichain(model, nchain=4, n_iter=100, n_warm=200, n_tune=1000,
+                   n_start=20, init_cov=None, dense=True, tol=1.5, jitter=0.1,
+                   target_ess=None, max_iter=None, max_rhat=None, check_every=25,
+                   seed=None, bounds_kwargs={}, **sampler_kwargs):
+    """Sample a patch with several chains advanced in lockstep by the native
+    NUTS sampler, gathering the positions of all chains at each leapfrog
+    step into one batched likelihood call (see `sampler.sample_lockstep`).
+
+    The batched call is `model.evaluate_batch` (see
+    `sampler.model_lnprob_and_grad_batch`).  `forcepho.model.GPUPosterior`
+    does not provide this: it evaluates one proposal per kernel launch, so
+    for it the positions of each batch are evaluated in a loop, and the
+    number of device calls is the same as for running the chains one after
+    the other.  The lockstep driver is then only useful for the between-chain
+    diagnostics; whether a batched path was used is recorded in `batched`.
+
+    Parameters
+    ----------
+    model : forcepho.model.GPUPosterior
+        The posterior, for a patch already loaded on the device.
+
+    nchain : int, optional (default: 4)
+        Number of chains.
+
+    n_iter, n_warm, n_tune, n_start, init_cov, dense, tol : optional
+        As for `sampler.run_native`, applied to each chain.
+
+    jitter : float, optional (default: 0.1)
+        Scatter of the starting positions about the scene parameters, in
+        the transformed space.
+
+    target_ess : float, optional
+        If given, the chains draw at least `n_iter` and at most `max_iter`
+        samples each, stopping together once the ESS of every flux
+        parameter, summed over chains, reaches this value (and their
+        between-chain split R-hat is below `max_rhat`, if given).
+
+    Returns
+    -------
+    result : argparse.Namespace
+        With attributes `chain` of shape (nchain, n_draw, ndim), `results`
+        (the per-chain results of `sampler.Sampler.sample`), `diagnostics`
+        (including the between-chain split R-hat), `n_batch` (the number of
+        batched likelihood calls), `batched`, `lower`, and `upper`.
+    """
+    model.proposer.patch.return_residuals = False
+    lower, upper, s0 = scene_bounds(model.scene, **bounds_kwargs)
+    ndim = len(lower)
+    rng = np.random.default_rng(seed)
+
+    samplers, starts, schedules = [], [], []
+    for k in range(nchain):
+        schedule = None
+        cov = init_cov
+        if (n_tune or 0) > n_warm:
+            schedule = WindowedAdaptation(ndim, n_tune - n_warm, n_start=n_start,
+                                          dense=dense, init_cov=init_cov, tol=tol)
+            cov = schedule.cov
+        s = Sampler(model_lnprob_and_grad(model), lower=lower, upper=upper,
+                    inv_metric=cov, seed=rng.integers(2**31), **sampler_kwargs)
+        z0 = s.to_unbounded(s0) + jitter * rng.standard_normal(ndim)
+        samplers.append(s)
+        starts.append(s.to_bounded(z0))
+        schedules.append(schedule)
+
+    batch = model_lnprob_and_grad_batch(model)
+    results, n_batch = sample_lockstep(samplers, batch, starts, schedules=schedules,
+                                       n_iter=n_iter, n_warm=n_warm,
+                                       target_ess=target_ess,
+                                       max_iter=max_iter, max_rhat=max_rhat,
+                                       check_every=check_every,
+                                       ess_params=flux_indices(model.scene.parameter_names))
+
+    chain = np.array([r.chain for r in results])
+    return Namespace(chain=chain, results=results, n_batch=n_batch,
+                     batched=hasattr(model, "evaluate_batch"),
+                     diagnostics=chain_diagnostics(chain),
+                     lower=lower, upper=upper)
 
 
 def get_step_for_trace(init_cov=None, trace=None, model=None,
-                       regularize_cov=False,
+                       regularize_cov=False, dense=True,
                        regular_window=5, regular_variance=1e-3,
-                       **kwargs):
+                       accumulator=None, **kwargs):
     """
     Construct an estimate of the mass matrix based on the sample covariance,
-    which is either provided directly via `init_cov` or generated from a
-    `MultiTrace` object from PyMC3. This is then used to initialize a `NUTS`
-    object to use in `sample`.
+    which is either provided directly via `init_cov`, accumulated online in a
+    `adaptation.WelfordCovariance` (e.g. with the `accumulate_draws`
+    callback), or generated from a `MultiTrace` object from PyMC3. This is
+    then used to initialize a `NUTS` object to use in `sample`.
     """
 
     # ???
     model = pm.modelcontext(model)
+    potential = QuadPotentialFull if dense else QuadPotentialDiag
 
     # If no trace or covariance is provided, just use the identity.
-    if trace is None and init_cov is None:
-        potential = QuadPotentialFull(np.eye(model.ndim))
-        return pm.NUTS(potential=potential, **nuts_kwargs)
+    if trace is None and init_cov is None and accumulator is None:
+        cov = np.eye(model.ndim) if dense else np.ones(model.ndim)
+        return pm.NUTS(potential=potential(cov), **kwargs)
 
-    # If the trace is provided, loop over samples
-    # and convert to the relevant parameter space.
+    # If the trace is provided, stream the samples (converted to the
+    # relevant parameter space) through an online estimator.
     if trace is not None:
-        samples = np.empty((len(trace) * trace.nchains, model.ndim))
-        i = 0
-        for chain in trace._straces.values():
-            for p in chain:
-                samples[i] = model.bijection.map(p)
-                i += 1
-
-        # Compute the sample covariance.
-        cov = np.cov(samples, rowvar=False)
+        accumulator = WelfordCovariance(model.ndim, dense=dense)
+        accumulate_trace(accumulator, trace, model)
 
+    if accumulator is not None:
         # Stan uses a regularized estimator for the covariance matrix to
         # be less sensitive to numerical issues for large parameter spaces.
-        if regularize_cov:
-            N = len(samples)
-            cov = cov * N / (N + regular_window)
-            diags = np.diag_indices_from(cov)
-            cov[diags] += ((regular_variance * regular_window)
-                           / (N + regular_window))
+        cov = accumulator.covariance(regularize=regularize_cov,
+                                     regular_window=regular_window,
+                                     regular_variance=regular_variance)
     else:
         # Otherwise, just copy `init_cov`.
         cov = np.array(init_cov)
 
-    # Use the sample covariance as the inverse metric.
-    potential = QuadPotentialFull(cov)
+    if dense and cov.ndim == 1:
+        cov = np.diag(cov)
+    elif (not dense) and cov.ndim == 2:
+        cov = np.diag(cov).copy()
 
-    return pm.NUTS(potential=potential, **nuts_kwargs)
+    # Use the sample covariance as the inverse metric.
+    return pm.NUTS(potential=potential(cov), **kwargs)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""patch_result.py
+
+Lazy reader for patch output files written by `utils.dump_to_h5` (either the
+"groups" or the "packed" layout) or for patch groups in a `runstore.RunStore`
+shard.  Datasets are only read when asked for, and only the requested slice
+is read.  Open file handles are kept in a small LRU cache so that scanning
+many outputs does not repeatedly pay the cost of opening files.  The shared
+module-level cache is closed at exit; use a `HandleCache` (or `PatchResult`)
+as a context manager, or call `close()`, to release handles sooner.
+"""
+
+import atexit
+from collections import OrderedDict
+import numpy as np
+import h5py
+
+
+__all__ = ["PatchResult", "HandleCache"]
+
+
+class HandleCache:
+    """An LRU cache of read-only h5py file handles.  All handles are closed
+    when it is used as a context manager and the block exits.
+
+    Parameters
+    ----------
+    maxsize : int, optional (default: 64)
+        Maximum number of files to keep open.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._handles = OrderedDict()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, filename):
+        """Get an open handle for `filename`, opening it if necessary and
+        closing the least recently used handle if the cache is full.
+        """
+        try:
+            self._handles.move_to_end(filename)
+            return self._handles[filename]
+        except(KeyError):
+            pass
+        handle = h5py.File(filename, "r")
+        self._handles[filename] = handle
+        while len(self._handles) > self.maxsize:
+            _, old = self._handles.popitem(last=False)
+            old.close()
+        return handle
+
+    def close(self, filename=None):
+        """Close one handle, or all of them."""
+        names = list(self._handles.keys()) if filename is None else [filename]
+        for n in names:
+            h = self._handles.pop(n, None)
+            if h is not None:
+                h.close()
+
+
+# shared default cache
+handles = HandleCache()
+atexit.register(handles.close)
+
+
+class PatchResult:
+    """Lazy view of the results for one patch.
+
+    Parameters
+    ----------
+    source : string or h5py.Group
+        The patch output filename, or an open group with the same layout.
+
+    group : string, optional
+        Path of the patch group within the file, e.g. for a patch stored in a
+        `RunStore` shard.
+
+    cache : HandleCache, optional
+        Cache of open file handles to use.  Defaults to a shared module-level
+        cache.  The handle for this patch's file is closed by `close()`, or
+        on exit when used as a context manager.
+    """
+
+    def __init__(self, source, group=None, cache=None):
+        self.source = source
+        self.group = group
+        self.cache = handles if cache is None else cache
+        self._active = None
+        self._fixed = None
+
+    def __repr__(self):
+        return "PatchResult({})".format(self.source)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the cached handle for this patch's file (but not a group
+        that was passed in).
+        """
+        if not isinstance(self.source, h5py.Group):
+            self.cache.close(self.source)
+
+    @property
+    def disk(self):
+        """The open h5py group for this patch."""
+        if isinstance(self.source, h5py.Group):
+            g = self.source
+        else:
+            g = self.cache.get(self.source)
+        if self.group:
+            g = g[self.group]
+        return g
+
+    def __contains__(self, name):
+        return name in self.disk
+
+    def __getitem__(self, name):
+        """Read a full top-level dataset"""
+        return self.disk[name][()]
+
+    def _meta(self, name):
+        """Read a value stored either as an attribute or as a dataset."""
+        disk = self.disk
+        if name in disk.attrs:
+            return disk.attrs[name]
+        return disk[name][()]
+
+    @property
+    def layout(self):
+        layout = self.disk.attrs.get("layout", "groups")
+        if isinstance(layout, bytes):
+            layout = layout.decode("utf-8")
+        return layout
+
+    @property
+    def bandlist(self):
+        return [b.decode("utf-8") for b in self._meta("bandlist")]
+
+    @property
+    def reference_coordinates(self):
+        return np.array(self._meta("reference_coordinates"))
+
+    @property
+    def epaths(self):
+        return [e.decode("utf-8") for e in self.disk["epaths"][:]]
+
+    @property
+    def active(self):
+        if (self._active is None) and ("active" in self.disk):
+            self._active = self.disk["active"][:]
+        return self._active
+
+    @property
+    def fixed(self):
+        if (self._fixed is None) and ("fixed" in self.disk):
+            self._fixed = self.disk["fixed"][:]
+        return self._fixed
+
+    # --- Chains ---
+
+    @property
+    def chain_shape(self):
+        """Shape of the chain, (n_iter, n_param), without reading it."""
+        return self.disk["chain"].shape
+
+    def chain(self, start=None, stop=None, thin=1, params=None):
+        """Read (part of) the chain.
+
+        Parameters
+        ----------
+        start, stop : int, optional
+            Range of iterations to read.
+
+        thin : int, optional (default: 1)
+            Read only every `thin`-th iteration.
+
+        params : slice or sorted sequence of int, optional
+            Columns (parameters) to read.
+
+        Returns
+        -------
+        chain : ndarray of shape (n_iter, n_param)
+        """
+        dset = self.disk["chain"]
+        rows = slice(start, stop, thin)
+        if params is None:
+            return dset[rows]
+        if not isinstance(params, slice):
+            params = np.array(params)
+        return dset[rows, params]
+
+    # --- Exposures ---
+
+    def _exposure_index(self, exposure):
+        if isinstance(exposure, (str, bytes)):
+            if isinstance(exposure, bytes):
+                exposure = exposure.decode("utf-8")
+            return self.epaths.index(exposure)
+        return int(exposure) % len(self.disk["epaths"])
+
+    def exposure(self, exposure, name):
+        """Read a pixel or meta quantity for a single exposure.
+
+        Parameters
+        ----------
+        exposure : int or string
+            Exposure index or path.
+
+        name : string
+            Quantity to read, e.g. "xpix", "data", "active_residual", "CW"
+
+        Returns
+        -------
+        arr : ndarray
+        """
+        i = self._exposure_index(exposure)
+        disk = self.disk
+        if self.layout == "packed":
+            if name in disk["meta"]:
+                return disk["meta"][name][i]
+            start = disk["exposure_start"][i]
+            npix = disk["exposure_N"][i]
+            return disk["pixels"][name][start:start + npix]
+        epath = disk["epaths"][i]
+        return disk[epath][name][()]
+
+    def exposure_meta(self, exposure):
+        """Get the astrometric meta data for one exposure as a dictionary
+        with keys "crval", "crpix", "CW", and "D".
+        """
+        return {k: self.exposure(exposure, k) for k in ["crval", "crpix", "CW", "D"]}
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""projection.py
+
+Batched conversion of celestial coordinates to pixel coordinates, for many
+sources and many samples of each source at once.  The full (non-linear) WCS
+is evaluated only at one reference position per source to get a local linear
+transform (the same crpix + CW . (sky - crval) form used for the patch
+metadata), which is then applied to every sample in a single vectorized
+operation.  Linearizations are cached per WCS and source id.
+"""
+
+import warnings
+import numpy as np
+
+
+__all__ = ["linear_project", "linearize", "Projector", "get_projector"]
+
+
+def linear_project(ra, dec, crval, crpix, CW, ref_coords=0.):
+    """Apply a linear sky to pixel transform to arrays of coordinates.
+
+    Parameters
+    ----------
+    ra, dec : ndarrays of shape (n_source,) or (n_source, n_sample)
+        Celestial coordinates in degrees.
+
+    crval : ndarray of shape (2,) or (n_source, 2)
+        Reference celestial coordinates of the transform.
+
+    crpix : ndarray of shape (2,) or (n_source, 2)
+        Pixel coordinates of `crval`.
+
+    CW : ndarray of shape (2, 2) or (n_source, 2, 2)
+        The matrix of derivatives of pixel coordinates with respect to
+        celestial coordinates.
+
+    ref_coords : float or ndarray of shape (2,), optional
+        Offset to add to `crval`, e.g. the patch reference coordinates.
+
+    Returns
+    -------
+    x, y : ndarrays with the same shape as `ra`
+    """
+    ra, dec = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+    shape = ra.shape
+    n_source = shape[0] if ra.ndim else 1
+    ra, dec = ra.reshape(n_source, -1), dec.reshape(n_source, -1)
+
+    crval = np.broadcast_to(np.asarray(crval) + ref_coords, (n_source, 2))
+    crpix = np.broadcast_to(np.asarray(crpix), (n_source, 2))
+    CW = np.broadcast_to(np.asarray(CW), (n_source, 2, 2))
+
+    dra = ra - crval[:, 0:1]
+    ddec = dec - crval[:, 1:2]
+    x = CW[:, 0, 0:1] * dra + CW[:, 0, 1:2] * ddec + crpix[:, 0:1]
+    y = CW[:, 1, 0:1] * dra + CW[:, 1, 1:2] * ddec + crpix[:, 1:2]
+    return x.reshape(shape), y.reshape(shape)
+
+
+def linearize(wcs, ra0, dec0, delta=1e-5, origin=1):
+    """Get local linear approximations to a WCS at a set of positions, with
+    one batched call to the full WCS.
+
+    Parameters
+    ----------
+    wcs : astropy.wcs.WCS
+
+    ra0, dec0 : ndarrays of shape (n,)
+        Positions (degrees) at which to linearize.
+
+    delta : float, optional (default: 1e-5)
+        Step in degrees for the finite difference derivatives.
+
+    origin : int, optional (default: 1)
+        Pixel origin convention passed to `all_world2pix`
+
+    Returns
+    -------
+    crval : ndarray of shape (n, 2)
+
+    crpix : ndarray of shape (n, 2)
+
+    CW : ndarray of shape (n, 2, 2)
+    """
+    ra0, dec0 = np.atleast_1d(ra0).astype(np.float64), np.atleast_1d(dec0).astype(np.float64)
+    n = len(ra0)
+    ra = np.concatenate([ra0, ra0 + delta, ra0])
+    dec = np.concatenate([dec0, dec0, dec0 + delta])
+    x, y = wcs.all_world2pix(ra, dec, origin)
+    pix = np.array([x, y]).T.reshape(3, n, 2)
+    CW = np.zeros((n, 2, 2))
+    CW[:, :, 0] = (pix[1] - pix[0]) / delta
+    CW[:, :, 1] = (pix[2] - pix[0]) / delta
+    crval = np.array([ra0, dec0]).T
+    return crval, pix[0], CW
+
+
+class Projector:
+    """Project samples of source positions through a single WCS, linearizing
+    the WCS once per source.  Over the spread of samples for a single source
+    (typically << 1 arcsec) the linearization error is negligible.
+
+    Parameters
+    ----------
+    wcs : astropy.wcs.WCS
+
+    origin : int, optional (default: 1)
+        Pixel origin convention, as for `all_world2pix`
+    """
+
+    def __init__(self, wcs, origin=1):
+        self.wcs = wcs
+        self.origin = origin
+        self._cache = {}
+
+    def transforms(self, ra0, dec0, ids=None):
+        """Get the linear transforms for a set of sources, using cached values
+        for source ids that have been seen before.  Transforms that are not
+        finite (e.g. for a NaN position) are returned but not cached.
+        """
+        if ids is None:
+            return linearize(self.wcs, ra0, dec0, origin=self.origin)
+        ids = np.atleast_1d(ids)
+        new = np.array([i not in self._cache for i in ids.tolist()], dtype=bool)
+        fresh = {}
+        if new.any():
+            cv, cp, cw = linearize(self.wcs, np.atleast_1d(ra0)[new],
+                                   np.atleast_1d(dec0)[new], origin=self.origin)
+            for k, i in enumerate(ids[new].tolist()):
+                fresh[i] = (cv[k], cp[k], cw[k])
+                if np.all(np.isfinite(cp[k])) and np.all(np.isfinite(cw[k])):
+                    self._cache[i] = fresh[i]
+        lin = [fresh[i] if i in fresh else self._cache[i] for i in ids.tolist()]
+        crval, crpix, CW = [np.array(a) for a in zip(*lin)]
+        return crval, crpix, CW
+
+    def project(self, ra, dec, ids=None):
+        """Convert celestial coordinates to pixel coordinates.
+
+        Parameters
+        ----------
+        ra, dec : ndarrays of shape (n_source, n_sample)
+            Samples of the source positions, in degrees.  NaN samples (e.g.
+            padding, see `make_cat.fit_chain_length`) give NaN pixels.
+
+        ids : ndarray of shape (n_source,), optional
+            Source ids used to cache the linearizations.
+
+        Returns
+        -------
+        x, y : ndarrays of shape (n_source, n_sample)
+        """
+        ra, dec = np.asarray(ra), np.asarray(dec)
+        ra2, dec2 = ra.reshape(len(ra), -1), dec.reshape(len(dec), -1)
+        # linearize about the mean of the valid samples
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            ra0, dec0 = np.nanmean(ra2, axis=-1), np.nanmean(dec2, axis=-1)
+        crval, crpix, CW = self.transforms(ra0, dec0, ids=ids)
+        return linear_project(ra, dec, crval, crpix, CW)
+
+
+_projectors = {}
+
+
+def get_projector(wcs, origin=1, maxsize=8):
+    """Get a cached `Projector` for a WCS.  WCS objects with the same header
+    (e.g. copies unpickled in different worker tasks) share a projector.
+    """
+    key = (wcs.to_header_string(relax=True), origin)
+    if key not in _projectors:
+        while len(_projectors) >= maxsize:
+            _projectors.pop(next(iter(_projectors)))
+        _projectors[key] = Projector(wcs, origin=origin)
+    return _projectors[key]
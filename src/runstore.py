@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""runstore.py
+
+A run-level store for patch results.  Instead of one HDF5 file per patch,
+each writer (e.g. each child process) appends patch results as groups in a
+small number of HDF5 shard files, and records every patch in an append-only
+JSON-lines index.  Readers use the index to find patches by patchid or by
+source index without opening every shard.
+
+The layout of each patch group is the same as that of the files written by
+`utils.dump_to_h5`.
+
+Directory layout::
+
+    <directory>/index_<writer>.jsonl
+    <directory>/shard_<writer>_<n>.h5  ->  /patch<patchid>/...
+
+Each index line is written (and flushed to disk) only after the patch group
+has been flushed to its shard, so the index can be read while the run is in
+progress to monitor it.  A shard may be opened for reading once its "closed"
+record is in the index; shards are closed when they reach
+`max_patches_per_shard` patches or when the writer is closed.
+
+A writer name may be reused by successive processes (e.g. one process per
+patch on the same host): a new writer reopens its last shard if that is not
+full, recording a "reopened" record so readers treat it as incomplete until
+it is closed again.  Writers with the same name hold an exclusive lock on
+`<directory>/lock_<writer>` while a shard is open, so concurrent processes
+with the same name take turns.  If a patchid is written more than once
+(e.g. when a patch is rerun) readers resolve it to the latest record.
+"""
+
+import os, glob, json, time, fcntl
+from contextlib import contextmanager
+from itertools import chain
+import numpy as np
+import h5py
+
+from utils import write_patch
+
+
+__all__ = ["RunStore", "region_to_list"]
+
+
+INDEX_FMT = "index_{}.jsonl"
+LOCK_FMT = "lock_{}"
+SHARD_FMT = "shard_{}_{:04d}.h5"
+GROUP_FMT = "patch{:08d}"
+
+
+def region_to_list(region):
+    """Convert a region object to a list of floats for the index.  Circular
+    regions give [ra, dec, radius] and rectangular regions give
+    [ra_min, ra_max, dec_min, dec_max].
+    """
+    if region is None:
+        return []
+    try:
+        return [float(region.ra), float(region.dec), float(region.radius)]
+    except(AttributeError):
+        return [float(region.ra_min), float(region.ra_max),
+                float(region.dec_min), float(region.dec_max)]
+
+
+class RunStore:
+    """Sharded, append-only store of patch results.
+
+    Parameters
+    ----------
+    directory : string
+        Location of the shards and index files.
+
+    writer : string or int, optional
+        A name for this writer, e.g. the MPI rank or the host name.  Writers
+        with the same name share shards (see above).  Only needed for
+        appending.
+
+    max_patches_per_shard : int, optional (default: 512)
+        Number of patches after which a writer closes its current shard and
+        starts a new one.
+
+    dump_kwargs : optional
+        Extra keyword arguments for `utils.write_patch`, e.g. `layout`.
+    """
+
+    def __init__(self, directory, writer=None, max_patches_per_shard=512,
+                 **dump_kwargs):
+        self.directory = directory
+        self.writer = writer
+        self.max_patches_per_shard = max_patches_per_shard
+        self.dump_kwargs = dump_kwargs
+        self._shard = None
+        self._shard_num = 0
+        self._shard_count = 0
+        self._lock = None
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # ------------------
+    # --- Writer side ---
+
+    def append(self, patchid, patch, region=None, active=None, fixed=None,
+               pixeldatadict={}, otherdatadict={}):
+        """Append the results for one patch to this writer's current shard,
+        and record it in the index.  Arguments are as for `utils.dump_to_h5`.
+        """
+        if self.writer is None:
+            raise ValueError("A writer name is required to append to a RunStore")
+        if self._shard is None:
+            self._open_shard()
+
+        name, n = GROUP_FMT.format(patchid), 0
+        while name in self._shard:
+            # a rerun of a patch already in this shard
+            n += 1
+            name = "{}_{}".format(GROUP_FMT.format(patchid), n)
+        g = self._shard.create_group(name)
+        write_patch(g, patch, active=active, fixed=fixed,
+                    pixeldatadict=pixeldatadict, otherdatadict=otherdatadict,
+                    **self.dump_kwargs)
+        self._shard.flush()
+
+        sources = [] if active is None else np.array(active["source_index"]).tolist()
+        record = dict(patchid=int(patchid), shard=os.path.basename(self._shard.filename),
+                      group=name, region=region_to_list(region),
+                      sources=sources, time=time.time())
+        # per-source convergence, so poorly converged sources can be found
+        # from the index alone
+        for k in ["source_ess", "source_rhat"]:
+            if k in otherdatadict:
+                record[k] = np.array(otherdatadict[k], dtype=float).tolist()
+        self._write_record(record)
+
+        self._shard_count += 1
+        if self._shard_count >= self.max_patches_per_shard:
+            self._close_shard()
+
+    def close(self):
+        """Close the current shard, if any."""
+        self._close_shard()
+
+    def _open_shard(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = open(os.path.join(self.directory, LOCK_FMT.format(self.writer)), "a")
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        last, count = self._last_shard()
+        if (last is not None) and (count < self.max_patches_per_shard):
+            try:
+                self._shard = h5py.File(os.path.join(self.directory, last), "a")
+            except(OSError):
+                # e.g. held open by a reader
+                pass
+            else:
+                self._shard_count = count
+                self._write_record(dict(reopened=last, time=time.time()))
+                return
+        while True:
+            fn = os.path.join(self.directory, SHARD_FMT.format(self.writer, self._shard_num))
+            self._shard_num += 1
+            if not os.path.exists(fn):
+                break
+        self._shard = h5py.File(fn, "w")
+        self._shard_count = 0
+
+    def _last_shard(self):
+        """The most recent shard of this writer and its number of patches."""
+        fn = os.path.join(self.directory, INDEX_FMT.format(self.writer))
+        last, counts = None, {}
+        if os.path.exists(fn):
+            for rec in self._read_records(fn):
+                shard = rec.get("shard", rec.get("closed", rec.get("reopened")))
+                counts[shard] = counts.get(shard, 0) + ("patchid" in rec)
+                last = shard
+        return last, counts.get(last, 0)
+
+    def _close_shard(self):
+        if self._shard is None:
+            return
+        name = os.path.basename(self._shard.filename)
+        self._shard.close()
+        self._shard = None
+        self._write_record(dict(closed=name, time=time.time()))
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+        self._lock = None
+
+    def _write_record(self, record):
+        fn = os.path.join(self.directory, INDEX_FMT.format(self.writer))
+        with open(fn, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    # ------------------
+    # --- Reader side ---
+
+    @staticmethod
+    def _read_records(fn):
+        with open(fn, "r") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except(ValueError):
+                    # partially written last line
+                    continue
+
+    def read_index(self):
+        """Read the index records from all writers.
+
+        Returns
+        -------
+        records : list of dicts
+            One record per patch, with keys "patchid", "shard", "group",
+            "region", "sources", "time", and "complete".  The last is True if
+            the shard holding the patch has been closed and can be read.
+            Patches written with convergence diagnostics also have
+            "source_ess" and "source_rhat", in the order of "sources".  If a
+            patchid was written more than once only the latest record is
+            returned.
+        """
+        latest, closed = {}, set()
+        search = os.path.join(self.directory, INDEX_FMT.format("*"))
+        for fn in sorted(glob.glob(search)):
+            for rec in self._read_records(fn):
+                if "closed" in rec:
+                    closed.add(rec["closed"])
+                elif "reopened" in rec:
+                    closed.discard(rec["reopened"])
+                else:
+                    old = latest.get(rec["patchid"])
+                    if (old is None) or (rec["time"] >= old["time"]):
+                        latest[rec["patchid"]] = rec
+        records = sorted(latest.values(), key=lambda rec: rec["time"])
+        for rec in records:
+            rec["complete"] = rec["shard"] in closed
+        self._index = records
+        return records
+
+    def index(self, refresh=False):
+        """Get the index as a structured array, with one row per patch.  The
+        source indices for each patch are in `sources()`.
+        """
+        if refresh or (self._index is None):
+            self.read_index()
+        dtype = np.dtype([("patchid", np.int64), ("shard", "S64"), ("group", "S32"),
+                          ("n_source", np.int32), ("source_start", np.int64),
+                          ("complete", bool), ("time", np.float64)])
+        out = np.zeros(len(self._index), dtype=dtype)
+        nsrc = np.array([len(r["sources"]) for r in self._index], dtype=np.int64)
+        out["n_source"] = nsrc
+        out["source_start"] = np.cumsum(nsrc) - nsrc
+        for c in ["patchid", "shard", "group", "complete", "time"]:
+            out[c] = [r[c] for r in self._index]
+        return out
+
+    def sources(self, refresh=False):
+        """Get the source indices of all patches, concatenated in index
+        order.  Use the "source_start" and "n_source" columns of `index()` to
+        find the sources of a given patch.
+        """
+        if refresh or (self._index is None):
+            self.read_index()
+        nsrc = sum([len(r["sources"]) for r in self._index])
+        src = chain.from_iterable([r["sources"] for r in self._index])
+        return np.fromiter(src, dtype=np.int64, count=nsrc)
+
+    def find_patch(self, patchid):
+        """Get the index record for a patch."""
+        if self._index is None:
+            self.read_index()
+        for rec in self._index:
+            if rec["patchid"] == patchid:
+                return rec
+        raise KeyError("No patch {} in {}".format(patchid, self.directory))
+
+    def find_source(self, source_index):
+        """Get the patchids of all patches in which a source was active."""
+        idx = self.index()
+        src = self.sources()
+        rows = np.searchsorted(idx["source_start"], np.where(src == source_index)[0],
+                               side="right") - 1
+        return idx["patchid"][rows]
+
+    def _complete_record(self, patchid):
+        """Get the index record for a patch, raising IOError if its shard is
+        still being written.
+        """
+        rec = self.find_patch(patchid)
+        if not rec["complete"]:
+            # the shard may have been closed since the index was read
+            self.read_index()
+            rec = self.find_patch(patchid)
+        if not rec["complete"]:
+            raise IOError("Shard {} is still being written".format(rec["shard"]))
+        return rec
+
+    @contextmanager
+    def open_patch(self, patchid):
+        """Open the HDF5 group holding the results for a patch.  The group has
+        the same layout as a file written by `utils.dump_to_h5`.
+        """
+        rec = self._complete_record(patchid)
+        with h5py.File(os.path.join(self.directory, rec["shard"]), "r") as disk:
+            yield disk[rec["group"]]
+
+    def result(self, patchid, cache=None):
+        """Get a lazy `patch_result.PatchResult` for a patch, using a cache of
+        open shard handles.
+        """
+        from patch_result import PatchResult
+        rec = self._complete_record(patchid)
+        return PatchResult(os.path.join(self.directory, rec["shard"]),
+                           group=rec["group"], cache=cache)
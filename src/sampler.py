@@ -0,0 +1,738 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""sampler.py - A self-contained NumPy implementation of HMC and NUTS.
+
+This samples a posterior given only a function returning the ln-probability
+and its gradient (e.g. `forcepho.model.GPUPosterior`), with no theano graph
+or pymc3 model.  Uniform priors are implemented as in pymc3, with a scaled
+logit transform from the bounded interval to the real line (including the
+log-Jacobian), so the target density is the same as that of the pymc3 model
+built with `mc.prior_bounds`.
+"""
+
+import time
+from argparse import Namespace
+import numpy as np
+
+from adaptation import WindowedAdaptation
+from diagnostics import ChainMonitor, flux_indices
+
+
+__all__ = ["scene_bounds", "BoundTransform", "QuadMetric",
+           "Sampler", "model_lnprob_and_grad", "model_lnprob_and_grad_batch",
+           "loop_batch", "sample_lockstep", "run_native"]
+
+
+def scene_bounds(scene, pos_prior=0.1/3600., flux_factor=5,
+                 flux_lim=2.0, max_flux=2e3):
+    """Generate lower and upper bounds of a uniform prior on the scene
+    parameters, and a starting position within the bounds.  See
+    `mc.prior_bounds` for a description of the parameters.
+
+    Returns
+    -------
+    lower : ndarray of shape (ndim,)
+
+    upper : ndarray of shape (ndim,)
+
+    start : ndarray of shape (ndim,)
+    """
+    pnames = scene.parameter_names
+
+    rh_range = np.array(scene.sources[0].rh_range)
+    sersic_range = np.array(scene.sources[0].sersic_range)
+    lower = [s.nband * [0.] +
+             [s.ra - pos_prior, s.dec - pos_prior,
+              0.3, -np.pi/1.5, sersic_range[0], rh_range[0]]
+             for s in scene.sources]
+    upper = [(np.clip(np.array(s.flux) * flux_factor, flux_lim, max_flux)).tolist() +
+             [s.ra + pos_prior, s.dec + pos_prior,
+              1.0, np.pi/1.5, sersic_range[-1], rh_range[-1]]
+             for s in scene.sources]
+    lower = np.concatenate(lower)
+    upper = np.concatenate(upper)
+    s0 = scene.get_all_source_params().copy()
+    # replace parameters at lower bound
+    # HACK
+    for i, p in enumerate(pnames):
+        if ("F" in p):
+            if s0[i] <= lower[i]:
+                s0[i] = 0.5 * (upper[i] + lower[i])
+
+    return lower, upper, s0
+
+
+class BoundTransform:
+    """Scaled logit transform between the box `lower < x < upper` and the
+    unbounded space `z`, as used by pymc3 for uniform priors.
+
+    Parameters
+    ----------
+    lower, upper : ndarrays of shape (ndim,)
+        Bounds.  Parameters with infinite bounds are not transformed.
+    """
+
+    def __init__(self, lower, upper):
+        self.lower = np.array(lower, dtype=np.float64)
+        self.upper = np.array(upper, dtype=np.float64)
+        self.bounded = np.isfinite(self.lower) & np.isfinite(self.upper)
+        self.width = np.where(self.bounded, self.upper - self.lower, 1.0)
+        self.offset = np.where(self.bounded, self.lower, 0.0)
+
+    def to_unbounded(self, x, margin=1e-8):
+        """Transform x to z.  Values on or outside the bounds are first moved
+        inside by a fraction `margin` of the interval.
+        """
+        u = (np.asarray(x, dtype=np.float64) - self.offset) / self.width
+        u = np.clip(u, margin, 1 - margin)
+        z = np.log(u) - np.log1p(-u)
+        return np.where(self.bounded, z, x)
+
+    def to_bounded(self, z):
+        """Transform z to x."""
+        s = _sigmoid(z)
+        return np.where(self.bounded, self.offset + self.width * s, z)
+
+    def jacobian(self, z):
+        """The derivatives dx/dz (the diagonal of the Jacobian) at z."""
+        s = _sigmoid(z)
+        return np.where(self.bounded, self.width * s * (1 - s), 1.0)
+
+    def lnp_and_grad(self, z, lnp_x, grad_x):
+        """Convert the ln-probability and gradient in x to those in z,
+        including the log-Jacobian of the transform.
+        """
+        s = _sigmoid(z)
+        dxdz = self.jacobian(z)
+        with np.errstate(divide="ignore"):
+            logj = np.where(self.bounded, np.log(dxdz), 0.0).sum()
+        dlogj = np.where(self.bounded, 1 - 2 * s, 0.0)
+        return lnp_x + logj, grad_x * dxdz + dlogj
+
+
+def _sigmoid(z):
+    return 0.5 * (1 + np.tanh(0.5 * np.asarray(z, dtype=np.float64)))
+
+
+class QuadMetric:
+    """Euclidean metric for the kinetic energy.
+
+    Parameters
+    ----------
+    inv_metric : ndarray of shape (ndim,) or (ndim, ndim)
+        The inverse mass matrix (i.e. an estimate of the posterior covariance
+        in the sampled space).  A 1-d array gives a diagonal metric.
+    """
+
+    def __init__(self, inv_metric):
+        self.set(inv_metric)
+
+    def set(self, inv_metric):
+        self.inv_metric = np.array(inv_metric, dtype=np.float64)
+        self.dense = self.inv_metric.ndim == 2
+        if self.dense:
+            # Sigma = L L^T, M = Sigma^{-1}, p = L^{-T} n has covariance M
+            self._chol = np.linalg.cholesky(self.inv_metric)
+        else:
+            self._isd = 1. / np.sqrt(self.inv_metric)
+
+    @property
+    def ndim(self):
+        return len(self.inv_metric)
+
+    def sample_momentum(self, rng):
+        n = rng.standard_normal(self.ndim)
+        if self.dense:
+            from scipy.linalg import solve_triangular
+            return solve_triangular(self._chol, n, lower=True, trans="T")
+        return n * self._isd
+
+    def velocity(self, p):
+        if self.dense:
+            return np.dot(self.inv_metric, p)
+        return self.inv_metric * p
+
+    def kinetic(self, p):
+        return 0.5 * np.dot(p, self.velocity(p))
+
+
+class DualAverage:
+    """Dual averaging step size adaptation (Hoffman & Gelman 2014)"""
+
+    def __init__(self, step_size, target_accept=0.8, gamma=0.05, t0=10, kappa=0.75):
+        self.mu = np.log(10 * step_size)
+        self.target = target_accept
+        self.gamma, self.t0, self.kappa = gamma, t0, kappa
+        self.restart(step_size)
+
+    def restart(self, step_size):
+        self.mu = np.log(10 * step_size)
+        self.count = 0
+        self.hbar = 0.
+        self.log_eps = np.log(step_size)
+        self.log_eps_bar = 0.
+
+    def update(self, accept):
+        self.count += 1
+        w = 1. / (self.count + self.t0)
+        self.hbar = (1 - w) * self.hbar + w * (self.target - accept)
+        self.log_eps = self.mu - np.sqrt(self.count) / self.gamma * self.hbar
+        eta = self.count**(-self.kappa)
+        self.log_eps_bar = eta * self.log_eps + (1 - eta) * self.log_eps_bar
+        return np.exp(self.log_eps)
+
+    @property
+    def final(self):
+        return np.exp(self.log_eps_bar)
+
+
+class Sampler:
+    """HMC sampler using the No-U-Turn criterion (multinomial NUTS) or a fixed
+    number of leapfrog steps.
+
+    Parameters
+    ----------
+    lnprob_and_grad : callable
+        Function of the parameter vector returning the ln-probability and
+        its gradient.
+
+    lower, upper : ndarrays of shape (ndim,), optional
+        Uniform prior bounds.  If not given the parameters are unbounded.
+
+    inv_metric : ndarray of shape (ndim,) or (ndim, ndim), optional
+        Initial inverse mass matrix in the unbounded space.  Defaults to the
+        identity (diagonal).
+
+    step_size : float, optional
+        Initial step size.  If not given a reasonable value is found
+        automatically.
+
+    n_steps : int, optional
+        If given, use static HMC with this many leapfrog steps instead of
+        NUTS.
+
+    target_accept : float, optional (default: 0.8)
+        Target mean acceptance probability for step size adaptation.
+
+    max_treedepth : int, optional (default: 10)
+
+    seed : int, optional
+        Seed for the random number generator.
+    """
+
+    def __init__(self, lnprob_and_grad, lower=None, upper=None, ndim=None,
+                 inv_metric=None, step_size=None, n_steps=None,
+                 target_accept=0.8, max_treedepth=10, max_energy_error=1000.,
+                 seed=None):
+        self.lnprob_and_grad = lnprob_and_grad
+        if lower is not None:
+            ndim = len(lower)
+            self.transform = BoundTransform(lower, upper)
+        else:
+            self.transform = None
+        if inv_metric is None:
+            inv_metric = np.ones(ndim)
+        self.metric = QuadMetric(inv_metric)
+        self.step_size = step_size
+        self.n_steps = n_steps
+        self.target_accept = target_accept
+        self.max_treedepth = max_treedepth
+        self.max_energy_error = max_energy_error
+        self.rng = np.random.default_rng(seed)
+        self.ncall = 0
+
+    # --- target in the unbounded space ---
+
+    def lnp_grad_z(self, z):
+        return self.finish(z, *self.lnprob_and_grad(self.to_bounded(z)))
+
+    def finish(self, z, lnp, grad):
+        """Convert the ln-probability and gradient at the bounded position
+        corresponding to `z` to those in the unbounded space.
+        """
+        self.ncall += 1
+        lnp, grad = float(lnp), np.asarray(grad, dtype=np.float64)
+        if self.transform is not None:
+            lnp, grad = self.transform.lnp_and_grad(z, lnp, grad)
+        if not np.isfinite(lnp) or not np.all(np.isfinite(grad)):
+            return -np.inf, np.zeros_like(z)
+        return lnp, grad
+
+    def to_unbounded(self, x):
+        return x if self.transform is None else self.transform.to_unbounded(x)
+
+    def to_bounded(self, z):
+        return z if self.transform is None else self.transform.to_bounded(z)
+
+    # The transitions are written as generators that yield each unbounded
+    # position at which the target must be evaluated, and are sent back the
+    # result of `finish` for that position.  This lets `sample_lockstep`
+    # batch the evaluations of several chains; `_run` evaluates them one at a
+    # time for a single chain.
+
+    def _run(self, gen):
+        try:
+            z = next(gen)
+            while True:
+                z = gen.send(self.lnp_grad_z(z))
+        except StopIteration as stop:
+            return stop.value
+
+    def leapfrog(self, z, p, grad, eps):
+        return self._run(self._leapfrog(z, p, grad, eps))
+
+    def _leapfrog(self, z, p, grad, eps):
+        p = p + 0.5 * eps * grad
+        z = z + eps * self.metric.velocity(p)
+        lnp, grad = yield z
+        p = p + 0.5 * eps * grad
+        return z, p, grad, lnp
+
+    def find_step_size(self, z, lnp, grad, eps=1.0, max_iter=100):
+        """Heuristic for an initial step size (Hoffman & Gelman 2014, alg. 4)
+        """
+        return self._run(self._find_step_size(z, lnp, grad, eps=eps, max_iter=max_iter))
+
+    def _find_step_size(self, z, lnp, grad, eps=1.0, max_iter=100):
+        p = self.metric.sample_momentum(self.rng)
+        H0 = -lnp + self.metric.kinetic(p)
+        _, p1, _, lnp1 = yield from self._leapfrog(z, p, grad, eps)
+        dH = H0 - (-lnp1 + self.metric.kinetic(p1))
+        direction = 1 if (np.isfinite(dH) and dH > np.log(0.5)) else -1
+        for i in range(max_iter):
+            _, p1, _, lnp1 = yield from self._leapfrog(z, p, grad, eps)
+            dH = H0 - (-lnp1 + self.metric.kinetic(p1))
+            if not np.isfinite(dH):
+                dH = -np.inf
+            if (direction * dH) <= (direction * np.log(0.5)):
+                break
+            eps *= 2.0**direction
+        return eps
+
+    # --- transitions ---
+
+    def step(self, z, lnp, grad, eps):
+        """Make one transition from z.
+
+        Returns
+        -------
+        z, lnp, grad : the new state
+
+        info : dict
+            Mean acceptance probability, number of leapfrog steps, tree depth,
+            whether a divergence was encountered, and the energy.
+        """
+        return self._run(self._transition(z, lnp, grad, eps))
+
+    def _transition(self, z, lnp, grad, eps):
+        if self.n_steps is None:
+            return (yield from self._nuts_step(z, lnp, grad, eps))
+        return (yield from self._hmc_step(z, lnp, grad, eps))
+
+    def _hmc_step(self, z, lnp, grad, eps):
+        p = self.metric.sample_momentum(self.rng)
+        H0 = -lnp + self.metric.kinetic(p)
+        z1, p1, g1, lnp1 = z, p, grad, lnp
+        for i in range(self.n_steps):
+            z1, p1, g1, lnp1 = yield from self._leapfrog(z1, p1, g1, eps)
+        H1 = -lnp1 + self.metric.kinetic(p1)
+        dH = H0 - H1 if np.isfinite(H1) else -np.inf
+        accept = min(1., np.exp(dH))
+        info = dict(accept=accept, n_leapfrog=self.n_steps, depth=0,
+                    diverging=-dH > self.max_energy_error, energy=H0)
+        if self.rng.uniform() < accept:
+            return z1, lnp1, g1, info
+        return z, lnp, grad, info
+
+    def _nuts_step(self, z, lnp, grad, eps):
+        p = self.metric.sample_momentum(self.rng)
+        H0 = -lnp + self.metric.kinetic(p)
+        left = right = (z, p, grad)
+        prop = (z, lnp, grad)
+        log_w = 0.
+        n_leapfrog, sum_accept, diverging = 0, 0., False
+        for depth in range(self.max_treedepth):
+            direction = 1 if self.rng.uniform() < 0.5 else -1
+            edge = right if direction > 0 else left
+            tree = yield from self._build_tree(edge, direction, depth, eps, H0)
+            n_leapfrog += tree["n"]
+            sum_accept += tree["sum_accept"]
+            if tree["diverging"]:
+                diverging = True
+                break
+            if tree["turning"]:
+                break
+            # biased progressive sampling of the proposal
+            if np.log(self.rng.uniform()) < tree["log_w"] - log_w:
+                prop = tree["prop"]
+            log_w = np.logaddexp(log_w, tree["log_w"])
+            if direction > 0:
+                right = tree["right"]
+            else:
+                left = tree["left"]
+            if self._is_turning(left, right):
+                break
+        info = dict(accept=sum_accept / max(n_leapfrog, 1), n_leapfrog=n_leapfrog,
+                    depth=depth + 1, diverging=diverging, energy=H0)
+        return prop[0], prop[1], prop[2], info
+
+    def _is_turning(self, left, right):
+        dz = right[0] - left[0]
+        return ((np.dot(dz, self.metric.velocity(left[1])) < 0) or
+                (np.dot(dz, self.metric.velocity(right[1])) < 0))
+
+    def _build_tree(self, edge, direction, depth, eps, H0):
+        if depth == 0:
+            z, p, grad = edge
+            z1, p1, g1, lnp1 = yield from self._leapfrog(z, p, grad, direction * eps)
+            H1 = -lnp1 + self.metric.kinetic(p1)
+            dH = H0 - H1 if np.isfinite(H1) else -np.inf
+            state = (z1, p1, g1)
+            return dict(left=state, right=state, prop=(z1, lnp1, g1), log_w=dH,
+                        turning=False, diverging=-dH > self.max_energy_error,
+                        sum_accept=min(1., np.exp(dH)), n=1)
+
+        t1 = yield from self._build_tree(edge, direction, depth - 1, eps, H0)
+        if t1["turning"] or t1["diverging"]:
+            return t1
+        edge = t1["right"] if direction > 0 else t1["left"]
+        t2 = yield from self._build_tree(edge, direction, depth - 1, eps, H0)
+
+        log_w = np.logaddexp(t1["log_w"], t2["log_w"])
+        prop = t1["prop"]
+        if np.log(self.rng.uniform()) < t2["log_w"] - log_w:
+            prop = t2["prop"]
+        if direction > 0:
+            left, right = t1["left"], t2["right"]
+        else:
+            left, right = t2["left"], t1["right"]
+        turning = t2["turning"] or self._is_turning(left, right)
+        return dict(left=left, right=right, prop=prop, log_w=log_w,
+                    turning=turning, diverging=t2["diverging"],
+                    sum_accept=t1["sum_accept"] + t2["sum_accept"],
+                    n=t1["n"] + t2["n"])
+
+    # --- sampling ---
+
+    def sample(self, start, n_iter=100, n_warm=100, schedule=None,
+               target_ess=None, max_iter=None, ess_params=None, max_rhat=None,
+               check_every=25, callback=None):
+        """Run warmup (with step size and, optionally, metric adaptation) and
+        then draw samples.
+
+        Parameters
+        ----------
+        start : ndarray of shape (ndim,)
+            Starting position, in the bounded (parameter) space.
+
+        n_iter : int
+            Number of samples to draw after warmup.
+
+        n_warm : int
+            Number of final warmup iterations, during which only the step size
+            is adapted.  These are not returned.
+
+        schedule : adaptation.WindowedAdaptation, optional
+            If given, the metric is adapted in the windows of this schedule
+            (with its early exit) before the final `n_warm` iterations.
+
+        target_ess : float, optional
+            If given, sampling continues past `n_iter` draws (checking every
+            `check_every` draws) until the batch-means ESS of the parameters
+            `ess_params` (default all) reaches this value and their R-hat is
+            below `max_rhat` (if given), or until `max_iter` draws.
+
+        callback : callable, optional
+            Called as `callback(i, x, info)` after every iteration (including
+            warmup), with the bounded position.
+
+        Returns
+        -------
+        result : argparse.Namespace
+            With attributes `chain` (n_draw, ndim) in the bounded space,
+            `lnp`, `accept`, `n_leapfrog`, `depth`, `diverging` (arrays of
+            shape (n_draw,)), `step_size`, `inv_metric`, `ncall`, `n_tune`,
+            `diagnostics` (see `diagnostics.ChainMonitor.summary`) and
+            `wall_time`.
+        """
+        return self._run(self._sample(start, n_iter=n_iter, n_warm=n_warm,
+                                      schedule=schedule, target_ess=target_ess,
+                                      max_iter=max_iter, ess_params=ess_params,
+                                      max_rhat=max_rhat, check_every=check_every,
+                                      callback=callback))
+
+    def _sample(self, start, n_iter=100, n_warm=100, schedule=None,
+                target_ess=None, max_iter=None, ess_params=None, max_rhat=None,
+                check_every=25, callback=None, sync=False):
+        tstart = time.time()
+        z = self.to_unbounded(np.array(start, dtype=np.float64))
+        lnp, grad = yield z
+        if not np.isfinite(lnp):
+            raise ValueError("Initial position has non-finite ln-probability")
+        eps = self.step_size or (yield from self._find_step_size(z, lnp, grad))
+        adapt = DualAverage(eps, target_accept=self.target_accept)
+
+        n_tune = 0
+        if schedule is not None:
+            for steps in schedule:
+                state, eps = yield from self._warmup((z, lnp, grad), eps, adapt, steps,
+                                                     schedule=schedule, callback=callback,
+                                                     offset=n_tune)
+                z, lnp, grad = state
+                n_tune += steps
+                self.metric.set(schedule.update())
+                adapt.restart(eps)
+
+        state, eps = yield from self._warmup((z, lnp, grad), eps, adapt, n_warm,
+                                             callback=callback, offset=n_tune)
+        z, lnp, grad = state
+        n_tune += n_warm
+        if n_warm > 0:
+            eps = adapt.final
+        self.step_size = eps
+
+        stop = None
+        if target_ess:
+            def stop(monitor):
+                return monitor.converged(target_ess, params=ess_params, max_rhat=max_rhat)
+        result = yield from self._draw(z, lnp, grad, n_iter, max_iter=max_iter, stop=stop,
+                                       check_every=check_every, callback=callback,
+                                       offset=n_tune, sync=sync)
+        result.n_tune = n_tune
+        result.wall_time = time.time() - tstart
+        return result
+
+    def _warmup(self, state, eps, adapt, n, schedule=None, callback=None, offset=0):
+        """Run `n` iterations with step size adaptation, adding the unbounded
+        positions to the metric adaptation `schedule` if given.
+        """
+        z, lnp, grad = state
+        for i in range(n):
+            z, lnp, grad, info = yield from self._transition(z, lnp, grad, eps)
+            eps = adapt.update(info["accept"])
+            if schedule is not None:
+                schedule.add(z)
+            if callback is not None:
+                callback(offset + i, self.to_bounded(z), info)
+        return (z, lnp, grad), eps
+
+    def _draw(self, z, lnp, grad, n_iter, max_iter=None, stop=None, check_every=25,
+              callback=None, offset=0, sync=False):
+        """Draw samples, stopping early if `stop(monitor)` is true.  With
+        `sync` the decision is instead made by the caller for several chains
+        at once: each draw is yielded as a `_Sync`, and the caller sends back
+        whether to stop.
+        """
+        ndim = len(z)
+        n_max = max(n_iter, max_iter or 0) if stop is not None else n_iter
+        chain = np.zeros((n_max, ndim))
+        stats = {k: np.zeros(n_max) for k in ["lnp", "accept", "n_leapfrog", "depth"]}
+        diverging = np.zeros(n_max, dtype=bool)
+        monitor = ChainMonitor(ndim)
+        n = 0
+        for i in range(n_max):
+            z, lnp, grad, info = yield from self._transition(z, lnp, grad, self.step_size)
+            chain[i] = self.to_bounded(z)
+            monitor.update(chain[i])
+            stats["lnp"][i] = lnp
+            for k in ["accept", "n_leapfrog", "depth"]:
+                stats[k][i] = info[k]
+            diverging[i] = info["diverging"]
+            n = i + 1
+            if callback is not None:
+                callback(offset + i, chain[i], info)
+            if sync and (stop is not None):
+                if (yield _Sync(chain[i].copy())):
+                    break
+            elif (stop is not None) and (n >= n_iter) and (n % check_every == 0):
+                if stop(monitor):
+                    break
+        stats = {k: v[:n] for k, v in stats.items()}
+        return Namespace(chain=chain[:n], diverging=diverging[:n], step_size=self.step_size,
+                         inv_metric=self.metric.inv_metric.copy(),
+                         ncall=self.ncall, last=(z, lnp, grad),
+                         diagnostics=monitor.summary(), **stats)
+
+
+class _Sync:
+    """Yielded by a chain in lockstep sampling at the end of each draw, in
+    place of a position to evaluate.
+    """
+
+    def __init__(self, x):
+        self.x = x
+
+
+def model_lnprob_and_grad(model):
+    """Make a function returning the ln-probability and gradient from a
+    posterior object such as `forcepho.model.GPUPosterior`, with a single
+    likelihood evaluation per call.
+    """
+    def lnprob_and_grad(x):
+        model.evaluate(x)
+        return model._lnp, model._lnp_grad
+    return lnprob_and_grad
+
+
+def loop_batch(lnprob_and_grad):
+    """Make a batched ln-probability function, taking positions of shape
+    (nchain, ndim), from a function of a single position by looping.
+    """
+    def lnprob_and_grad_batch(xs):
+        out = [lnprob_and_grad(x) for x in xs]
+        return (np.array([o[0] for o in out], dtype=np.float64),
+                np.array([o[1] for o in out], dtype=np.float64))
+    return lnprob_and_grad_batch
+
+
+def model_lnprob_and_grad_batch(model):
+    """Make a batched ln-probability function from a posterior object.  If
+    the posterior can evaluate several positions in one call it should
+    provide `evaluate_batch(xs)`, taking positions of shape (nchain, ndim)
+    and returning the ln-probabilities, shape (nchain,), and gradients, shape
+    (nchain, ndim).  Otherwise the positions are evaluated one at a time.
+    """
+    if hasattr(model, "evaluate_batch"):
+        return model.evaluate_batch
+    return loop_batch(model_lnprob_and_grad(model))
+
+
+def sample_lockstep(samplers, lnprob_and_grad_batch, starts, schedules=None,
+                    **sample_kwargs):
+    """Run several chains in lockstep, gathering the positions at which each
+    chain needs the target evaluated (one per leapfrog step) into a single
+    batched call.  Chains whose trajectories are shorter (or which finish
+    sampling earlier) drop out of a batch, so every call contains at most
+    one position per chain.
+
+    If `target_ess` is given the stopping rule is applied to all chains
+    together: each chain waits at the end of every draw until the others
+    reach the same draw, the draws are added to one `ChainMonitor` for all
+    chains, and all chains stop once the combined ESS (and R-hat, if
+    `max_rhat` is given) of the `ess_params` meets the target.  All chains
+    then have the same length.
+
+    Parameters
+    ----------
+    samplers : list of Sampler
+        One sampler per chain.  Their own `lnprob_and_grad` is not used.
+
+    lnprob_and_grad_batch : callable
+        Function of positions of shape (n, ndim) returning ln-probabilities
+        of shape (n,) and gradients of shape (n, ndim)
+
+    starts : ndarray of shape (nchain, ndim)
+        Starting positions in the bounded space.
+
+    schedules : list of adaptation.WindowedAdaptation, optional
+        Metric adaptation schedule for each chain.
+
+    sample_kwargs : optional
+        Passed to `Sampler.sample` for every chain.
+
+    Returns
+    -------
+    results : list of argparse.Namespace
+        The result of `Sampler.sample` for each chain.  The `diagnostics` of
+        each are for that chain alone.
+
+    n_batch : int
+        Number of batched calls.
+    """
+    if schedules is None:
+        schedules = [None] * len(samplers)
+    nchain = len(samplers)
+    monitor = None
+    if sample_kwargs.get("target_ess"):
+        monitor = ChainMonitor(samplers[0].metric.ndim, nchain=nchain)
+        n_iter = sample_kwargs.get("n_iter", 100)
+        check_every = sample_kwargs.get("check_every", 25)
+
+    gens = [s._sample(x0, schedule=sch, sync=monitor is not None, **sample_kwargs)
+            for s, x0, sch in zip(samplers, starts, schedules)]
+    results = [None] * nchain
+    pending, parked = {}, {}
+
+    def advance(k, value):
+        try:
+            out = gens[k].send(value) if value is not None else next(gens[k])
+        except StopIteration as stop:
+            results[k] = stop.value
+            return
+        if isinstance(out, _Sync):
+            parked[k] = out.x
+        else:
+            pending[k] = out
+
+    for k in range(nchain):
+        advance(k, None)
+    n_batch = 0
+    while pending or parked:
+        if not pending:
+            # every chain has made the same number of draws
+            monitor.update(np.array([parked[k] for k in range(nchain)]))
+            n = monitor.n
+            done = ((n >= n_iter) and (n % check_every == 0) and
+                    monitor.converged(sample_kwargs["target_ess"],
+                                      params=sample_kwargs.get("ess_params"),
+                                      max_rhat=sample_kwargs.get("max_rhat")))
+            ks, parked = list(parked.keys()), {}
+            for k in ks:
+                advance(k, done)
+            continue
+        ks = list(pending.keys())
+        xs = np.array([samplers[k].to_bounded(pending[k]) for k in ks])
+        lnp, grad = lnprob_and_grad_batch(xs)
+        n_batch += 1
+        for i, k in enumerate(ks):
+            state = samplers[k].finish(pending.pop(k), lnp[i], grad[i])
+            advance(k, state)
+    return results, n_batch
+
+
+def run_native(model, n_iter=100, n_warm=100, n_tune=None, n_start=20,
+               init_cov=None, dense=True, tol=1.5, seed=None,
+               target_ess=None, max_iter=None, max_rhat=None,
+               bounds_kwargs={}, **sampler_kwargs):
+    """Sample the posterior for the active sources of a patch with the native
+    NUTS sampler, using the same uniform priors as `mc.prior_bounds`.
+
+    Parameters
+    ----------
+    model : forcepho.model.GPUPosterior
+        The posterior object, with a `scene` attribute.
+
+    n_tune : int, optional
+        Maximum total number of warmup iterations.  If larger than `n_warm`
+        the metric is adapted in windows (see `mc.run_pymc3`) for up to
+        `n_tune - n_warm` iterations.
+
+    init_cov : ndarray, optional
+        Initial inverse mass matrix (in the transformed space).
+
+    target_ess : float, optional
+        If given, draw at least `n_iter` and at most `max_iter` samples,
+        stopping once the ESS of every flux parameter reaches this value.
+
+    Returns
+    -------
+    result : argparse.Namespace
+        See `Sampler.sample`.  Also has `lower`, `upper` and `adaptation`
+        attributes.
+    """
+    model.proposer.patch.return_residuals = False
+    lower, upper, start = scene_bounds(model.scene, **bounds_kwargs)
+    schedule = None
+    if (n_tune or 0) > n_warm:
+        schedule = WindowedAdaptation(len(lower), n_tune - n_warm, n_start=n_start,
+                                      dense=dense, init_cov=init_cov, tol=tol)
+        init_cov = schedule.cov
+    sampler = Sampler(model_lnprob_and_grad(model), lower=lower, upper=upper,
+                      inv_metric=init_cov, seed=seed, **sampler_kwargs)
+    result = sampler.sample(start, n_iter=n_iter, n_warm=n_warm, schedule=schedule,
+                            target_ess=target_ess, max_iter=max_iter, max_rhat=max_rhat,
+                            ess_params=flux_indices(model.scene.parameter_names))
+    result.lower, result.upper = lower, upper
+    result.adaptation = schedule
+    return result
@@ -7,6 +7,9 @@ import matplotlib.pyplot as pl
 
 import h5py
 
+from patch_result import PatchResult
+from projection import linear_project
+
 
 def split_patch_exp(patch):
     pixdat = ["xpix", "ypix", "data", "ierr"]
@@ -54,8 +57,8 @@ def sky_to_pix(ra, dec, group=None, patch=None, exp_idx=0, ref_coords=0.):
     if len(CW) != len(ra):
         CW = CW[0]
 
-    sky = np.array([ra, dec]).T - (crval + ref_coords)
-    pix = np.matmul(CW, sky[:, :, None])[..., 0] + crpix
+    x, y = linear_project(ra, dec, crval, crpix, CW, ref_coords=ref_coords)
+    pix = np.array([x, y]).T
 
     return pix
 
@@ -74,18 +77,10 @@ def mark_sources(ra, dec, group, ref_coords=0, ax=None,
 def show_patch(fn, exposure_inds=[0, -1], show_fixed=True, show_active=False,
                imshow_kwargs={"vmin": -0.1, "vmax": 0.5}, **extras):
 
-    disk = h5py.File(fn, "r")
-    epaths = disk["epaths"][:]
-    try:
-        active = disk["active"][:]
-    except(KeyError):
-        active = None
-    try:
-        fixed = disk["fixed"][:]
-    except(KeyError):
-        fixed = None
+    result = PatchResult(fn)
+    active, fixed = result.active, result.fixed
     try:
-        ref = disk["reference_coordinates"][:]
+        ref = result.reference_coordinates
     except(KeyError):
         ref = np.array([np.median(active["ra"]), np.median(active["dec"])])
 
@@ -93,17 +88,18 @@ def show_patch(fn, exposure_inds=[0, -1], show_fixed=True, show_active=False,
     ne = len(exposure_inds)
 
     fig, axes = pl.subplots(ne, 3, sharex="row", sharey="row", squeeze=False)
+    epaths = result.epaths
     for i, e in enumerate(exposure_inds):
-        epath = epaths[e]
-        g = disk[epath]
-        model = g["data"][:] - g["active_residual"][:]
+        xpix, ypix = result.exposure(e, "xpix"), result.exposure(e, "ypix")
+        g = result.exposure_meta(e)
+        model = result.exposure(e, "data") - result.exposure(e, "active_residual")
         for j, vtype in enumerate(vtypes):
             ax = axes[i, j]
-            show_exp(g["xpix"][:], g["ypix"][:], g[vtype][:], ax=ax, **imshow_kwargs)
+            show_exp(xpix, ypix, result.exposure(e, vtype), ax=ax, **imshow_kwargs)
             #ax.set_title(e)
         ax = axes[i, -1]
-        show_exp(g["xpix"][:], g["ypix"][:], model, ax=ax, **imshow_kwargs)
-        ee = epath.decode("utf")
+        show_exp(xpix, ypix, model, ax=ax, **imshow_kwargs)
+        ee = epaths[e]
         axes[i, 0].set_ylabel(" ".join(ee.replace(".flx", "").split("_")[-3:]))
 
         if show_active and (active is not None):
@@ -121,7 +117,7 @@ def show_patch(fn, exposure_inds=[0, -1], show_fixed=True, show_active=False,
     if active is not None:
         fig.suptitle(ti.format(active[0]["source_index"], active[0]["ra"], active[0]["dec"]))
     pl.show()
-    return fig, axes, disk
+    return fig, axes, result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""spatial.py
+
+A spatial index over celestial coordinates of a source catalog, for fast
+region and neighbor queries.  Coordinates are converted to unit vectors on
+the sphere and stored in a KD-tree, so that angular distances can be
+converted to (exact) chord lengths.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+__all__ = ["SourceIndex", "radec_to_xyz",
+           "chord_to_angle", "angle_to_chord"]
+
+
+def radec_to_xyz(ra, dec):
+    """Convert celestial coordinates to unit vectors.
+
+    Parameters
+    ----------
+    ra : ndarray of shape (n,)
+        Right ascension in degrees
+
+    dec : ndarray of shape (n,)
+        Declination in degrees
+
+    Returns
+    -------
+    xyz : ndarray of shape (n, 3)
+    """
+    ra, dec = np.deg2rad(np.atleast_1d(ra)), np.deg2rad(np.atleast_1d(dec))
+    cd = np.cos(dec)
+    return np.array([cd * np.cos(ra), cd * np.sin(ra), np.sin(dec)]).T
+
+
+def angle_to_chord(radius):
+    """Convert an angular separation in degrees to a chord length on the unit
+    sphere.
+    """
+    return 2 * np.sin(np.deg2rad(np.minimum(radius, 180.)) / 2.)
+
+
+def chord_to_angle(chord):
+    """Convert a chord length on the unit sphere to an angular separation in
+    degrees.
+    """
+    return np.rad2deg(2 * np.arcsin(np.clip(chord / 2., 0, 1)))
+
+
+class SourceIndex:
+    """KD-tree index over the positions of a catalog.  Built once, it answers
+    cone, rectangle, and k-nearest-neighbor queries in logarithmic time.
+    All returned indices refer to rows of the catalog used to build the index.
+
+    Parameters
+    ----------
+    ra : ndarray of shape (n_sources,)
+        Right ascension in degrees
+
+    dec : ndarray of shape (n_sources,)
+        Declination in degrees
+
+    leafsize : int, optional (default: 32)
+        Passed to `scipy.spatial.cKDTree`
+    """
+
+    def __init__(self, ra, dec, leafsize=32):
+        self.ra = np.array(ra, dtype=np.float64)
+        self.dec = np.array(dec, dtype=np.float64)
+        self.tree = cKDTree(radec_to_xyz(self.ra, self.dec),
+                            leafsize=leafsize)
+
+    @classmethod
+    def from_sourcecat(cls, sourcecat, **kwargs):
+        """Build an index from a structured array with "ra" and "dec" fields
+        (e.g. a `sourcecat`)
+        """
+        return cls(sourcecat["ra"], sourcecat["dec"], **kwargs)
+
+    def __len__(self):
+        return len(self.ra)
+
+    def within_radius(self, ra, dec, radius):
+        """Find all sources within `radius` of a position
+
+        Parameters
+        ----------
+        ra, dec : float
+            Center of the search, in degrees
+
+        radius : float
+            Search radius in degrees
+
+        Returns
+        -------
+        inds : ndarray of int
+            Sorted indices of the sources within the cone.
+        """
+        xyz = radec_to_xyz(ra, dec)[0]
+        inds = self.tree.query_ball_point(xyz, angle_to_chord(radius))
+        return np.sort(np.array(inds, dtype=int))
+
+    def within_rectangle(self, ra_min, ra_max, dec_min, dec_max):
+        """Find all sources within a rectangle in celestial coordinates.
+        The rectangle may not cross ra=0.
+
+        Returns
+        -------
+        inds : ndarray of int
+            Sorted indices of the sources within the rectangle.
+        """
+        # query the circumscribed cone, then cut exactly
+        ra0, dec0 = (ra_min + ra_max) / 2., (dec_min + dec_max) / 2.
+        corners = radec_to_xyz([ra_min, ra_min, ra_max, ra_max],
+                               [dec_min, dec_max, dec_min, dec_max])
+        center = radec_to_xyz(ra0, dec0)[0]
+        chord = np.sqrt(((corners - center)**2).sum(axis=-1)).max()
+        inds = self.tree.query_ball_point(center, chord * (1 + 1e-12))
+        inds = np.array(inds, dtype=int)
+        ra, dec = self.ra[inds], self.dec[inds]
+        sel = ((ra >= ra_min) & (ra <= ra_max) &
+               (dec >= dec_min) & (dec <= dec_max))
+        return np.sort(inds[sel])
+
+    def nearest(self, ra, dec, k=1, max_radius=np.inf):
+        """Find the `k` nearest sources to each of a set of positions.
+
+        Parameters
+        ----------
+        ra, dec : float or ndarray of shape (n,)
+            Query positions, in degrees
+
+        k : int, optional (default: 1)
+            Number of neighbors to return
+
+        max_radius : float, optional
+            Maximum separation in degrees.  Missing neighbors are given
+            index `len(self)` and infinite separation.
+
+        Returns
+        -------
+        inds : ndarray of int, shape (n, k)
+            Indices of the neighbors, in order of increasing separation.
+
+        sep : ndarray of float, shape (n, k)
+            Separations in degrees.
+        """
+        xyz = radec_to_xyz(ra, dec)
+        ub = angle_to_chord(max_radius) if np.isfinite(max_radius) else np.inf
+        chord, inds = self.tree.query(xyz, k=[i + 1 for i in range(k)],
+                                      distance_upper_bound=ub)
+        sep = np.where(np.isfinite(chord), chord_to_angle(chord), np.inf)
+        return inds, sep
@@ -12,6 +12,22 @@ from argparse import Namespace
 
 # parent side
 from forcepho.dispatcher import SuperScene, MPIQueue
+from catalog import to_compact, from_compact
+from massmatrix import MassMatrixStore
+
+
+def pack_sources(cat, reference):
+    """Convert a sourcecat block to the compact layout for sending"""
+    if cat is None:
+        return None
+    return to_compact(cat, reference=reference)[0]
+
+
+def unpack_sources(cat, reference):
+    """Convert a received compact block back to the sourcecat layout"""
+    if cat is None:
+        return None
+    return from_compact(cat, reference)
 
 
 # child side
@@ -22,6 +38,8 @@ def do_work(region, active, fixed, mm):
     result.niter = 75
     result.active = active
     result.fixed = fixed
+    # pretend we tuned a metric; see `massmatrix.extract`
+    result.mass_matrix = mm
     return result
 
 
@@ -49,6 +67,9 @@ if __name__ == "__main__":
         patchcat = {}
         # Make Queue
         queue = MPIQueue(comm, config.nchildren)
+        # Per-source metric store, shipped with each patch
+        nparam = len(config.bandlist) + 6
+        massDB = MassMatrixStore(nparam, filename=config.mass_matrix_file or None)
         with SuperScene(config.initial_catalog) as sceneDB:
             # LOOP
             patchid = 0
@@ -65,11 +86,14 @@ if __name__ == "__main__":
                     # keep asking for patches until a valid one is found
                     while active is None:
                         region, active, fixed = sceneDB.checkout_region()
-                        mass = None  # TODO: this should be returned by the superscene
                         n += 1
                         patchid += 1
-                    # construct the task
-                    chore = (region, (active, fixed, mass))
+                    mass = massDB.checkout(active["source_index"])
+                    # construct the task, using the compact catalog layout
+                    # referenced to the region center to shrink the message
+                    ref = np.array([region.ra, region.dec])
+                    chore = (region, (pack_sources(active, ref),
+                                      pack_sources(fixed, ref), mass))
                     patchcat[patchid] = {"ra": region.ra,
                                          "dec": region.dec,
                                          "radius": region.radius,
@@ -87,10 +111,14 @@ if __name__ == "__main__":
 
                 # collect from a single child and set it idle
                 c, result = queue.collect_one()
+                ref = np.array([result.region.ra, result.region.dec])
+                result.active = unpack_sources(result.active, ref)
+                result.fixed = unpack_sources(result.fixed, ref)
                 #print(result)
                 # TODO: Log the collection
                 sceneDB.checkin_region(result.active, result.fixed,
                                        result.niter, mass_matrix=None)
+                massDB.checkin(result.mass_matrix)
 
                 # End criterion
                 end = len(queue.idle) == queue.n_children
@@ -99,6 +127,9 @@ if __name__ == "__main__":
                     print("finished in {}s".format(ttotal))
                     break
 
+        if config.mass_matrix_file:
+            massDB.save()
+
         import json
         with open(config.patchlogfile, "w") as f:
             json.dump(patchcat, f)
@@ -120,6 +151,9 @@ if __name__ == "__main__":
 
             region, cats = task
             active, fixed, mm = cats
+            ref = np.array([region.ra, region.dec])
+            active = unpack_sources(active, ref)
+            fixed = unpack_sources(fixed, ref)
             patchid = status.tag
             #log.log(_VERBOSE, "Child {} received {} with tag {}".format(child, region.ra, status.tag))
             print("Child {} received {} with tag {}".format(child, region.ra, patchid))
@@ -127,6 +161,9 @@ if __name__ == "__main__":
             result = do_work(region, active, fixed, mm)
             print(result.active["n_iter"].min(), result.active["n_iter"].max())
             # develop the payload
+            result.region = region
+            result.active = pack_sources(result.active, ref)
+            result.fixed = pack_sources(result.fixed, ref)
             payload = result
 
             # send to parent, free GPU memory
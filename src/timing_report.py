@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""timing_report.py - Summarize the stage timing stored in patch outputs
+across a run.
+
+usage: python timing_report.py "output/patch*.h5"
+       python timing_report.py <run store directory>
+"""
+
+import os, sys, glob
+import numpy as np
+
+from utils import read_timing, timing_summary
+from runstore import RunStore
+
+
+if __name__ == "__main__":
+
+    if os.path.isdir(sys.argv[1]):
+        files = RunStore(sys.argv[1])
+    else:
+        files = sorted(glob.glob(sys.argv[1]))
+    tables = read_timing(files)
+    summary = timing_summary(tables, percentiles=[50, 90, 99])
+
+    print("{} patches with timing".format(len(tables)))
+    hdr = "{:40s} {:>8s} {:>10s} {:>12s} {:>10s} {:>10s} {:>10s}"
+    row = "{:40s} {:8d} {:10d} {:12.2f} {:10.3f} {:10.3f} {:10.3f}"
+    print(hdr.format("stage", "n_patch", "count", "total (s)", "p50", "p90", "p99"))
+    for s in summary[np.argsort(summary["total"])[::-1]]:
+        print(row.format(s["name"].decode("utf-8"), s["n_patch"], s["count"],
+                         s["total"], s["p50"], s["p90"], s["p99"]))
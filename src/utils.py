@@ -1,30 +1,200 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import numpy as np
 import time
+import atexit
+import threading
+import queue
+from argparse import Namespace
+from contextlib import contextmanager
+from functools import wraps
 import h5py
 
 
-__all__ = ["Logger", "dump_to_h5"]
+__all__ = ["Logger", "timing_summary", "read_timing", "dump_to_h5", "write_patch", "read_packed", "ResultWriter"]
+
+
+# dtype of the timing table produced by Logger.span_table
+SPAN_DTYPE = np.dtype([("name", "S128"), ("depth", np.int16),
+                       ("start", np.float64), ("duration", np.float64),
+                       ("count", np.int64), ("mem_delta", np.float64)])
+
+
+def _rss():
+    """Current resident set size of this process in MB, or nan"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024.**2
+    except(IOError, OSError, ValueError, IndexError):
+        return np.nan
+
+
+class Span:
+    """A single timed span, as recorded by `Logger.span`.  The `count`
+    attribute can be set inside the span (e.g. to the number of likelihood
+    calls) and is stored with the timing.
+    """
+
+    def __init__(self, name, depth, start, count=1):
+        self.name = name
+        self.depth = depth
+        self.start = start
+        self.duration = np.nan
+        self.count = count
+        self.mem_delta = np.nan
 
 
 class Logger:
+    """Collect log messages, and timing information for nested stages.
 
-    def __init__(self, name):
+    Parameters
+    ----------
+    name : string
+        Name of the logger
+
+    handler : logging.Logger, optional
+        If given, messages are also passed to this logger's `info` method.
+
+    memory : bool, optional (default: False)
+        Whether to record the change in resident memory over each span.
+    """
+
+    def __init__(self, name, handler=None, memory=False):
         self.name = name
         self.comments = []
+        self.handler = handler
+        self.memory = memory
+        self.spans = []
+        self._stack = []
+        self._t0 = time.perf_counter()
 
     def info(self, message, timetag=None):
         if timetag is None:
             timetag = time.strftime("%y%b%d-%H.%M", time.localtime())
 
         self.comments.append((message, timetag))
+        if self.handler is not None:
+            self.handler.info(message)
 
     def serialize(self):
         log = "\n".join([c[0] for c in self.comments])
         return log
 
+    @contextmanager
+    def span(self, name, count=1):
+        """Time a stage with a high-resolution clock.  Spans may be nested;
+        the recorded name of a nested span is the "/" separated path of the
+        enclosing span names.
+
+        >>> with logger.span("sample") as sp:
+        ...     trace = pm.sample(...)
+        ...     sp.count = model.ncall
+        """
+        path = "/".join([s.name for s in self._stack] + [name])
+        sp = Span(path, len(self._stack), time.perf_counter() - self._t0, count=count)
+        self._stack.append(Span(name, 0, 0))
+        m0 = _rss() if self.memory else np.nan
+        try:
+            yield sp
+        finally:
+            sp.duration = time.perf_counter() - self._t0 - sp.start
+            sp.mem_delta = _rss() - m0
+            self._stack.pop()
+            self.spans.append(sp)
+
+    def timed(self, name=None):
+        """Decorator that times every call of the decorated function as a
+        span, named after the function by default.
+        """
+        def decorator(func):
+            sname = name or func.__name__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(sname):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def span_table(self):
+        """Get the recorded spans, in order of completion, as a structured
+        array suitable for storing with the patch output (e.g. as the "timing"
+        entry of `otherdatadict` in `dump_to_h5`).  Start times are in seconds
+        since the creation of the logger.
+        """
+        table = np.zeros(len(self.spans), dtype=SPAN_DTYPE)
+        for c in table.dtype.names:
+            table[c] = [getattr(sp, c) for sp in self.spans]
+        return table
+
+
+def timing_summary(tables, percentiles=[50, 90, 99]):
+    """Aggregate timing tables from many patches into per-stage statistics.
+
+    Parameters
+    ----------
+    tables : list of structured ndarrays
+        Timing tables from `Logger.span_table`, e.g. the "timing" datasets of
+        many patch output files (see `read_timing`).
+
+    percentiles : list of float, optional
+        Percentiles of the per-patch duration of each stage to compute.
+
+    Returns
+    -------
+    summary : structured ndarray
+        One row per stage name, with the number of patches and calls, the
+        total duration, and the requested percentiles of the duration
+        (columns "p50", etc.), all in seconds.
+    """
+    tables = [t for t in tables if t is not None and len(t)]
+    if len(tables):
+        allspans = np.concatenate([np.array(t, dtype=SPAN_DTYPE) for t in tables])
+    else:
+        allspans = np.zeros(0, dtype=SPAN_DTYPE)
+    pid = np.repeat(np.arange(len(tables)), [len(t) for t in tables])
+    names = np.unique(allspans["name"])
+    cols = [("name", "S128"), ("n_patch", np.int64), ("count", np.int64),
+            ("total", np.float64)]
+    cols += [("p{:g}".format(p), np.float64) for p in percentiles]
+    summary = np.zeros(len(names), dtype=np.dtype(cols))
+    for i, n in enumerate(names):
+        sel = allspans["name"] == n
+        # sum repeated spans within each patch before taking percentiles
+        ids, inv = np.unique(pid[sel], return_inverse=True)
+        per_patch = np.bincount(inv, weights=allspans["duration"][sel])
+        summary[i]["name"] = n
+        summary[i]["n_patch"] = len(ids)
+        summary[i]["count"] = allspans["count"][sel].sum()
+        summary[i]["total"] = per_patch.sum()
+        for p in percentiles:
+            summary[i]["p{:g}".format(p)] = np.percentile(per_patch, p)
+    return summary
+
+
+def read_timing(filenames, name="timing"):
+    """Read the timing tables from a list of patch output files, or from the
+    complete patches of a `runstore.RunStore`.  Patches without timing
+    information are skipped.
+    """
+    tables = []
+    if hasattr(filenames, "open_patch"):
+        store = filenames
+        idx = store.index(refresh=True)
+        for patchid in idx["patchid"][idx["complete"]]:
+            with store.open_patch(patchid) as g:
+                if name in g:
+                    tables.append(g[name][:])
+        return tables
+    for fn in filenames:
+        with h5py.File(fn, "r") as disk:
+            if name in disk:
+                tables.append(disk[name][:])
+    return tables
+
 
 def _make_imset(out, paths, name, arrs):
     for i, epath in enumerate(paths):
@@ -39,21 +209,76 @@ def _make_imset(out, paths, name, arrs):
             print("Could not make {}/{} dataset from {}".format(epath, name, arrs[i]))
 
 
+def _make_packed(out, name, arrs, compression="gzip"):
+    """Concatenate a list of per-exposure arrays into a single chunked,
+    compressed dataset.
+    """
+    data = np.concatenate([np.atleast_1d(np.array(a)) for a in arrs])
+    kw = {}
+    if (compression is not None) and (data.size > 0):
+        kw = dict(chunks=True, shuffle=True, compression=compression)
+    try:
+        out.create_dataset(name, data=data, **kw)
+    except(TypeError, ValueError):
+        print("Could not make packed {} dataset".format(name))
+
+
 def dump_to_h5(filename, patch, active=None, fixed=None,
-               pixeldatadict={}, otherdatadict={}):
+               pixeldatadict={}, otherdatadict={}, layout="groups",
+               compression="gzip"):
     """Dump patch data and scene data to an HDF5 file
+
+    Parameters
+    ----------
+    layout : string, optional (default: "groups")
+        If "groups", write one HDF5 group per exposure path, each holding one
+        dataset per pixel or meta quantity.  If "packed", write one contiguous
+        dataset per quantity under the "pixels" and "meta" groups, indexed by
+        the `exposure_start` and `exposure_N` datasets.  Use `read_packed` to
+        get per-exposure arrays back.
+
+    compression : string or None, optional (default: "gzip")
+        Compression filter ("gzip" or "lzf") applied, with the shuffle filter,
+        to the packed datasets.  Only used if `layout` is "packed".
+    """
+    with h5py.File(filename, "w") as out:
+        write_patch(out, patch, active=active, fixed=fixed,
+                    pixeldatadict=pixeldatadict, otherdatadict=otherdatadict,
+                    layout=layout, compression=compression)
+
+
+def write_patch(out, patch, active=None, fixed=None,
+                pixeldatadict={}, otherdatadict={}, layout="groups",
+                compression="gzip"):
+    """Write patch data and scene data into an open HDF5 file or group.  See
+    `dump_to_h5` for a description of the parameters.
     """
     pix = ["xpix", "ypix", "ierr"]
     meta = ["D", "CW", "crpix", "crval"]
-    with h5py.File(filename, "w") as out:
+    out.attrs["reference_coordinates"] = np.array(patch.patch_reference_coordinates)
+    out.attrs["bandlist"] = np.array(patch.bandlist, dtype="S")
+    out.attrs["layout"] = layout
 
-        out.attrs["reference_coordinates"] = np.array(patch.patch_reference_coordinates)
-        out.attrs["bandlist"] = np.array(patch.bandlist, dtype="S")
+    out.create_dataset("epaths", data=np.array(patch.epaths, dtype="S"))
+    #out.create_dataset("bandlist", data=np.array(patch.bandlist, dtype="S"))
 
-        out.create_dataset("epaths", data=np.array(patch.epaths, dtype="S"))
-        #out.create_dataset("bandlist", data=np.array(patch.bandlist, dtype="S"))
+    if layout == "packed":
+        # starts are with respect to the packed (unpadded) pixel arrays
+        npix = np.array(patch.exposure_N)
+        out.create_dataset("exposure_start", data=np.cumsum(npix) - npix)
+        out.create_dataset("exposure_N", data=npix)
+        pixels = out.create_group("pixels")
+        for a in pix:
+            arr = getattr(patch, a)
+            _make_packed(pixels, a, [arr[:npix.sum()]], compression=compression)
+        for a, pdat in pixeldatadict.items():
+            _make_packed(pixels, a, pdat, compression=compression)
+        mgroup = out.create_group("meta")
+        for a in meta:
+            arr = np.array(getattr(patch, a))
+            mgroup.create_dataset(a, data=arr)
+    else:
         out.create_dataset("exposure_start", data=patch.exposure_start)
-
         for band in patch.bandlist:
             g = out.create_group(band)
 
@@ -69,10 +294,169 @@ def dump_to_h5(filename, patch, active=None, fixed=None,
         for a, pdat in pixeldatadict.items():
             _make_imset(out, patch.epaths, a, pdat)
 
-        for a, arr in otherdatadict.items():
-            out.create_dataset(a, data=arr)
+    for a, arr in otherdatadict.items():
+        out.create_dataset(a, data=arr)
+
+    if active is not None:
+        out.create_dataset("active", data=np.array(active))
+    if fixed is not None:
+        out.create_dataset("fixed", data=np.array(fixed))
+
+
+def read_packed(disk, name):
+    """Read a pixel or meta quantity from a file written with the "packed"
+    layout of `dump_to_h5`, split into exposures.
+
+    Parameters
+    ----------
+    disk : h5py.File
+        The open output file.
+
+    name : string
+        Name of the quantity, e.g. "xpix", "ierr", "active_residual", or "CW"
+
+    Returns
+    -------
+    arrs : list of ndarrays
+        One array per exposure, in the order of the "epaths" dataset.  For
+        pixel quantities these are views into a single array read from disk.
+    """
+    if name in disk["meta"]:
+        return list(disk["meta"][name][:])
+    data = disk["pixels"][name][:]
+    start, npix = disk["exposure_start"][:], disk["exposure_N"][:]
+    return [data[s:s + n] for s, n in zip(start, npix)]
+
+
+# attributes of a patch that are used by dump_to_h5
+PATCH_ATTRS = ["patch_reference_coordinates", "bandlist", "epaths",
+               "exposure_start", "exposure_N",
+               "xpix", "ypix", "ierr", "D", "CW", "crpix", "crval"]
+
+
+def snapshot_patch(patch):
+    """Copy the patch attributes used by `dump_to_h5` so that the patch
+    object can be reused (e.g. rebuilt for the next region) while the copy
+    is written.
+    """
+    snap = Namespace()
+    for a in PATCH_ATTRS:
+        v = getattr(patch, a)
+        if isinstance(v, np.ndarray):
+            v = v.copy()
+        elif isinstance(v, list):
+            v = list(v)
+        setattr(snap, a, v)
+    return snap
+
+
+class ResultWriter:
+    """Write patch results with `dump_to_h5` from a background thread, so that
+    the caller can start work on the next patch while the previous one is
+    being serialized.
+
+    Pending writes are held in a bounded queue; `submit` blocks when the queue
+    is full.  The writer takes ownership of the arrays passed to `submit`,
+    which must not be modified afterwards.  The patch itself is copied.
+
+    Errors raised in the background thread are re-raised in the caller at the
+    next call to `submit`, `flush`, or `close`.  Pending writes are flushed on
+    `close`, when used as a context manager, and at interpreter exit.
+
+    Parameters
+    ----------
+    maxsize : int, optional (default: 2)
+        Maximum number of pending results.
+
+    logger : optional
+        If given, an object with an `info` method used to report each write.
+    """
+
+    def __init__(self, maxsize=2, logger=None):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.logger = logger
+        self.latency = []
+        self.max_depth = 0
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def depth(self):
+        """Number of results waiting to be written."""
+        return self.queue.qsize()
+
+    def submit(self, filename, patch, active=None, fixed=None,
+               pixeldatadict={}, otherdatadict={}, **kwargs):
+        """Queue a result for writing.  Arguments are as for `dump_to_h5`.
+        """
+        self._raise()
+        if self._closed:
+            raise RuntimeError("ResultWriter is closed")
+        item = (filename, snapshot_patch(patch), active, fixed,
+                dict(pixeldatadict), dict(otherdatadict), kwargs)
+        self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.depth)
+
+    def flush(self):
+        """Block until all queued results have been written."""
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        """Flush pending results and stop the background thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self._thread.join()
+        atexit.unregister(self.close)
+        self._raise()
+
+    def stats(self):
+        """Summarize the writes done so far.
+
+        Returns
+        -------
+        stats : dict
+            Number of results written, mean and max write latency in seconds,
+            and the maximum observed queue depth.
+        """
+        lat = np.array(self.latency)
+        return dict(n_written=len(lat),
+                    mean_latency=lat.mean() if len(lat) else 0.,
+                    max_latency=lat.max() if len(lat) else 0.,
+                    max_depth=self.max_depth)
+
+    def _raise(self):
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise RuntimeError("Background write failed") from err
 
-        if active is not None:
-            out.create_dataset("active", data=np.array(active))
-        if fixed is not None:
-            out.create_dataset("fixed", data=np.array(fixed))
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            filename, patch, active, fixed, pixr, extra, kwargs = item
+            try:
+                t = time.perf_counter()
+                dump_to_h5(filename, patch, active, fixed,
+                           pixeldatadict=pixr, otherdatadict=extra, **kwargs)
+                self.latency.append(time.perf_counter() - t)
+                if self.logger is not None:
+                    self.logger.info("wrote {} in {:.3f}s".format(filename, self.latency[-1]))
+            except(Exception) as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                self.queue.task_done()
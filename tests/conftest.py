@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+"""Put the flat modules of src/ on the path, as the scripts in cannon/ do."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
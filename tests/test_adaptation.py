@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from adaptation import (WelfordCovariance, WindowedAdaptation, metric_distance,
+                        regularize_covariance, window_schedule)
+
+
+def correlated_gaussian(ndim, seed=0):
+    rng = np.random.default_rng(seed)
+    a = rng.standard_normal((ndim, ndim)) / np.sqrt(ndim) + np.eye(ndim)
+    return np.dot(a, a.T)
+
+
+def run_schedule(cov, n_adapt, n_start, dense=True, shrink=1.0, seed=1):
+    """Feed independent draws from N(0, cov) to a schedule, scaling the
+    draws of each successive window by `shrink`.
+    """
+    rng = np.random.default_rng(seed)
+    chol = np.linalg.cholesky(cov)
+    schedule = WindowedAdaptation(len(cov), n_adapt, n_start=n_start, dense=dense)
+    for i, w in enumerate(schedule):
+        z = np.dot(rng.standard_normal((w, len(cov))), chol.T) * shrink**i
+        for x in z:
+            schedule.add(x)
+        schedule.update()
+    return schedule
+
+
+def test_window_schedule():
+    windows = window_schedule(1000, n_start=50)
+    assert windows.sum() == 1000
+    assert np.all(windows[1:-1] == 2 * windows[:-2])
+
+
+def test_early_exit_fires_for_stationary_gaussian():
+    cov = correlated_gaussian(5)
+    schedule = run_schedule(cov, 3000, 50)
+    assert schedule.converged
+    assert schedule.n_windows == schedule.min_windows
+    assert schedule.n_saved > 0
+    assert metric_distance(cov, schedule.cov) < 0.3
+
+
+def test_early_exit_diagonal():
+    cov = correlated_gaussian(20)
+    schedule = run_schedule(cov, 3000, 20, dense=False)
+    assert schedule.converged
+    assert metric_distance(np.diag(cov), schedule.cov) < 0.3
+
+
+def test_no_exit_while_metric_changes():
+    cov = correlated_gaussian(5)
+    schedule = run_schedule(cov, 3000, 50, shrink=0.5)
+    assert not schedule.converged
+    assert schedule.n_saved == 0
+
+
+def test_no_test_for_short_dense_windows():
+    # windows shorter than min_ratio * ndim are not compared
+    ndim = 45
+    schedule = run_schedule(correlated_gaussian(ndim), 3000, 20)
+    n_compared = schedule.windows[:len(schedule.distances)]
+    short = n_compared < schedule.min_ratio * ndim
+    assert short.any()
+    assert np.all(np.isnan(np.array(schedule.distances)[short]))
+    assert schedule.n_windows > short.sum() + 1
+
+
+def welford_samples(n=500, ndim=4, seed=3):
+    rng = np.random.default_rng(seed)
+    # large offset to check the numerical stability of the updates
+    return 1e6 + np.dot(rng.standard_normal((n, ndim)), np.linalg.cholesky(correlated_gaussian(ndim)).T)
+
+
+def test_welford_update_matches_numpy():
+    x = welford_samples()
+    for dense in [True, False]:
+        acc = WelfordCovariance(x.shape[1], dense=dense)
+        for row in x:
+            acc.update(row)
+        expected = np.cov(x.T) if dense else x.var(axis=0, ddof=1)
+        assert acc.n == len(x)
+        assert np.allclose(acc.mean, x.mean(axis=0), rtol=0, atol=1e-8)
+        assert np.allclose(acc.covariance(), expected, rtol=1e-8, atol=1e-10)
+
+
+def test_welford_update_batch_matches_numpy():
+    x = welford_samples()
+    for dense in [True, False]:
+        acc = WelfordCovariance(x.shape[1], dense=dense)
+        acc.update(x[0])
+        for lo, hi in [(1, 7), (7, 8), (8, 8), (8, 200), (200, len(x))]:
+            acc.update_batch(x[lo:hi])
+        expected = np.cov(x.T) if dense else x.var(axis=0, ddof=1)
+        assert acc.n == len(x)
+        assert np.allclose(acc.covariance(), expected, rtol=1e-8, atol=1e-10)
+        assert np.allclose(acc.covariance(regularize=True),
+                           regularize_covariance(expected, len(x)), rtol=1e-8)
+
+
+def test_welford_reset():
+    acc = WelfordCovariance(2)
+    acc.update_batch(welford_samples(ndim=2))
+    acc.reset()
+    assert acc.n == 0
+    with pytest.raises(ValueError):
+        acc.covariance()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from catalog import catalog_cache_key
+
+
+def test_catalog_cache_key(tmp_path):
+    fn = str(tmp_path / "cat.fits")
+    with open(fn, "wb") as f:
+        f.write(b"x" * 1000)
+    key = catalog_cache_key(fn, rotate=False)
+    assert key == catalog_cache_key(fn, rotate=False)
+    assert key != catalog_cache_key(fn, rotate=True)
+    full = catalog_cache_key(fn, full_hash=True, rotate=False)
+    assert full != key
+
+    # a change of modification time changes the stat key, not the full hash
+    st = os.stat(fn)
+    os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert catalog_cache_key(fn, rotate=False) != key
+    assert catalog_cache_key(fn, full_hash=True, rotate=False) == full
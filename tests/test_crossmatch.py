@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from crossmatch import match_nearest, match_within, match_one_to_one
+
+
+ARCSEC = 1. / 3600
+
+
+def offset(ra, dec, dra_arcsec, ddec_arcsec):
+    """Shift positions by small on-sky offsets in arcseconds."""
+    return (ra + dra_arcsec * ARCSEC / np.cos(np.deg2rad(dec)),
+            dec + ddec_arcsec * ARCSEC)
+
+
+def test_match_nearest_known_pairs():
+    rng = np.random.default_rng(5)
+    ra1 = rng.uniform(53.0, 53.1, 50)
+    dec1 = rng.uniform(-27.85, -27.75, 50)
+    # the second catalog is a shuffled, jittered copy plus unrelated sources
+    perm = rng.permutation(50)
+    ra2, dec2 = offset(ra1[perm], dec1[perm], *rng.normal(0, 0.05, (2, 50)))
+    ra2 = np.concatenate([ra2, [54.0, 54.1]])
+    dec2 = np.concatenate([dec2, [-27.0, -27.1]])
+    # and the first catalog has a source without a counterpart
+    ra1, dec1 = np.append(ra1, 52.5), np.append(dec1, -28.)
+
+    inds, sep = match_nearest(ra1, dec1, ra2, dec2, tolerance=0.5 * ARCSEC)
+    assert np.array_equal(inds[:50], np.argsort(perm))
+    assert np.all(sep[:50] < 0.5 * ARCSEC)
+    assert inds[50] == -1 and np.isinf(sep[50])
+
+    # without a tolerance everything is matched
+    inds, sep = match_nearest(ra1, dec1, ra2, dec2)
+    assert np.all(inds >= 0) and np.all(np.isfinite(sep))
+
+
+def test_match_within():
+    ra1, dec1 = np.array([10., 10.01, 200.]), np.array([0., 0., 45.])
+    ra2 = np.array([10., 10.0001, 10.0102, 200.5])
+    dec2 = np.array([0., 0., 0., 45.])
+    i1, i2, sep = match_within(ra1, dec1, ra2, dec2, radius=0.005)
+    # source 0 has two neighbors sorted by separation, 2 has none
+    assert i1.tolist() == [0, 0, 1]
+    assert i2.tolist() == [0, 1, 2]
+    assert np.allclose(sep, [0, 0.0001, 0.0002], atol=1e-9)
+
+
+def test_match_one_to_one_competing_claims():
+    # two sources in catalog 1 both have catalog-2 source 0 as their nearest
+    # neighbor; only the closer one keeps it and the other falls back to its
+    # next best candidate
+    ra1 = np.array([150., 150. + 0.3 * ARCSEC, 151.])
+    dec1 = np.array([2., 2., 2.])
+    ra2 = np.array([150. + 0.1 * ARCSEC, 150. + 0.9 * ARCSEC, 152.])
+    dec2 = np.array([2., 2., 2.])
+    i1, i2, sep = match_one_to_one(ra1, dec1, ra2, dec2, tolerance=1 * ARCSEC)
+    assert i1.tolist() == [0, 1]
+    assert i2.tolist() == [0, 1]
+    assert np.allclose(sep * 3600, [0.1, 0.6], atol=1e-3)
+
+    # with a tighter tolerance the loser is left unmatched
+    i1, i2, sep = match_one_to_one(ra1, dec1, ra2, dec2, tolerance=0.5 * ARCSEC)
+    assert i1.tolist() == [0] and i2.tolist() == [0]
+
+    # the result is one-to-one in both directions
+    rng = np.random.default_rng(2)
+    ra1, dec1 = rng.uniform(0, 0.01, 300), rng.uniform(0, 0.01, 300)
+    ra2, dec2 = rng.uniform(0, 0.01, 200), rng.uniform(0, 0.01, 200)
+    i1, i2, sep = match_one_to_one(ra1, dec1, ra2, dec2, tolerance=2 * ARCSEC)
+    assert len(np.unique(i1)) == len(i1) and len(np.unique(i2)) == len(i2)
+    assert np.all(sep <= 2 * ARCSEC)
+
+    # nothing to match
+    i1, i2, sep = match_one_to_one(ra1, dec1, ra2 + 10, dec2, tolerance=ARCSEC)
+    assert len(i1) == len(i2) == len(sep) == 0
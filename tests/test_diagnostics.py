@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from diagnostics import ChainMonitor, chain_diagnostics, flux_indices, source_diagnostics
+
+
+def ar1(n, ndim, phi, nchain=1, seed=0):
+    """AR(1) chains with unit stationary variance, whose ESS is
+    n (1 - phi) / (1 + phi).
+    """
+    rng = np.random.default_rng(seed)
+    eps = rng.standard_normal((nchain, n, ndim)) * np.sqrt(1 - phi**2)
+    x = np.zeros((nchain, n, ndim))
+    x[:, 0] = rng.standard_normal((nchain, ndim))
+    for i in range(1, n):
+        x[:, i] = phi * x[:, i - 1] + eps[:, i]
+    return x
+
+
+def test_online_matches_batch():
+    chain = ar1(3000, 3, 0.6, nchain=2)
+    monitor = ChainMonitor(3, nchain=2)
+    for i in range(chain.shape[1]):
+        monitor.update(chain[:, i])
+    summary = chain_diagnostics(chain)
+    assert np.allclose(monitor.ess(), summary["ess"])
+    assert np.allclose(monitor.rhat(), summary["rhat"])
+    assert summary["n_draws"] == 6000
+    # batches have been merged, so memory did not grow with the chain
+    assert monitor.batch_size > 5
+
+
+def test_ess_ar1():
+    n, phi, ndim = 20000, 0.5, 16
+    chain = ar1(n, ndim, phi, seed=1)
+    ess = chain_diagnostics(chain[0])["ess"]
+    expected = n * (1 - phi) / (1 + phi)
+    assert abs(ess.mean() / expected - 1) < 0.15
+    assert np.all(ess <= n)
+
+
+def test_ess_sums_over_chains():
+    n, phi = 8000, 0.3
+    chain = ar1(n, 16, phi, nchain=4, seed=2)
+    ess = chain_diagnostics(chain)["ess"]
+    expected = 4 * n * (1 - phi) / (1 + phi)
+    assert abs(ess.mean() / expected - 1) < 0.15
+
+
+def test_rhat():
+    chain = ar1(4000, 4, 0.5, nchain=4, seed=3)
+    assert np.all(np.abs(chain_diagnostics(chain)["rhat"] - 1) < 0.02)
+    # chains stuck in different places
+    chain += np.arange(4)[:, None, None]
+    assert np.all(chain_diagnostics(chain)["rhat"] > 1.5)
+
+
+def test_too_few_batches():
+    monitor = ChainMonitor(2)
+    for x in ar1(15, 2, 0.5)[0]:
+        monitor.update(x)
+    assert np.all(np.isnan(monitor.ess()))
+    assert not monitor.converged(10)
+
+
+def test_converged_and_source_diagnostics():
+    names = ["F200W", "F444W", "ra", "dec"] * 2
+    fluxes = flux_indices(names)
+    assert fluxes.tolist() == [0, 1, 4, 5]
+    chain = ar1(5000, 8, 0.5, seed=4)
+    # make the position parameters of both sources poorly mixed
+    slow = ar1(5000, 8, 0.99, seed=5)
+    chain[..., [2, 3, 6, 7]] = slow[..., [2, 3, 6, 7]]
+    monitor = ChainMonitor(8)
+    for x in chain[0]:
+        monitor.update(x)
+    assert monitor.converged(1000, params=fluxes)
+    assert not monitor.converged(1000)
+    ess, rhat = source_diagnostics(monitor.ess(), monitor.rhat(), 2, params=fluxes)
+    assert np.allclose(ess, [monitor.ess()[:2].min(), monitor.ess()[4:6].min()])
+    assert np.allclose(rhat, [monitor.rhat()[:2].max(), monitor.rhat()[4:6].max()])
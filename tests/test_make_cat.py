@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pytest
+import h5py
+
+import make_cat
+from make_cat import SHAPE_COLS, build_catalogs, fit_chain_length
+
+
+BANDS = ["F200W"]
+
+
+def fake_chaincat(ids, n_iter, seed=0):
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype([("id", np.int64)] +
+                     [(c, np.float64, (n_iter,)) for c in BANDS + SHAPE_COLS])
+    cat = np.zeros(len(ids), dtype=dtype)
+    cat["id"] = ids
+    for c in BANDS + SHAPE_COLS:
+        cat[c] = rng.uniform(1, 2, size=(len(ids), n_iter))
+    return cat
+
+
+def fake_summary(chaincat, patchid):
+    summary = make_cat.summary_cat(chaincat)
+    summary["patchid"] = patchid
+    return summary
+
+
+def test_fit_chain_length():
+    cat = fake_chaincat([1, 2], 10)
+    short = fit_chain_length(cat, 15)
+    assert np.all(short["n_iter"] == 10)
+    assert np.array_equal(short["ra"][:, :10], cat["ra"])
+    assert np.all(np.isnan(short["ra"][:, 10:]))
+    thin = fit_chain_length(cat, 4)
+    assert np.all(thin["n_iter"] == 4)
+    assert np.array_equal(thin["ra"], cat["ra"][:, [0, 3, 6, 9]])
+
+
+@pytest.fixture
+def patch_files(tmp_path, monkeypatch):
+    """Patch files whose chains have different lengths."""
+    lengths = {}
+    for patchid, n_iter in enumerate([20, 35, 12]):
+        fn = str(tmp_path / "test_sample_idx{}.h5".format(patchid))
+        open(fn, "w").close()
+        lengths[fn] = (patchid, n_iter)
+
+    def worker(args):
+        fn, kwargs = args
+        patchid, n_iter = lengths[fn]
+        cat = fake_chaincat([10 * patchid, 10 * patchid + 1], n_iter, seed=patchid)
+        return fn, cat, fake_summary(cat, patchid), None
+
+    monkeypatch.setattr(make_cat, "_patch_catalogs", worker)
+    return sorted(lengths)
+
+
+def test_build_ragged_chains(tmp_path, patch_files):
+    outfile = str(tmp_path / "cat.h5")
+    failed = build_catalogs(patch_files, outfile, nproc=1, progress_every=0)
+    assert failed == []
+    with h5py.File(outfile, "r") as disk:
+        chains = disk["chains"][:]
+    assert len(chains) == 6
+    assert chains["ra"].shape == (6, 20)
+    assert sorted(chains["n_iter"].tolist()) == [12, 12, 20, 20, 20, 20]
+
+
+def test_failed_build_removes_tmpfile(tmp_path, patch_files, monkeypatch):
+    def broken(out, name, rows):
+        raise ValueError("boom")
+
+    monkeypatch.setattr(make_cat, "_append_rows", broken)
+    outfile = str(tmp_path / "cat.h5")
+    with pytest.raises(ValueError):
+        build_catalogs(patch_files, outfile, nproc=1, progress_every=0)
+    assert not os.path.exists(outfile)
+    assert not os.path.exists(outfile + ".tmp")
+
+
+def test_aperture_fraction_matches_exact():
+    rng = np.random.default_rng(3)
+    n = rng.uniform(0.6, 7.5, 1000)
+    r = rng.uniform(0.01, 1.0, 1000)
+    frac = make_cat.fixed_aperture_fraction(n, r, 0.1, exact=False)
+    exact = make_cat.fixed_aperture_fraction(n, r, 0.1)
+    assert np.allclose(frac, exact, atol=1e-4)
+    cat = fake_chaincat(np.arange(10), 100)
+    cat["nsersic"], cat["rhalf"] = n.reshape(10, 100), r.reshape(10, 100)
+    grid = make_cat.ChainCatalog(cat, apertures=[0.1], aperture_grid=True)
+    assert np.array_equal(grid.aperture_fraction(0.1), frac.reshape(10, 100))
+
+
+def test_aperture_fraction_invalid_inputs():
+    n = np.array([2.0, np.nan, 2.0, -1.0, 0.0, 2.0, 20.0])
+    r = np.array([0.1, 0.1, np.nan, 0.1, 0.1, -0.2, 0.1])
+    frac = make_cat.fixed_aperture_fraction(n, r, 0.1, exact=False)
+    bad = np.array([False, True, True, True, True, True, False])
+    assert np.all(np.isnan(frac[bad]))
+    assert np.all(np.isfinite(frac[~bad]))
+    assert np.isclose(frac[-1], make_cat.fixed_aperture_fraction(20.0, 0.1, 0.1))
+    assert np.isnan(make_cat.fixed_aperture_fraction(np.nan, 0.1, 0.1))
+    assert np.isnan(make_cat.fixed_aperture_fraction(np.nan, 0.1, 0.1, exact=False))
+
+
+def test_summary_and_materialize():
+    cat = make_cat.ChainCatalog(fake_chaincat([1, 2, 3], 10), apertures=[0.1])
+    summary = make_cat.summary_cat(cat, percentiles=[16, 84])
+    assert summary.dtype["id"] == np.int64
+    assert np.allclose(summary["ra"], cat["ra"].mean(axis=-1))
+    for c in ["ra", "F200W_aper100mas"]:
+        assert np.allclose(summary[c + "_median"], np.median(cat[c], axis=-1))
+        assert np.allclose(summary[c + "_p16"], np.percentile(cat[c], 16, axis=-1))
+        assert np.allclose(summary[c + "_p84"], np.percentile(cat[c], 84, axis=-1))
+    # padded draws are ignored
+    padded = make_cat.summary_cat(fit_chain_length(cat.base, 25), percentiles=[16, 84])
+    for c in summary.dtype.names:
+        if not c.startswith("F200W_aper"):
+            assert np.allclose(padded[c], summary[c]), c
+    full = cat.materialize()
+    assert full["F200W_aper100mas"].shape == (3, 10)
+
+
+def test_chain_flux_covariance(tmp_path, patch_files):
+    catfile, covfile = str(tmp_path / "cat.h5"), str(tmp_path / "cov.h5")
+    build_catalogs(patch_files, catfile, nproc=1, progress_every=0)
+    make_cat.chain_flux_covariance(catfile, covfile, bands=["F200W", "rhalf"], chunksize=4)
+    with h5py.File(catfile, "r") as disk:
+        chains = disk["chains"][:]
+    with h5py.File(covfile, "r") as disk:
+        assert np.array_equal(disk["id"][:], chains["id"])
+        cov, corr = disk["flux_cov"][:], disk["flux_corr"][:]
+    for row, c, r in zip(chains, cov, corr):
+        n = row["n_iter"]
+        expected = np.cov(np.array([row["F200W"][:n], row["rhalf"][:n]]))
+        assert np.allclose(c, expected, rtol=1e-5)
+        assert np.allclose(np.diag(r), 1, rtol=1e-5)
+
+
+def loop_chaincat(filename, apertures=[]):
+    """The per-source loop that `make_chaincat` used to run, as a reference."""
+    from scipy.special import gammainc, gammaincinv
+    with h5py.File(filename, "r") as disk:
+        chain = disk["chain"][:]
+        active = disk["active"][:]
+        bands = [b.decode("utf-8") for b in disk.attrs["bandlist"]]
+        ref = disk.attrs["reference_coordinates"][:]
+    n_iter, n_param = chain.shape
+    n_per = len(bands) + 6
+    n_source = n_param // n_per
+    colnames = bands + SHAPE_COLS
+    aper = ["{}_aper{:.0f}mas".format(b, r * 1000) for r in apertures for b in bands]
+    cat = np.zeros(n_source, dtype=[("id", np.int64)] +
+                   [(c, np.float64, (n_iter,)) for c in colnames + aper])
+    for s in range(n_source):
+        for j, col in enumerate(colnames):
+            cat[s][col] = chain[:, s * n_per + j]
+    cat["ra"] += ref[0]
+    cat["dec"] += ref[1]
+    cat["q"] = cat["q"]**2
+    cat["pa"] = -np.rad2deg(cat["pa"])
+    cat["id"] = active["source_index"]
+    for r in apertures:
+        n = cat["nsersic"]
+        frac = gammainc(2 * n, gammaincinv(2 * n, 0.5) * (r / cat["rhalf"])**(1. / n))
+        for b in bands:
+            cat["{}_aper{:.0f}mas".format(b, r * 1000)] = cat[b] * frac
+    return cat
+
+
+def test_make_chaincat_matches_loop(tmp_path):
+    rng = np.random.default_rng(4)
+    bands, n_source, n_iter = ["F090W", "F200W", "F444W"], 4, 7
+    # per-source parameters: fluxes, ra, dec, sqrt(q), pa, nsersic, rhalf
+    lo = [0.5] * len(bands) + [-1e-3, -1e-3, 0.3, -1.5, 0.8, 0.02]
+    hi = [5.0] * len(bands) + [1e-3, 1e-3, 1.0, 1.5, 5.0, 0.4]
+    chain = rng.uniform(np.tile(lo, n_source), np.tile(hi, n_source),
+                        size=(n_iter, n_source * len(lo)))
+    active = np.zeros(n_source, dtype=[("source_index", np.int64)])
+    active["source_index"] = rng.permutation(100)[:n_source]
+    fn = str(tmp_path / "patch.h5")
+    with h5py.File(fn, "w") as out:
+        out.attrs["bandlist"] = np.array(bands, dtype="S")
+        out.attrs["reference_coordinates"] = np.array([53.1, -27.8])
+        out.create_dataset("chain", data=chain)
+        out.create_dataset("active", data=active)
+
+    apertures, colors = [0.1, 0.2], [("F090W", "F444W")]
+    cat = make_cat.make_chaincat(fn, apertures=apertures, colors=colors)
+    ref = loop_chaincat(fn, apertures=apertures)
+    assert cat.bands == bands
+    assert len(cat) == n_source
+    assert np.array_equal(cat["id"], ref["id"])
+    for col in bands + SHAPE_COLS:
+        assert cat[col].shape == (n_source, n_iter)
+        assert np.array_equal(cat[col], ref[col]), col
+    for col in ref.dtype.names[len(bands) + 7:]:
+        assert np.allclose(cat[col], ref[col], rtol=1e-4), col
+    assert np.allclose(cat["color_F090W_F444W"],
+                       -2.5 * np.log10(ref["F090W"] / ref["F444W"]))
+
+
+def test_incremental_build(tmp_path, patch_files, monkeypatch):
+    # record the processed files, and make the fluxes depend on file content
+    calls = []
+    worker = make_cat._patch_catalogs
+
+    def counting(args):
+        calls.append(args[0])
+        fn, chaincat, summary, err = worker(args)
+        chaincat["F200W"] += os.path.getsize(fn)
+        summary["F200W"] += os.path.getsize(fn)
+        return fn, chaincat, summary, err
+
+    monkeypatch.setattr(make_cat, "_patch_catalogs", counting)
+    outfile = str(tmp_path / "cat.h5")
+
+    def read(outfile):
+        with h5py.File(outfile, "r") as disk:
+            chains, summary = disk["chains"][:], disk["summary"][:]
+        manifest, sources = make_cat.read_manifest(outfile)
+        names = [n.decode("utf-8") for n in manifest["filename"]]
+        return chains, summary, names
+
+    build_catalogs(patch_files, outfile, nproc=1, progress_every=0)
+    assert sorted(calls) == patch_files
+    first, first_summary, _ = read(outfile)
+
+    # change one file
+    changed = patch_files[1]
+    with open(changed, "w") as f:
+        f.write("new contents")
+    st = os.stat(changed)
+    os.utime(changed, (st.st_atime, st.st_mtime + 10))
+    del calls[:]
+    build_catalogs(patch_files, outfile, nproc=1, progress_every=0, incremental=True)
+    assert calls == [changed]
+    chains, summary, names = read(outfile)
+    assert sorted(names) == patch_files
+    assert sorted(chains["id"]) == sorted(first["id"])
+    patchid = patch_files.index(changed)
+    sel = summary["patchid"] == patchid
+    old = first_summary[first_summary["patchid"] == patchid]
+    assert np.allclose(summary["F200W"][sel], old["F200W"] + os.path.getsize(changed))
+    # rows of the unchanged files are copied as they were
+    for row in chains[~np.isin(chains["id"], summary["id"][sel])]:
+        old = first[first["id"] == row["id"]][0]
+        assert np.array_equal(row["F200W"], old["F200W"], equal_nan=True)
+
+    # nothing changed, nothing is processed
+    del calls[:]
+    build_catalogs(patch_files, outfile, nproc=1, progress_every=0, incremental=True)
+    assert calls == []
+
+    # files that are no longer listed are kept, unless pruned
+    dropped = patch_files[0]
+    build_catalogs(patch_files[1:], outfile, nproc=1, progress_every=0, incremental=True)
+    chains, summary, names = read(outfile)
+    assert dropped in names and len(chains) == 6
+    build_catalogs(patch_files[1:], outfile, nproc=1, progress_every=0,
+                   incremental=True, prune=True)
+    assert calls == []
+    chains, summary, names = read(outfile)
+    assert sorted(names) == patch_files[1:]
+    assert len(chains) == len(summary) == 4
+    assert not np.any(summary["patchid"] == patch_files.index(dropped))
+    assert not np.any(np.isin(chains["id"], [0, 1]))
+
+
+def test_patchid(tmp_path):
+    assert make_cat.patchid_from_filename("/out/test_sample_idx100.h5") == 100
+    assert make_cat.patchid_from_filename("/patch00000042") == 42
+    assert make_cat.patchid_from_filename("patch00000042_1") == 42
+    name = "patch{}_ra{:6.4f}_dec{:6.4f}.h5".format("sample", 53.1, -27.8)
+    assert make_cat.patchid_from_filename(name) == -1
+
+    # a stored patchid takes precedence over the name
+    fn = str(tmp_path / name)
+    with h5py.File(fn, "w") as out:
+        out.create_dataset("patchid", data=7)
+        out.create_group("patch00000003")
+    assert make_cat.read_patchid(fn) == 7
+    with h5py.File(fn, "r") as disk:
+        assert make_cat.read_patchid(disk) == 7
+        assert make_cat.read_patchid(disk["patch00000003"]) == 3
+    with h5py.File(fn, "w") as out:
+        pass
+    assert make_cat.read_patchid(fn) == -1
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import h5py
+
+from massmatrix import MassMatrixStore, assemble, extract
+from sampler import BoundTransform
+
+
+NPARAM = 3
+
+
+def patch_covariance(nsource=3, seed=0):
+    """A covariance where sources 0 and 1 are correlated and source 2 is
+    independent of both.
+    """
+    rng = np.random.default_rng(seed)
+    n = nsource * NPARAM
+    a = rng.normal(size=(n, n)) * 0.3 + np.eye(n)
+    cov = np.dot(a, a.T)
+    cov[2 * NPARAM:, :2 * NPARAM] = 0
+    cov[:2 * NPARAM, 2 * NPARAM:] = 0
+    return cov
+
+
+def test_extract_assemble_round_trip():
+    cov = patch_covariance()
+    sids = [10, 4, 7]
+    payload = extract(cov, sids, NPARAM, weight=50)
+    assert payload["pairs"].tolist() == [[4, 10]]
+    assert payload["weak_pairs"].tolist() == [[7, 10], [4, 7]]
+    inv_metric, known = assemble(payload, sids, NPARAM)
+    assert known.all()
+    assert np.allclose(inv_metric, cov)
+
+    # sources in a different order, and one without a stored block
+    order = [7, 99, 10, 4]
+    inv_metric, known = assemble(payload, order, NPARAM)
+    assert known.tolist() == [True, False, True, True]
+    blocks = {s: slice(i * NPARAM, (i + 1) * NPARAM) for i, s in enumerate(order)}
+    old = {s: slice(i * NPARAM, (i + 1) * NPARAM) for i, s in enumerate(sids)}
+    for a in [7, 10, 4]:
+        for b in [7, 10, 4]:
+            assert np.allclose(inv_metric[blocks[a], blocks[b]], cov[old[a], old[b]])
+    assert np.allclose(inv_metric[blocks[99], blocks[99]], np.eye(NPARAM))
+
+
+def test_assemble_jacobian():
+    # blocks stored in parameter space are mapped to the sampled space of
+    # the current bounds
+    rng = np.random.default_rng(1)
+    lower, upper = np.array([0., -1., 5.]), np.array([10., 1., 6.])
+    mu, sd = np.array([4., 0.2, 5.3]), np.array([0.1, 0.01, 0.005])
+    corr = np.array([[1, 0.5, 0], [0.5, 1, -0.3], [0, -0.3, 1]])
+    cov_x = corr * np.outer(sd, sd)
+    x = rng.multivariate_normal(mu, cov_x, size=20000)
+    bt = BoundTransform(lower, upper)
+    z = bt.to_unbounded(x)
+
+    payload = extract(np.cov(x.T), [0], NPARAM)
+    inv_metric, _ = assemble(payload, [0], NPARAM, jacobian=bt.jacobian(bt.to_unbounded(mu)))
+    assert np.allclose(inv_metric, np.cov(z.T), rtol=0.05, atol=1e-3 * np.diag(inv_metric).min())
+
+
+def test_checkin_merge():
+    store = MassMatrixStore(NPARAM, max_weight=100)
+    cov = patch_covariance()
+    store.checkin(extract(cov, [1, 2, 3], NPARAM, weight=60))
+    assert len(store) == 3 and (1, 2) in store.cross
+    store.checkin(extract(2 * cov, [1, 2, 3], NPARAM, weight=60))
+    # equal weights average
+    assert np.allclose(store.blocks[1], 1.5 * cov[:NPARAM, :NPARAM])
+    assert store.weights[1] == 100
+    # the stored weight is capped, so a newer estimate counts more
+    store.checkin(extract(4 * cov, [1, 2, 3], NPARAM, weight=100))
+    assert np.allclose(store.blocks[1], 0.5 * (1.5 + 4) * cov[:NPARAM, :NPARAM])
+    # cross terms are replaced, and removed when no longer significant
+    assert np.allclose(store.cross[(1, 2)], 4 * cov[:NPARAM, NPARAM:2 * NPARAM])
+    uncorrelated = np.diag(np.diag(cov))[:2 * NPARAM, :2 * NPARAM]
+    store.checkin(extract(uncorrelated, [1, 2], NPARAM, weight=10))
+    assert (1, 2) not in store.cross
+    assert store.checkout([5, 6]) is None
+    assert store.known([1, 5]).tolist() == [True, False]
+
+
+def test_save_load(tmp_path):
+    fn = str(tmp_path / "mm.h5")
+    store = MassMatrixStore(NPARAM, filename=fn)
+    store.checkin(extract(patch_covariance(), [1, 2, 3], NPARAM, weight=20))
+    store.save()
+    loaded = MassMatrixStore(NPARAM, filename=fn)
+    assert sorted(loaded.blocks) == [1, 2, 3]
+    for s in [1, 2, 3]:
+        assert np.allclose(loaded.blocks[s], store.blocks[s])
+        assert loaded.weights[s] == store.weights[s]
+    assert sorted(loaded.cross) == sorted(store.cross)
+    payload = loaded.checkout([3, 1, 2])
+    assert np.allclose(assemble(payload, [1, 2, 3], NPARAM)[0],
+                       assemble(store.checkout([1, 2, 3]), [1, 2, 3], NPARAM)[0])
+
+    with pytest.raises(ValueError):
+        MassMatrixStore(NPARAM + 1, filename=fn)
+    # stores written before blocks were kept in parameter space
+    with h5py.File(fn, "a") as disk:
+        del disk.attrs["space"]
+    with pytest.raises(ValueError):
+        MassMatrixStore(NPARAM, filename=fn)
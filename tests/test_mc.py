@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+pm = pytest.importorskip("pymc3")
+pytest.importorskip("forcepho")
+
+import mc
+from pymc3.step_methods.hmc.quadpotential import QuadPotentialFull
+
+
+def test_step_swaps_integrator_potential():
+    ndim = 3
+    template = mc.ModelTemplate(ndim)
+    first = QuadPotentialFull(np.eye(ndim))
+    step = template.step(potential=first)
+    assert step.integrator._potential is first
+
+    second = QuadPotentialFull(2 * np.eye(ndim))
+    swapped = template.step(potential=second)
+    assert swapped is step
+    assert swapped.potential is second
+    assert swapped.integrator._potential is second
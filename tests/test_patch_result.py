@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from argparse import Namespace
+import numpy as np
+import h5py
+import pytest
+
+from patch_result import HandleCache, PatchResult
+from utils import write_patch
+
+
+def make_file(fn, n_iter=5, n_param=3):
+    with h5py.File(fn, "w") as out:
+        out.attrs["bandlist"] = np.array(["F200W"], dtype="S")
+        out.create_dataset("chain", data=np.arange(n_iter * n_param).reshape(n_iter, n_param))
+    return fn
+
+
+def test_cache_context_closes_handles(tmp_path):
+    files = [make_file(str(tmp_path / "p{}.h5".format(i))) for i in range(3)]
+    with HandleCache(maxsize=2) as cache:
+        opened = [cache.get(fn) for fn in files]
+        assert len(cache) == 2
+        assert not opened[0].id.valid
+    assert len(cache) == 0
+    assert not any([h.id.valid for h in opened])
+
+
+def test_patch_result_close(tmp_path):
+    fn = make_file(str(tmp_path / "p.h5"))
+    cache = HandleCache()
+    with PatchResult(fn, cache=cache) as result:
+        assert result.chain_shape == (5, 3)
+        assert np.array_equal(result.chain(params=[1]), np.arange(1, 15, 3)[:, None])
+        assert len(cache) == 1
+    assert len(cache) == 0
+
+    # a group passed in is left open
+    with h5py.File(fn, "r") as disk:
+        with PatchResult(disk, cache=cache) as result:
+            assert result.bandlist == ["F200W"]
+        assert disk.id.valid
+
+
+def mock_patch(nexp=3, nsrc=2, seed=0):
+    rng = np.random.default_rng(seed)
+    N = rng.integers(10, 30, nexp)
+    tot = N.sum()
+    return Namespace(patch_reference_coordinates=np.array([53.1, -27.8]),
+                     bandlist=["F200W", "F444W"],
+                     epaths=["F200W/exp0", "F200W/exp1", "F444W/exp0"][:nexp],
+                     exposure_start=np.cumsum(N) - N, exposure_N=N,
+                     xpix=rng.uniform(0, 100, tot), ypix=rng.uniform(0, 100, tot),
+                     ierr=rng.uniform(0, 1, tot),
+                     D=rng.normal(size=(nexp, nsrc, 2, 2)), CW=rng.normal(size=(nexp, nsrc, 2, 2)),
+                     crpix=rng.normal(size=(nexp, 2)), crval=rng.normal(size=(nexp, 2)))
+
+
+@pytest.mark.parametrize("compression", ["gzip", None])
+def test_layouts_round_trip(tmp_path, compression):
+    patch = mock_patch()
+    split = np.cumsum(patch.exposure_N)[:-1]
+    residual = np.split(np.random.default_rng(1).normal(size=patch.exposure_N.sum()), split)
+    results = {}
+    for layout in ["groups", "packed"]:
+        fn = str(tmp_path / "{}.h5".format(layout))
+        with h5py.File(fn, "w") as out:
+            write_patch(out, patch, pixeldatadict=dict(active_residual=residual),
+                        layout=layout, compression=compression)
+        results[layout] = PatchResult(fn)
+
+    groups, packed = results["groups"], results["packed"]
+    assert groups.layout == "groups" and packed.layout == "packed"
+    assert groups.epaths == packed.epaths == patch.epaths
+    assert groups.bandlist == packed.bandlist == patch.bandlist
+    for i, epath in enumerate(patch.epaths):
+        s = slice(patch.exposure_start[i], patch.exposure_start[i] + patch.exposure_N[i])
+        for name in ["xpix", "ypix", "ierr"]:
+            expected = getattr(patch, name)[s]
+            assert np.array_equal(groups.exposure(i, name), expected)
+            assert np.array_equal(packed.exposure(epath, name), expected)
+        assert np.array_equal(groups.exposure(i, "active_residual"), residual[i])
+        assert np.array_equal(packed.exposure(i, "active_residual"), residual[i])
+        gmeta, pmeta = groups.exposure_meta(epath), packed.exposure_meta(i)
+        assert sorted(gmeta) == sorted(pmeta)
+        for k in gmeta:
+            assert np.array_equal(gmeta[k], getattr(patch, k)[i])
+            assert np.array_equal(pmeta[k], gmeta[k])
+    for r in results.values():
+        r.close()
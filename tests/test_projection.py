@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+pytest.importorskip("astropy")
+from astropy.wcs import WCS
+
+from make_cat import fit_chain_length, SHAPE_COLS
+from projection import Projector
+
+
+def tan_wcs():
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [53.16, -27.78]
+    wcs.wcs.crpix = [1000., 1000.]
+    wcs.wcs.cd = np.array([[-1.7e-5, 2e-7], [3e-7, 1.7e-5]])
+    return wcs
+
+
+def position_chains(n_source=3, n_iter=40, seed=0):
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype([("id", np.int64)] + [(c, np.float64, (n_iter,)) for c in SHAPE_COLS])
+    cat = np.zeros(n_source, dtype=dtype)
+    cat["id"] = np.arange(n_source) + 1
+    ra0 = 53.16 + rng.uniform(-0.01, 0.01, n_source)
+    dec0 = -27.78 + rng.uniform(-0.01, 0.01, n_source)
+    cat["ra"] = ra0[:, None] + rng.normal(0, 1e-5, (n_source, n_iter))
+    cat["dec"] = dec0[:, None] + rng.normal(0, 1e-5, (n_source, n_iter))
+    return cat
+
+
+def reference(wcs, ra, dec):
+    x, y = wcs.all_world2pix(ra.ravel(), dec.ravel(), 1)
+    return x.reshape(ra.shape), y.reshape(ra.shape)
+
+
+def test_projector_matches_wcs():
+    wcs = tan_wcs()
+    cat = position_chains()
+    x, y = Projector(wcs).project(cat["ra"], cat["dec"], ids=cat["id"])
+    xr, yr = reference(wcs, cat["ra"], cat["dec"])
+    assert np.allclose(x, xr, atol=1e-3) and np.allclose(y, yr, atol=1e-3)
+
+
+def test_projector_padded_chains():
+    wcs = tan_wcs()
+    cat = position_chains()
+    padded = fit_chain_length(cat, 60)
+    projector = Projector(wcs)
+    x, y = projector.project(padded["ra"], padded["dec"], ids=padded["id"])
+    valid = np.isfinite(padded["ra"])
+    assert np.all(np.isnan(x[~valid])) and np.all(np.isnan(y[~valid]))
+    xr, yr = reference(wcs, cat["ra"], cat["dec"])
+    assert np.allclose(x[valid], xr.ravel(), atol=1e-3)
+    assert np.allclose(y[valid], yr.ravel(), atol=1e-3)
+
+    # a source with no valid samples is not cached as NaN
+    allnan = cat.copy()
+    allnan["ra"][0], allnan["dec"][0] = np.nan, np.nan
+    x, y = projector.project(allnan["ra"][:1], allnan["dec"][:1], ids=[99])
+    assert np.all(np.isnan(x))
+    x, y = projector.project(cat["ra"][:1], cat["dec"][:1], ids=[99])
+    assert np.allclose(x, xr[:1], atol=1e-3)
+
+    # later unpadded catalogs for the same ids use the good transforms
+    x, y = projector.project(cat["ra"], cat["dec"], ids=cat["id"])
+    assert np.allclose(x, xr, atol=1e-3) and np.allclose(y, yr, atol=1e-3)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+from argparse import Namespace
+import numpy as np
+import pytest
+
+from runstore import RunStore
+
+
+def mock_patch(nexp=2, nsrc=2, seed=0):
+    rng = np.random.default_rng(seed)
+    N = rng.integers(10, 30, nexp)
+    tot = N.sum()
+    return Namespace(patch_reference_coordinates=np.array([53.1, -27.8]),
+                     bandlist=["F200W"],
+                     epaths=["F200W/exp{}".format(i) for i in range(nexp)],
+                     exposure_start=np.cumsum(N) - N, exposure_N=N,
+                     xpix=rng.uniform(0, 100, tot), ypix=rng.uniform(0, 100, tot),
+                     ierr=rng.uniform(0, 1, tot),
+                     D=rng.normal(size=(nexp, nsrc, 2, 2)), CW=rng.normal(size=(nexp, nsrc, 2, 2)),
+                     crpix=rng.normal(size=(nexp, 2)), crval=rng.normal(size=(nexp, 2)))
+
+
+def append_one(directory, patchid, value, writer="host"):
+    """Append a patch in its own store, as a one-patch process would."""
+    active = np.zeros(2, dtype=[("source_index", np.int64)])
+    active["source_index"] = [2 * patchid, 2 * patchid + 1]
+    with RunStore(directory, writer=writer, layout="packed") as store:
+        store.append(patchid, mock_patch(), active=active,
+                     otherdatadict=dict(value=np.array(value)))
+
+
+def test_successive_writers_share_shard(tmp_path):
+    directory = str(tmp_path)
+    for patchid in range(3):
+        append_one(directory, patchid, patchid)
+    shards = [f for f in os.listdir(directory) if f.startswith("shard_")]
+    assert len(shards) == 1
+    store = RunStore(directory)
+    idx = store.index()
+    assert idx["patchid"].tolist() == [0, 1, 2]
+    assert idx["complete"].all()
+    with store.open_patch(1) as g:
+        assert g["value"][()] == 1
+
+
+def test_full_shard_starts_new_one(tmp_path):
+    directory = str(tmp_path)
+    for patchid in range(3):
+        with RunStore(directory, writer="host", max_patches_per_shard=2,
+                      layout="packed") as store:
+            store.append(patchid, mock_patch())
+    shards = [f for f in os.listdir(directory) if f.startswith("shard_")]
+    assert len(shards) == 2
+    assert len(RunStore(directory).index()) == 3
+
+
+def test_duplicate_patchid_resolves_to_latest(tmp_path):
+    directory = str(tmp_path)
+    append_one(directory, 7, 1.0)
+    append_one(directory, 8, 0.0)
+    append_one(directory, 7, 2.0)
+    append_one(directory, 7, 3.0, writer="other")
+    store = RunStore(directory)
+    idx = store.index()
+    assert sorted(idx["patchid"].tolist()) == [7, 8]
+    assert store.find_patch(7)["shard"].startswith("shard_other")
+    with store.open_patch(7) as g:
+        assert g["value"][()] == 3.0
+    assert store.find_source(14).tolist() == [7]
+
+
+def test_read_timing_from_store(tmp_path):
+    from utils import read_timing
+    directory = str(tmp_path)
+    timing = np.zeros(2, dtype=[("name", "S32"), ("duration", np.float64)])
+    with RunStore(directory, writer="host", layout="packed") as store:
+        store.append(0, mock_patch(), otherdatadict=dict(timing=timing))
+        store.append(1, mock_patch())
+    tables = read_timing(RunStore(directory))
+    assert len(tables) == 1
+    assert tables[0].dtype == timing.dtype
+
+
+def test_reader_sees_shard_closed_after_index_read(tmp_path):
+    directory = str(tmp_path)
+    reader = RunStore(directory)
+    writer = RunStore(directory, writer="host", layout="packed")
+    writer.append(3, mock_patch(), otherdatadict=dict(value=np.array(3.0)))
+    assert not reader.find_patch(3)["complete"]
+    with pytest.raises(IOError):
+        reader.result(3)
+    with pytest.raises(IOError):
+        with reader.open_patch(3) as g:
+            pass
+    writer.close()
+    # the cached index is stale, but the reader re-reads it
+    assert not reader.find_patch(3)["complete"]
+    with reader.result(3) as result:
+        assert result["value"] == 3.0
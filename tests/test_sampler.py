@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from adaptation import WindowedAdaptation
+from sampler import BoundTransform, Sampler, loop_batch, sample_lockstep
+
+
+def gaussian(ndim=4, seed=0):
+    rng = np.random.default_rng(seed)
+    a = rng.normal(size=(ndim, ndim))
+    cov = np.dot(a, a.T) / ndim + 0.1 * np.eye(ndim)
+    mu = rng.normal(size=ndim)
+    prec = np.linalg.inv(cov)
+
+    def lnprob_and_grad(x):
+        d = x - mu
+        return -0.5 * np.dot(d, np.dot(prec, d)), -np.dot(prec, d)
+
+    return mu, cov, lnprob_and_grad
+
+
+def check_moments(chain, mu, cov, tol=0.15):
+    sd = np.sqrt(np.diag(cov))
+    assert np.all(np.abs(chain.mean(axis=0) - mu) < tol * sd)
+    corr = cov / np.outer(sd, sd)
+    est = np.cov(chain.T)
+    assert np.all(np.abs(np.sqrt(np.diag(est)) / sd - 1) < tol)
+    assert np.all(np.abs(est / np.outer(sd, sd) - corr) < tol)
+
+
+def test_nuts_correlated_gaussian():
+    mu, cov, f = gaussian()
+    s = Sampler(f, ndim=len(mu), seed=1)
+    schedule = WindowedAdaptation(len(mu), 500, n_start=25, tol=0)
+    r = s.sample(mu + 1, n_iter=3000, n_warm=200, schedule=schedule)
+    check_moments(r.chain, mu, cov)
+    assert 0.6 < r.accept.mean() < 0.95
+    assert r.diverging.sum() == 0
+    assert r.n_tune == 700
+
+
+def test_hmc_correlated_gaussian():
+    mu, cov, f = gaussian(seed=2)
+    s = Sampler(f, ndim=len(mu), inv_metric=cov, n_steps=5, seed=3)
+    r = s.sample(mu, n_iter=4000, n_warm=300)
+    check_moments(r.chain, mu, cov)
+    assert np.all(r.n_leapfrog == 5)
+
+
+def test_bounded_uniform():
+    lower, upper = np.array([0., -2.]), np.array([1., 5.])
+    s = Sampler(lambda x: (0.0, np.zeros(2)), lower=lower, upper=upper, seed=4)
+    r = s.sample(0.5 * (lower + upper), n_iter=4000, n_warm=300)
+    assert np.all((r.chain > lower) & (r.chain < upper))
+    width = upper - lower
+    assert np.all(np.abs(r.chain.mean(axis=0) - 0.5 * (lower + upper)) < 0.05 * width)
+    assert np.all(np.abs(r.chain.std(axis=0) / (width / np.sqrt(12)) - 1) < 0.1)
+
+
+def test_bound_transform_round_trip():
+    lower = np.array([0., -3., -np.inf])
+    upper = np.array([1., 7., np.inf])
+    bt = BoundTransform(lower, upper)
+    x = np.array([0.3, 6.99, -40.])
+    assert np.allclose(bt.to_bounded(bt.to_unbounded(x)), x)
+    z = np.array([-5., 0.1, 12.])
+    assert np.allclose(bt.to_unbounded(bt.to_bounded(z)), z)
+    # points on the bounds are moved inside
+    zb = bt.to_unbounded(np.array([0., 7., 0.]))
+    assert np.all(np.isfinite(zb))
+
+
+def test_bound_transform_jacobian():
+    lower, upper = np.array([0., -3.]), np.array([1., 7.])
+    bt = BoundTransform(lower, upper)
+
+    def lnp_x(x):
+        return -np.sum(x**2), -2 * x
+
+    def lnp_z(z):
+        return bt.lnp_and_grad(z, *lnp_x(bt.to_bounded(z)))
+
+    z = np.array([0.4, -1.3])
+    lnp, grad = lnp_z(z)
+    # log-Jacobian from finite differences of the transform
+    h = 1e-6
+    dxdz = (bt.to_bounded(z + h) - bt.to_bounded(z - h)) / (2 * h)
+    assert np.isclose(lnp, lnp_x(bt.to_bounded(z))[0] + np.log(dxdz).sum())
+    # gradient from finite differences of the transformed ln-probability
+    fd = [(lnp_z(z + h * e)[0] - lnp_z(z - h * e)[0]) / (2 * h) for e in np.eye(2)]
+    assert np.allclose(grad, fd, rtol=1e-5)
+
+    # the Jacobian maps the unit density in x to a normalized density in z
+    bt1 = BoundTransform([2.], [5.])
+    zz = np.linspace(-40, 40, 40001)
+    logj = np.array([bt1.lnp_and_grad(np.array([v]), 0.0, np.zeros(1))[0] for v in zz])
+    assert np.isclose(np.exp(logj).sum() * (zz[1] - zz[0]), 3.0, rtol=1e-6)
+
+
+def test_lockstep_matches_sequential():
+    mu, cov, f = gaussian(ndim=3, seed=5)
+    starts = [mu + 0.5, mu - 0.5]
+    seq = [Sampler(f, ndim=3, seed=k).sample(x0, n_iter=200, n_warm=100)
+           for k, x0 in enumerate(starts)]
+    samplers = [Sampler(f, ndim=3, seed=k) for k in range(2)]
+    lock, n_batch = sample_lockstep(samplers, loop_batch(f), starts,
+                                    n_iter=200, n_warm=100)
+    for a, b in zip(seq, lock):
+        assert np.array_equal(a.chain, b.chain)
+    assert n_batch <= sum([r.ncall for r in lock])
+
+
+def test_lockstep_shared_stopping_rule():
+    from diagnostics import chain_diagnostics
+    mu, cov, f = gaussian(ndim=3, seed=6)
+    samplers = [Sampler(f, ndim=3, seed=k) for k in range(4)]
+    starts = [mu + 0.1 * k for k in range(4)]
+    params = np.array([0, 1])
+    results, n_batch = sample_lockstep(samplers, loop_batch(f), starts, n_iter=50,
+                                       n_warm=100, target_ess=600, max_iter=2000,
+                                       ess_params=params, check_every=25)
+    lengths = [len(r.chain) for r in results]
+    assert len(set(lengths)) == 1
+    assert 50 <= lengths[0] < 2000
+    # the combined ESS of the stored chains meets the target
+    ess = chain_diagnostics(np.array([r.chain for r in results]))["ess"]
+    assert np.all(ess[params] >= 600)
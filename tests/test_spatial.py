@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from spatial import SourceIndex, radec_to_xyz
+
+
+def separation(ra, dec, ra0, dec0):
+    """Brute-force angular separation in degrees."""
+    a, b = radec_to_xyz(ra, dec), radec_to_xyz(ra0, dec0)[0]
+    cross = np.sqrt((np.cross(a, b)**2).sum(-1))
+    return np.rad2deg(np.arctan2(cross, np.dot(a, b)))
+
+
+@pytest.fixture
+def catalog():
+    rng = np.random.default_rng(3)
+    n = 5000
+    # uniform on the sphere, plus clumps at the ra=0/360 seam and at the poles
+    ra = rng.uniform(0, 360, n)
+    dec = np.rad2deg(np.arcsin(rng.uniform(-1, 1, n)))
+    seam = rng.uniform(-2, 2, 500) % 360
+    pole = rng.uniform(0, 360, 1000)
+    ra = np.concatenate([ra, seam, pole])
+    dec = np.concatenate([dec, rng.uniform(-2, 2, 500),
+                          np.sign(rng.uniform(-1, 1, 1000)) * rng.uniform(87, 90, 1000)])
+    return ra, dec
+
+
+QUERIES = [(120., 30., 5.), (0.1, 0.5, 1.), (359.9, -0.3, 1.5), (0., 0., 0.7),
+           (45., 89.5, 2.), (200., -89.9, 1.), (10., 90., 0.5)]
+
+
+@pytest.mark.parametrize("ra0,dec0,radius", QUERIES)
+def test_cone(catalog, ra0, dec0, radius):
+    ra, dec = catalog
+    index = SourceIndex(ra, dec)
+    expected = np.where(separation(ra, dec, ra0, dec0) <= radius)[0]
+    assert len(expected) > 0
+    assert np.array_equal(index.within_radius(ra0, dec0, radius), expected)
+
+
+@pytest.mark.parametrize("box", [(10., 40., -20., 15.), (0., 1.5, -1., 1.),
+                                 (358., 360., -1.5, 1.5), (0., 360., 88., 90.),
+                                 (30., 250., -89.5, -87.)])
+def test_rectangle(catalog, box):
+    ra, dec = catalog
+    index = SourceIndex(ra, dec)
+    ra_min, ra_max, dec_min, dec_max = box
+    expected = np.where((ra >= ra_min) & (ra <= ra_max) &
+                        (dec >= dec_min) & (dec <= dec_max))[0]
+    assert len(expected) > 0
+    assert np.array_equal(index.within_rectangle(*box), expected)
+
+
+def test_nearest(catalog):
+    ra, dec = catalog
+    index = SourceIndex(ra, dec)
+    ra0 = np.array([q[0] for q in QUERIES])
+    dec0 = np.array([q[1] for q in QUERIES])
+    k = 5
+    inds, sep = index.nearest(ra0, dec0, k=k)
+    assert inds.shape == sep.shape == (len(QUERIES), k)
+    for i in range(len(QUERIES)):
+        ref = separation(ra, dec, ra0[i], dec0[i])
+        order = np.argsort(ref)[:k]
+        assert np.array_equal(inds[i], order)
+        assert np.allclose(sep[i], ref[order], rtol=1e-6, atol=1e-9)
+
+    # neighbors beyond max_radius are flagged as missing
+    inds, sep = index.nearest(ra0, dec0, k=k, max_radius=0.05)
+    for i in range(len(QUERIES)):
+        ref = separation(ra, dec, ra0[i], dec0[i])
+        n = min(k, (ref <= 0.05).sum())
+        assert np.array_equal(inds[i, :n], np.argsort(ref)[:n])
+        assert np.all(inds[i, n:] == len(index))
+        assert np.all(np.isinf(sep[i, n:]))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from argparse import Namespace
+import numpy as np
+import h5py
+import pytest
+
+import utils
+from utils import ResultWriter
+
+
+def mock_patch(nexp=2, seed=0):
+    rng = np.random.default_rng(seed)
+    N = rng.integers(10, 30, nexp)
+    tot = N.sum()
+    return Namespace(patch_reference_coordinates=np.array([53.1, -27.8]),
+                     bandlist=["F200W"],
+                     epaths=["F200W/exp{}".format(i) for i in range(nexp)],
+                     exposure_start=np.cumsum(N) - N, exposure_N=N,
+                     xpix=rng.uniform(0, 100, tot), ypix=rng.uniform(0, 100, tot),
+                     ierr=rng.uniform(0, 1, tot),
+                     D=rng.normal(size=(nexp, 1, 2, 2)), CW=rng.normal(size=(nexp, 1, 2, 2)),
+                     crpix=rng.normal(size=(nexp, 2)), crval=rng.normal(size=(nexp, 2)))
+
+
+def test_queued_writes_flushed_on_close(tmp_path, monkeypatch):
+    # hold the background thread so that writes pile up in the queue
+    gate = threading.Event()
+    dump = utils.dump_to_h5
+
+    def slow_dump(*args, **kwargs):
+        gate.wait()
+        dump(*args, **kwargs)
+
+    monkeypatch.setattr(utils, "dump_to_h5", slow_dump)
+    patch = mock_patch()
+    names = [str(tmp_path / "patch{}.h5".format(i)) for i in range(4)]
+    writer = ResultWriter(maxsize=len(names))
+    for i, fn in enumerate(names):
+        writer.submit(fn, patch, otherdatadict=dict(value=np.array(i)))
+        # the patch is copied, so it can be changed after submission
+        patch.xpix[:] = -1
+    assert not any([os.path.exists(fn) for fn in names])
+    gate.set()
+    writer.close()
+    for i, fn in enumerate(names):
+        with h5py.File(fn, "r") as disk:
+            assert disk["value"][()] == i
+            assert (disk["F200W/exp0/xpix"][:] >= 0).all() == (i == 0)
+    assert writer.stats()["n_written"] == len(names)
+    with pytest.raises(RuntimeError):
+        writer.submit(names[0], patch)
+
+
+def test_failed_write_raised_on_close(tmp_path):
+    writer = ResultWriter()
+    writer.submit(str(tmp_path / "missing" / "patch.h5"), mock_patch())
+    with pytest.raises(RuntimeError) as err:
+        writer.close()
+    assert isinstance(err.value.__cause__, OSError)
+    # the error is only raised once
+    writer.close()
+
+
+def test_failed_write_raised_on_next_submit(tmp_path):
+    writer = ResultWriter()
+    writer.submit(str(tmp_path / "missing" / "patch.h5"), mock_patch())
+    writer.queue.join()
+    good = str(tmp_path / "good.h5")
+    with pytest.raises(RuntimeError) as err:
+        writer.submit(good, mock_patch())
+    assert isinstance(err.value.__cause__, OSError)
+    # the writer is still usable after the error was reported
+    writer.submit(good, mock_patch())
+    writer.close()
+    assert os.path.exists(good)